@@ -0,0 +1 @@
+"""Core engines behind the AgriLoop AI Streamlit app."""
@@ -0,0 +1,159 @@
+"""Compact advisory history.
+
+Advisories are stored as numbers: ``level`` indexes the engine's
+``REC_TEMPLATES`` and ``soil_moisture`` is the value the template is
+formatted with, so the recommendation text is rendered when shown instead
+of being stored on every row. Rows written before these columns existed
+keep their ``recommendation`` text and are shown as-is.
+
+``AdvisoryLog`` answers the "latest few advisories of a user" queries of
+the dashboard and advisory pages from per-user ring buffers of slotted
+``Advisory`` records. A user's buffer is read from the repository on first
+use and then kept current from the table's write events (queued without
+blocking the writer and applied at the next query, like the marketplace
+index), so a rerun no longer materializes a user's whole history. A gap in
+the table version -- writes this process did not see -- drops the buffers.
+
+``archive`` moves advisories older than a cutoff out of the table into a
+gzip'd CSV file; ``AdvisoryLog.apply_retention`` runs it at most once per
+``min_interval`` for a retention period in days, and ``watch_retention``
+does so from a background thread so no page render pays for it.
+"""
+import csv
+import gzip
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from datetime import datetime
+
+from agriloop.engine import recommendation_text
+from agriloop.storage import columns_of
+
+TABLE = 'advisories'
+RECENT = 20           # records kept per user
+ARCHIVE_CHUNK = 5_000
+
+class Advisory:
+    __slots__ = ('id', 'crop_id', 'type', 'level', 'soil_moisture', 'volume', 'frequency', 'created_at', 'text')
+
+    def __init__(self, row):
+        self.id, self.crop_id, self.type = row['id'], row.get('crop_id'), row.get('type') or 'irrigation'
+        self.level, self.soil_moisture = row.get('level'), row.get('soil_moisture')
+        self.volume, self.frequency, self.created_at = row.get('volume'), row.get('frequency'), row.get('created_at') or ''
+        self.text = row.get('recommendation') if self.level is None else None
+
+    def recommendation(self, crop_name):
+        if self.level is None:
+            return self.text or ''
+        return recommendation_text(self.level, crop_name, self.soil_moisture)
+
+def record(user, crop_id, rec, soil_moisture, created_at=None):
+    """The row to insert for an irrigation result ``rec`` from ``get_irrigation_rec``."""
+    return {'user': user, 'crop_id': crop_id, 'type': 'irrigation', 'status': 'completed', 'level': rec['level'],
+            'soil_moisture': soil_moisture, 'volume': rec['volume'], 'frequency': rec['frequency'],
+            'created_at': created_at or datetime.now().isoformat()}
+
+class AdvisoryLog:
+    def __init__(self, size=RECENT):
+        self.size = size
+        self.version = None
+        self._users = {}  # user -> deque of Advisory, oldest first
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._last_retention = 0.0
+
+    def on_write(self, op, items, version):
+        """Repository listener: queue the write for the next query."""
+        self._pending.append((op, items, version))
+
+    def _sync(self, repo):
+        events = []
+        while self._pending:
+            events.append(self._pending.popleft())
+        for op, items, version in sorted(events, key=lambda e: e[2]):
+            if self.version is None or version <= self.version:
+                continue
+            if version != self.version + 1:
+                self._users.clear()
+            self.version = version
+            if op == 'insert':
+                for row in items:
+                    buf = self._users.get(row['user'])
+                    if buf is not None and all(a.id != row['id'] for a in buf):
+                        buf.append(Advisory(row))
+            else:
+                # updates and deletes are rare (edits, archiving): re-read the users they touch
+                keys = {k for k, _ in items} if op == 'update' else set(items)
+                for user in [u for u, buf in self._users.items() if any(a.id in keys for a in buf)]:
+                    del self._users[user]
+        current = repo.version(TABLE)
+        if self.version != current:
+            self._users.clear()
+            self.version = current
+
+    def recent(self, repo, user, n=RECENT):
+        """The latest ``n`` (at most ``size``) advisories of ``user``, newest first."""
+        with self._lock:
+            self._sync(repo)
+            buf = self._users.get(user)
+            if buf is None:
+                rows, _ = repo.page(TABLE, 0, self.size, descending=True, user=user)
+                buf = self._users[user] = deque(map(Advisory, reversed(rows)), maxlen=self.size)
+            return list(buf)[::-1][:n]
+
+    def apply_retention(self, repo, days, directory, min_interval=3600, now=None):
+        """Archive advisories older than ``days`` (None keeps everything); returns the number moved."""
+        now = now or time.time()
+        if days is None or now - self._last_retention < min_interval:
+            return 0
+        self._last_retention = now
+        return archive(repo, datetime.fromtimestamp(now - days * 86400).isoformat(), directory)
+
+def archive(repo, before, directory, chunk=ARCHIVE_CHUNK):
+    """Move advisories created before ``before`` (ISO timestamp) into ``directory``; returns the number moved."""
+    cols, moved, f = columns_of(TABLE), 0, None
+    try:
+        while True:
+            rows = repo.before(TABLE, 'created_at', before, chunk)
+            if not rows:
+                return moved
+            if f is None:
+                os.makedirs(directory, exist_ok=True)
+                f = gzip.open(os.path.join(directory, f"{TABLE}-{time.strftime('%Y%m%d-%H%M%S')}.csv.gz"), 'wt', newline='')
+                out = csv.writer(f)
+                out.writerow(cols)
+            out.writerows([r[c] for c in cols] for r in rows)
+            f.flush()
+            repo.delete_many(TABLE, [r['id'] for r in rows])
+            moved += len(rows)
+    finally:
+        if f is not None:
+            f.close()
+
+def watch_retention(repo, days, directory, interval=3600):
+    """Archive advisories older than ``days`` every ``interval`` seconds on a daemon thread; returns the thread."""
+    def loop():
+        log = log_for(repo)
+        while True:
+            try:
+                log.apply_retention(repo, days, directory, min_interval=interval)
+            except OSError:
+                pass  # e.g. the archive directory is not writable right now; retry on the next pass
+            time.sleep(interval)
+    thread = threading.Thread(target=loop, daemon=True, name="advisory-retention")
+    thread.start()
+    return thread
+
+_logs = weakref.WeakKeyDictionary()
+_logs_lock = threading.Lock()
+
+def log_for(repo):
+    """The process-wide advisory log following ``repo``; subscribed on first use."""
+    with _logs_lock:
+        log = _logs.get(repo)
+        if log is None:
+            log = _logs[repo] = AdvisoryLog()
+            repo.subscribe(TABLE, log.on_write)
+        return log
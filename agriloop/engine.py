@@ -0,0 +1,177 @@
+"""Vectorized advisory engine.
+
+All scoring runs over columnar inputs (lists, NumPy arrays or pandas Series)
+in a single pass; the scalar helpers used by the single-crop forms are thin
+wrappers over the same batch functions or lookup tables so both paths
+always agree.
+"""
+import random
+
+import numpy as np
+
+# ============ IRRIGATION ============
+URGENCY = np.array(["high", "medium", "low", "none"])
+FREQUENCY = np.array([1, 2, 3, 5])
+MOISTURE_BANDS = [30, 50, 70]  # soil moisture < 30 -> high, < 50 -> medium, < 70 -> low, else none
+
+RISK_HIGH_TEMP, RISK_MOISTURE_DEFICIT, RISK_LOW_HUMIDITY = 1, 2, 4
+RISK_LABELS = [(RISK_HIGH_TEMP, "High temperature stress"),
+               (RISK_MOISTURE_DEFICIT, "Critical moisture deficit"),
+               (RISK_LOW_HUMIDITY, "Low humidity")]
+
+REC_TEMPLATES = [
+    "🚨 Immediate irrigation needed for {crop}. Soil moisture critically low at {moisture}%.",
+    "⚠️ Schedule irrigation within 24-48 hours for {crop}. Moisture: {moisture}%.",
+    "📊 Monitor {crop}. Irrigation may be needed in 2-3 days. Moisture: {moisture}%.",
+    "✅ No immediate irrigation needed for {crop}. Moisture adequate at {moisture}%.",
+]
+
+def _col(x):
+    return np.asarray(x, dtype=float)
+
+def evaporation(temp, humidity):
+    """Daily evaporative demand (mm) for the given temperature (°C) and relative humidity (%)."""
+    return (_col(temp) * 0.1) + ((100 - _col(humidity)) * 0.05)
+
+def irrigation_batch(soil_moisture, temp, humidity, rainfall, area):
+    """Score every row at once.
+
+    Returns a dict of equal-length arrays: ``volume`` (L), ``frequency`` (days),
+    ``level`` (0=high .. 3=none, index into ``URGENCY``/``REC_TEMPLATES``),
+    ``urgency`` (labels) and ``risks`` (bitmask of ``RISK_*`` flags).
+    """
+    sm, t, h, rain, a = _col(soil_moisture), _col(temp), _col(humidity), _col(rainfall), _col(area)
+    water_stress = np.maximum(0, (100 - sm) / 100)
+    evap = evaporation(t, h)
+    rain_factor = np.maximum(0, 1 - (rain / 50))
+    volume = np.maximum(0, a * 1000 * water_stress * evap * rain_factor)
+
+    level = np.searchsorted(MOISTURE_BANDS, sm, side="right")
+    risks = ((t > 35) * RISK_HIGH_TEMP) | ((sm < 25) * RISK_MOISTURE_DEFICIT) | ((h < 30) * RISK_LOW_HUMIDITY)
+    return {"volume": volume, "frequency": FREQUENCY[level], "level": level,
+            "urgency": URGENCY[level], "risks": risks.astype(np.int8)}
+
+def water_saved(volume, soil_moisture, level):
+    """Water (L) each advisory saves against calendar irrigation.
+
+    A fixed schedule waters as if the soil were dry, i.e. ``volume`` over the
+    row's water stress; the advisory applies ``volume``, or nothing at level
+    3 (no irrigation needed). Rows without a moisture reading save nothing.
+    """
+    v, sm, lvl = _col(volume), _col(soil_moisture), _col(level)
+    calendar = v / np.clip((100 - sm) / 100, 0.05, 1)
+    applied = np.where(lvl == len(URGENCY) - 1, 0.0, v)
+    return np.nan_to_num(np.maximum(calendar - applied, 0))
+
+def risk_labels(mask):
+    return [label for flag, label in RISK_LABELS if int(mask) & flag]
+
+def recommendation_text(level, crop_name, soil_moisture):
+    return REC_TEMPLATES[int(level)].format(crop=crop_name, moisture=soil_moisture)
+
+def irrigation_rows(batch, rows, crop_names, soil_moisture):
+    """Materialize full advisory dicts for the given row positions only.
+
+    Recommendation strings and risk labels are built lazily here, so callers
+    scoring thousands of fields pay for text only on the rows they display.
+    """
+    out = []
+    for i in rows:
+        out.append({"recommendation": recommendation_text(batch["level"][i], crop_names[i], soil_moisture[i]),
+                    "volume": float(batch["volume"][i]), "frequency": int(batch["frequency"][i]),
+                    "urgency": str(batch["urgency"][i]), "level": int(batch["level"][i]),
+                    "risks": risk_labels(batch["risks"][i])})
+    return out
+
+def get_irrigation_rec(soil_moisture, temp, humidity, rainfall, crop_name, area):
+    batch = irrigation_batch([soil_moisture], [temp], [humidity], [rainfall], [area])
+    return irrigation_rows(batch, [0], [crop_name], [soil_moisture])[0]
+
+def irrigation_recs(soil_moisture, temp, humidity, rainfall, crop_names, areas):
+    """``get_irrigation_rec`` for every row, scored as one batch."""
+    batch = irrigation_batch(soil_moisture, temp, humidity, rainfall, areas)
+    return irrigation_rows(batch, range(len(crop_names)), crop_names, soil_moisture)
+
+# ============ YIELD & SURPLUS ============
+BASE_YIELD = {"wheat": 3500, "rice": 4000, "corn": 8000, "maize": 8000, "potato": 25000, "tomato": 50000}
+DEFAULT_BASE_YIELD = 5000
+SOIL_MULTIPLIER = {"loamy": 1.2, "clay": 0.9, "sandy": 0.8, "silty": 1.1}
+YIELD_NOISE = (0.9, 1.1)  # uniform multiplicative season factor
+
+def table_yield(crop_names, areas, soils):
+    """Yield (kg) per row from the lookup table: base yield per hectare x area x soil multiplier."""
+    base = np.array([BASE_YIELD.get(c.lower(), DEFAULT_BASE_YIELD) for c in crop_names], dtype=float)
+    mult = np.array([SOIL_MULTIPLIER.get(s, 1.0) if s else 1.0 for s in soils], dtype=float)
+    return base * _col(areas) * mult
+
+def expected_yield(crop_names, areas, soils, model=None, weather=None):
+    """Noise-free yield (kg) per row from ``model`` (a ``yieldmodel.YieldModel``), or the table where there is none or it does not know the crop."""
+    if model is None:
+        return table_yield(crop_names, areas, soils)
+    y = model.predict(crop_names, areas, soils, weather)
+    unknown = np.flatnonzero(np.isnan(y))
+    if len(unknown):
+        areas = _col(areas)
+        y[unknown] = table_yield([crop_names[i] for i in unknown], areas[unknown], [soils[i] for i in unknown])
+    return y
+
+def predict_yield(crop, area, soil, model=None, weather=None):
+    weather = {k: [v] for k, v in weather.items()} if weather else None
+    return round(float(expected_yield([crop], [area], [soil], model, weather)[0]) * random.uniform(*YIELD_NOISE), 2)
+
+def predict_yields(crop_names, areas, soils, seed=None, model=None, weather=None):
+    """``predict_yield`` for every row, each with its own season factor."""
+    noise = np.random.default_rng(seed).uniform(*YIELD_NOISE, size=len(crop_names))
+    return [round(float(y), 2) for y in expected_yield(crop_names, areas, soils, model, weather) * noise]
+
+SURPLUS_CATEGORIES = np.array(["minimal", "low", "medium", "high"])
+SURPLUS_URGENCY = np.array(["none", "low", "medium", "high"])
+SURPLUS_BANDS = [5, 15, 30]  # surplus % > 30 -> high, > 15 -> medium, > 5 -> low, else minimal
+
+def predict_surplus(yield_kg, demand, storage):
+    return predict_surpluses([yield_kg], [demand], [storage])[0]
+
+def predict_surpluses(yield_kg, demand, storage):
+    """Surplus, its share of the yield, category and recommendations for every row."""
+    y, d, cap = _col(yield_kg), _col(demand), _col(storage)
+    surplus = np.maximum(0, y - d)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = np.where(y > 0, surplus / y * 100, 0.0)
+    band = np.searchsorted(SURPLUS_BANDS, pct, side="left")
+    out = []
+    for s, p, b, over in zip(surplus.tolist(), pct.tolist(), band.tolist(), (surplus > cap).tolist()):
+        recs = []
+        if over: recs.append("⚠️ Surplus exceeds storage - sell immediately")
+        if b == 3: recs.extend(["🏦 Connect with food banks", "🏭 Consider processing"])
+        if b >= 2: recs.append("📦 List on marketplace")
+        out.append({"surplus": round(s, 2), "pct": round(p, 2), "category": str(SURPLUS_CATEGORIES[b]),
+                    "urgency": str(SURPLUS_URGENCY[b]), "recs": recs})
+    return out
+
+def forecast_surplus(crop_names, areas, soils, demand, storage, samples=5000, seed=42, model=None):
+    """Monte Carlo surplus forecast for many crops in one pass.
+
+    ``samples`` season factors are drawn once from a generator seeded with
+    ``seed`` and shared by every row (common random numbers), so a crop's
+    forecast does not depend on which other crops are in the batch. Surplus
+    is monotone in the factor, so each row's percentiles and exceedance
+    probability are read off the sorted draws instead of materializing a
+    rows x samples matrix -- the numbers are identical either way.
+
+    ``demand`` and ``storage`` may be scalars or per-row arrays. Returns
+    arrays ``yield_p50`` and ``p10``/``p50``/``p90`` surplus (kg) plus
+    ``p_exceed``, the probability surplus exceeds storage. ``model`` is as
+    for ``expected_yield``.
+    """
+    mean = expected_yield(crop_names, areas, soils, model)
+    demand = np.broadcast_to(_col(demand), mean.shape)
+    storage = np.broadcast_to(_col(storage), mean.shape)
+    factor = np.sort(np.random.default_rng(seed).uniform(*YIELD_NOISE, size=samples))
+    q10, q50, q90 = np.quantile(factor, [0.1, 0.5, 0.9])
+    surplus_at = lambda q: np.maximum(0, mean * q - demand)
+    # surplus > storage  <=>  factor > (storage + demand) / mean
+    with np.errstate(divide='ignore', invalid='ignore'):
+        threshold = np.where(mean > 0, (storage + demand) / mean, np.inf)
+    p_exceed = (samples - np.searchsorted(factor, threshold, side='right')) / samples
+    return {"yield_p50": mean * q50, "p10": surplus_at(q10), "p50": surplus_at(q50), "p90": surplus_at(q90),
+            "p_exceed": p_exceed}
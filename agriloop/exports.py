@@ -0,0 +1,246 @@
+"""Streaming exports of stored tables to CSV, NDJSON or Parquet.
+
+``stream`` walks a table with the repository's ``chunks`` (key order,
+``CHUNK`` rows per read) and yields the encoded bytes of each chunk as it
+goes, so memory is bounded by one chunk however large the table is, and
+no lock or read transaction is held between chunks. CSV and NDJSON can be
+gzip'd; Parquet is written one row group per chunk with its own codec
+(``snappy`` by default, or ``gzip``/``zstd``) and needs pyarrow.
+
+Exports can be narrowed to one owner, a status and a ``created_at`` range
+(``since`` inclusive, ``until`` exclusive, ISO dates or timestamps).
+Password hashes are never exported. ``export`` writes a file, and
+``ExportJobs`` runs exports on background threads so the page that starts
+one is not held up; from the command line::
+
+    python -m agriloop.exports advisories advisories.csv.gz --owner alice --since 2025-01-01
+"""
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from agriloop.storage import SCHEMA, columns_of
+
+TABLES = ('users', 'farms', 'crops', 'advisories', 'surplus_listings', 'waste_requests')
+OWNER_COLUMN = {'users': 'username', 'farms': 'owner', 'crops': 'owner', 'advisories': 'user',
+                'surplus_listings': 'user', 'waste_requests': 'user'}
+EXCLUDED = {'users': {'password'}}
+FORMATS = ('csv', 'ndjson', 'parquet')
+COMPRESSIONS = {'csv': (None, 'gzip'), 'ndjson': (None, 'gzip'), 'parquet': (None, 'snappy', 'gzip', 'zstd')}
+SUFFIX = {'csv': '.csv', 'ndjson': '.ndjson', 'parquet': '.parquet'}
+CONTENT_TYPE = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson', 'parquet': 'application/vnd.apache.parquet'}
+CHUNK = 5_000
+
+def export_columns(table):
+    return [c for c in columns_of(table) if c not in EXCLUDED.get(table, ())]
+
+def check(table, fmt='csv', compression=None, owner=None, status=None):
+    """Repository filters for an export; ValueError for a table, format or filter that does not apply."""
+    if table not in TABLES:
+        raise ValueError(f"cannot export {table!r}; choose from {', '.join(TABLES)}")
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}; choose from {', '.join(FORMATS)}")
+    if compression not in COMPRESSIONS[fmt]:
+        raise ValueError(f"{fmt} exports support compression {', '.join(str(c) for c in COMPRESSIONS[fmt])}")
+    filters = {}
+    if owner:
+        filters[OWNER_COLUMN[table]] = owner
+    if status:
+        if 'status' not in columns_of(table):
+            raise ValueError(f"{table} has no status")
+        filters['status'] = status
+    return filters
+
+def filename(stem, fmt, compression=None):
+    return f"{stem}{SUFFIX[fmt]}" + (".gz" if compression == 'gzip' and fmt != 'parquet' else "")
+
+class _Sink(io.RawIOBase):
+    """Write-only byte buffer drained after every chunk; ``tell`` counts every byte ever written."""
+
+    def __init__(self):
+        self._parts, self._pos = [], 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._parts.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+# ============ ENCODERS ============
+class _TextEncoder:
+    def __init__(self, sink, columns, compression):
+        self.columns = columns
+        self.out = gzip.GzipFile(fileobj=sink, mode='wb') if compression == 'gzip' else sink
+
+    def header(self):
+        pass
+
+    def write(self, rows):
+        buf = io.StringIO()
+        self.encode(buf, rows)
+        self.out.write(buf.getvalue().encode())
+
+    def close(self):
+        if isinstance(self.out, gzip.GzipFile):
+            self.out.close()
+
+class _CsvEncoder(_TextEncoder):
+    def header(self):
+        buf = io.StringIO()
+        csv.writer(buf).writerow(self.columns)
+        self.out.write(buf.getvalue().encode())
+
+    def encode(self, buf, rows):
+        csv.writer(buf).writerows([r[c] for c in self.columns] for r in rows)
+
+class _NdjsonEncoder(_TextEncoder):
+    def encode(self, buf, rows):
+        for r in rows:
+            buf.write(json.dumps({c: r[c] for c in self.columns}, default=str))
+            buf.write("\n")
+
+class _ParquetEncoder:
+    TYPES = {'INTEGER': 'int64', 'REAL': 'float64', 'NUMERIC': 'float64', 'TEXT': 'string'}
+
+    def __init__(self, sink, columns, compression, table):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Parquet export needs pyarrow: pip install pyarrow") from e
+        types = dict(SCHEMA[table][1])
+        self.pa, self.columns = pa, columns
+        self.schema = pa.schema([(c, getattr(pa, self.TYPES[types[c]])()) for c in columns])
+        self.writer = pq.ParquetWriter(sink, self.schema, compression=compression or 'snappy')
+
+    def header(self):
+        pass
+
+    def write(self, rows):
+        arrays = [self.pa.array([r[c] for r in rows], type=f.type) for c, f in zip(self.columns, self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def _encoder(fmt, sink, columns, compression, table):
+    if fmt == 'parquet':
+        return _ParquetEncoder(sink, columns, compression, table)
+    return (_CsvEncoder if fmt == 'csv' else _NdjsonEncoder)(sink, columns, compression)
+
+# ============ EXPORT ============
+def stream(repo, table, fmt='csv', compression=None, owner=None, status=None, since=None, until=None,
+           chunk=CHUNK, on_progress=None):
+    """Yield the encoded export of ``table`` piece by piece; ``on_progress(rows)`` after each chunk."""
+    filters = check(table, fmt, compression, owner, status)
+    sink = _Sink()
+    encoder = _encoder(fmt, sink, export_columns(table), compression, table)
+    done = 0
+    encoder.header()
+    for rows in repo.chunks(table, chunk, since=since, until=until, **filters):
+        encoder.write(rows)
+        done += len(rows)
+        if on_progress:
+            on_progress(done)
+        data = sink.drain()
+        if data:
+            yield data
+    encoder.close()
+    yield sink.drain()
+
+def export(repo, table, path, fmt=None, compression=None, on_progress=None, **options):
+    """Write an export to ``path`` (format from the suffix when ``fmt`` is None); returns the row count.
+
+    The file appears under its final name only once complete.
+    """
+    fmt = fmt or next((f for f, s in SUFFIX.items() if s in os.path.basename(path)), 'csv')
+    if compression is None and path.endswith(".gz") and fmt != 'parquet':
+        compression = 'gzip'
+    count = [0]
+    def progress(n):
+        count[0] = n
+        if on_progress:
+            on_progress(n)
+    tmp = f"{path}.part"
+    try:
+        with open(tmp, 'wb') as f:
+            for data in stream(repo, table, fmt, compression, on_progress=progress, **options):
+                f.write(data)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return count[0]
+
+class ExportJobs:
+    """Exports written to ``directory`` on a small thread pool; ``jobs`` reports their progress."""
+
+    def __init__(self, directory, workers=2):
+        self.directory = directory
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="export")
+
+    def submit(self, repo, table, fmt='csv', compression=None, requested_by=None, **options):
+        check(table, fmt, compression, options.get('owner'), options.get('status'))
+        with self._lock:
+            n = len(self._jobs) + 1
+            stem = f"{table}-{time.strftime('%Y%m%d-%H%M%S')}-{n}"
+            job = {'id': n, 'table': table, 'format': fmt, 'requested_by': requested_by, 'rows': 0, 'status': 'running',
+                   'error': None, 'started': time.time(), 'finished': None,
+                   'path': os.path.join(self.directory, filename(stem, fmt, compression))}
+            self._jobs.append(job)
+        self._pool.submit(self._run, job, repo, table, fmt, compression, options)
+        return job['id']
+
+    def _run(self, job, repo, table, fmt, compression, options):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            export(repo, table, job['path'], fmt, compression, on_progress=lambda n: job.update(rows=n), **options)
+            job.update(status='done')
+        except Exception as e:
+            job.update(status='failed', error=str(e))
+        job['finished'] = time.time()
+
+    def jobs(self):
+        """Snapshots of every job, newest first."""
+        with self._lock:
+            return [dict(j) for j in reversed(self._jobs)]
+
+def main(argv=None):
+    from agriloop.storage import open_repository
+    ap = argparse.ArgumentParser(description="Export a table to CSV, NDJSON or Parquet.")
+    ap.add_argument("table", choices=TABLES)
+    ap.add_argument("path", help="output file; the format follows the suffix (.csv, .ndjson, .parquet, optionally .gz)")
+    ap.add_argument("--format", choices=FORMATS)
+    ap.add_argument("--compression", help="gzip for CSV/NDJSON; snappy, gzip or zstd for Parquet")
+    ap.add_argument("--owner")
+    ap.add_argument("--status")
+    ap.add_argument("--since", help="created_at >= this ISO date/time")
+    ap.add_argument("--until", help="created_at < this ISO date/time")
+    ap.add_argument("--db", default=None, help="SQLite path (defaults to $AGRILOOP_DB / agriloop.db)")
+    ap.add_argument("--chunk", type=int, default=CHUNK)
+    args = ap.parse_args(argv)
+    progress = lambda n: print(f"\r{n:,} rows", end="", flush=True)
+    n = export(open_repository(args.db), args.table, args.path, args.format, args.compression, on_progress=progress,
+               owner=args.owner, status=args.status, since=args.since, until=args.until, chunk=args.chunk)
+    print(f"\r{n:,} rows written to {args.path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,465 @@
+"""Sustainability impact rollups.
+
+Impact is derived from three tables:
+
+* advisories -- water saved against calendar irrigation (``engine.water_saved``),
+* waste requests once matched or completed -- kg diverted, per ``WASTE_TYPES``,
+* surplus listings once sold -- kg of food rescued,
+
+plus the emissions each avoids (``EMISSION_FACTORS``, kg CO2e per unit).
+
+``ImpactRollups`` keeps day, week (Monday) and month buckets of every
+metric per user, farm, region (a ``REGION_DEG`` lat/lng cell) and for the
+whole platform, so charts read a few hundred buckets instead of the rows
+behind them. A bucket is one int64 key -- entity, grain, period, metric --
+and its total; they live in sorted numpy arrays plus a tail of deltas that
+is merged once it outgrows a fraction of them. What each counted row added
+is remembered by id, so an update or delete takes out exactly that.
+
+The rollups follow their tables through ``subscribe`` like the marketplace
+index: writes are queued and applied at the next query, and a gap in a
+table version -- writes this process did not see -- reloads them. Farms
+and crops are watched only for moves (a farm's location, a crop's farm),
+which also reload. Rollups cover the rows in the store, so archived
+advisories drop out of them.
+"""
+import threading
+import weakref
+from collections import deque
+
+import numpy as np
+
+from agriloop.engine import water_saved
+from agriloop.matching import WASTE_PARTNER_TYPES
+
+WASTE_TYPES = tuple(sorted(WASTE_PARTNER_TYPES))
+METRICS = ('water_saved_l', 'food_rescued_kg') + tuple(f"{t}_kg" for t in WASTE_TYPES)
+REPORTED = METRICS + ('waste_diverted_kg', 'co2e_water_kg', 'co2e_waste_kg', 'co2e_food_kg', 'co2e_avoided_kg')
+# kg CO2e avoided per unit: pumping energy per litre, food production per kg
+# rescued, and landfill methane or open burning per kg diverted. Indicative
+# defaults; replace with local factors where known.
+EMISSION_FACTORS = {'water_saved_l': 0.0003, 'food_rescued_kg': 2.5, 'crop_residue_kg': 1.2, 'food_waste_kg': 0.6,
+                    'organic_waste_kg': 0.5, 'spoiled_produce_kg': 0.5, 'surplus_produce_kg': 2.5}
+GRAINS = ('day', 'week', 'month')
+DIMENSIONS = ('user', 'farm', 'region', 'all')
+REGION_DEG = 1.0
+COUNTED_WASTE = ('matched', 'completed')
+MAX_PENDING = 200_000  # rows queued without a query before the rollups give up and reload
+LOAD_CHUNK = 100_000
+
+SOURCES = {
+    'advisories': ('id', 'user', 'crop_id', 'level', 'soil_moisture', 'volume', 'created_at'),
+    'waste_requests': ('id', 'user', 'waste_type', 'quantity_kg', 'location_latitude', 'location_longitude',
+                       'status', 'created_at', 'matched_at'),
+    'surplus_listings': ('id', 'user', 'crop_id', 'quantity', 'status', 'created_at'),
+}
+_MOVES = {'farms': {'location_latitude', 'location_longitude'}, 'crops': {'farm_id'}}
+_FACTORS = np.array([EMISSION_FACTORS.get(m, 0.0) for m in METRICS])
+_WASTE_METRIC = {t: METRICS.index(f"{t}_kg") for t in WASTE_TYPES}
+_UNKNOWN, _NONE = -2, -1  # crop -> farm and farm -> region lookups
+
+# key = entity | grain (2 bits) | period (16 bits: days, weeks as their Monday, months since 1970) | metric (4 bits)
+_METRIC_BITS, _PERIOD_BITS, _GRAIN_BITS = 4, 16, 2
+_ENTITY_SHIFT = _METRIC_BITS + _PERIOD_BITS + _GRAIN_BITS
+
+def _key(entity, grain, period, metric):
+    return (((np.asarray(entity, dtype=np.int64) << _GRAIN_BITS) + grain << _PERIOD_BITS) + period << _METRIC_BITS) + metric
+
+def _day_numbers(values):
+    """ISO dates/timestamps as int64 days since 1970, -1 where missing, unparseable or out of range."""
+    try:
+        d = np.array(values, dtype='datetime64[s]').astype('datetime64[D]')
+    except ValueError:
+        d = np.array([_day_or_nat(str(v)[:10]) if v else np.datetime64('NaT', 'D') for v in values], dtype='datetime64[D]')
+    days = d.astype(np.int64)
+    return np.where(np.isnat(d) | (days < 0) | (days >= 1 << _PERIOD_BITS), -1, days)
+
+def _day_or_nat(text):
+    try:
+        return np.datetime64(text, 'D')
+    except ValueError:
+        return np.datetime64('NaT', 'D')
+
+def _periods(days):
+    """``{grain: period numbers}`` for int64 day numbers."""
+    return {'day': days, 'week': days - (days + 3) % 7,  # 1970-01-01 was a Thursday
+            'month': days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)}
+
+def _period_label(grain, period):
+    return str(np.datetime64(int(period), 'M' if grain == 'month' else 'D'))
+
+def _period_of(grain, day):
+    return int(_periods(np.array([_day_numbers([day])[0]]))[grain][0])
+
+def _float(values):
+    return np.array([np.nan if v is None or v == '' else v for v in values], dtype=float)
+
+def region_of(lat, lng):
+    """Label of the ``REGION_DEG`` cell holding ``(lat, lng)``, e.g. ``28°N 77°E``; None without a location."""
+    if lat is None or lng is None:
+        return None
+    return _region_labels(np.array([lat], dtype=float), np.array([lng], dtype=float))[0]
+
+def _region_labels(lat, lng):
+    ok = ~(np.isnan(lat) | np.isnan(lng))
+    cells = np.floor(np.c_[np.nan_to_num(lat), np.nan_to_num(lng)] / REGION_DEG) * REGION_DEG
+    cells, row = np.unique(cells, axis=0, return_inverse=True)
+    labels = [f"{abs(s):g}°{'N' if s >= 0 else 'S'} {abs(w):g}°{'E' if w >= 0 else 'W'}" for s, w in cells.tolist()]
+    return [labels[i] if k else None for i, k in zip(row.ravel().tolist(), ok.tolist())]
+
+class _Names:
+    """Dense integer codes for string entities (users, regions)."""
+
+    def __init__(self):
+        self.names, self._code = [], {}
+
+    def code(self, name, add=True):
+        code = self._code.get(name)
+        if code is None and add:
+            code = self._code[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def codes(self, values):
+        memo = {}
+        return np.fromiter((_NONE if v is None else memo[v] if v in memo else memo.setdefault(v, self.code(v))
+                            for v in values), dtype=np.int64, count=len(values))
+
+class _Buckets:
+    """Additive totals by int64 key: sorted base arrays plus an unsorted tail of deltas, merged as it grows."""
+
+    def __init__(self):
+        self.keys, self.totals = np.zeros(0, np.int64), np.zeros(0)
+        self._tail, self._tail_n = [], 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, keys, values):
+        if len(keys):
+            self._tail.append((keys, values))
+            self._tail_n += len(keys)
+            if self._tail_n > max(4096, len(self.keys) // 8):
+                self.merge()
+
+    def merge(self):
+        if not self._tail:
+            return
+        keys = np.concatenate([self.keys] + [k for k, _ in self._tail])
+        totals = np.concatenate([self.totals] + [v for _, v in self._tail])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.totals = np.bincount(inverse, totals, len(self.keys))
+        keep = np.abs(self.totals) > 1e-6  # buckets emptied by deletes
+        self.keys, self.totals = self.keys[keep], self.totals[keep]
+        self._tail, self._tail_n = [], 0
+
+    def range(self, lo, hi):
+        """Sorted keys in ``[lo, hi)`` with their totals."""
+        i, j = np.searchsorted(self.keys, [lo, hi])
+        keys, totals = self.keys[i:j], self.totals[i:j]
+        if self._tail:
+            tk = np.concatenate([k for k, _ in self._tail])
+            tv = np.concatenate([v for _, v in self._tail])
+            hit = (tk >= lo) & (tk < hi)
+            keys, inverse = np.unique(np.r_[keys, tk[hit]], return_inverse=True)
+            totals = np.bincount(inverse, np.r_[totals, tv[hit]], len(keys))
+            keep = np.abs(totals) > 1e-6
+            keys, totals = keys[keep], totals[keep]
+        return keys, totals
+
+class _Contributions:
+    """What each counted row of one table added, by row id."""
+    FIELDS = {'day': np.int64, 'user': np.int64, 'farm': np.int64, 'region': np.int64, 'metric': np.int8, 'amount': float}
+
+    def __init__(self):
+        self.a = {f: np.full(0, -1, dtype=t) for f, t in self.FIELDS.items()}
+
+    def _grow(self, top):
+        cap = len(self.a['day'])
+        if top >= cap:
+            cap = max(top + 1, cap * 2, 1024)
+            for f, arr in self.a.items():
+                grown = np.full(cap, -1, dtype=arr.dtype)
+                grown[:len(arr)] = arr
+                self.a[f] = grown
+
+    def take(self, ids):
+        """Remove and return the contributions of ``ids`` that were counted."""
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[(ids >= 0) & (ids < len(self.a['day']))]
+        ids = ids[self.a['day'][ids] >= 0]
+        out = {f: arr[ids] for f, arr in self.a.items()}
+        self.a['day'][ids] = -1
+        return out
+
+    def put(self, ids, fields):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids):
+            self._grow(int(ids.max()))
+            for f, arr in self.a.items():
+                arr[ids] = fields[f]
+
+class ImpactRollups:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pending = deque()
+        self._pending_rows = 0
+        self._listening = False
+        self._stale = False
+        self.versions = None  # source table versions the buckets reflect; None until first loaded
+        self._reset()
+
+    def _reset(self):
+        self._names = {'user': _Names(), 'region': _Names()}
+        self._buckets = {d: _Buckets() for d in DIMENSIONS}
+        self._rows = {t: _Contributions() for t in SOURCES}
+        self._farm_of = np.zeros(0, np.int64)     # crop id -> farm id
+        self._region_of = np.zeros(0, np.int64)   # farm id -> region code
+
+    def __len__(self):
+        """Buckets held, over every dimension and grain."""
+        return sum(len(b) + b._tail_n for b in self._buckets.values())
+
+    # ---------- maintenance ----------
+    def listener(self, table):
+        """Repository listener for ``table``: queue the write for the next query."""
+        def on_write(op, items, version):
+            if not self._listening:
+                return
+            if table in _MOVES:
+                if op == 'update' and any(_MOVES[table] & changes.keys() for _, changes in items):
+                    self._stale = True
+                return
+            self._pending_rows += len(items)
+            if self._pending_rows > MAX_PENDING:
+                self._pending.clear()
+                self._stale = True
+            else:
+                self._pending.append((table, op, items, version))
+        return on_write
+
+    def _load(self, repo):
+        self._listening = True
+        self._pending.clear()
+        self._pending_rows = 0
+        self._stale = False
+        versions = {t: repo.version(t) for t in SOURCES}
+        self._reset()
+        crops = repo.scan('crops', ('id', 'farm_id'))
+        if crops:
+            ids, farms = (np.array(c, dtype=float) for c in zip(*crops))
+            self._farm_of = np.full(int(ids.max()) + 1, _NONE, np.int64)
+            self._farm_of[ids.astype(np.int64)] = np.nan_to_num(farms, nan=_NONE).astype(np.int64)
+        farms = repo.scan('farms', ('id', 'location_latitude', 'location_longitude'))
+        if farms:
+            ids, lat, lng = zip(*farms)
+            self._region_of = np.full(max(ids) + 1, _NONE, np.int64)
+            self._region_of[list(ids)] = self._names['region'].codes(_region_labels(_float(lat), _float(lng)))
+        for table, columns in SOURCES.items():
+            rows = repo.scan(table, columns)
+            for lo in range(0, len(rows), LOAD_CHUNK):
+                self._count(repo, table, rows[lo:lo + LOAD_CHUNK])
+            del rows
+        for b in self._buckets.values():
+            b.merge()
+        self.versions = versions
+
+    def _lookup(self, repo, table, ids, known):
+        """``known[ids]`` with _UNKNOWN entries (rows written since the load) read from the repository."""
+        ids = np.asarray(ids, dtype=np.int64)
+        ok = ids >= 0
+        inside = ok & (ids < len(known))
+        missing = np.unique(np.r_[ids[ok & ~inside], ids[inside][known[ids[inside]] == _UNKNOWN]])
+        if len(missing) and missing.max() >= len(known):
+            grow = max(int(missing.max()) + 1 - len(known), len(known))
+            known = np.r_[known, np.full(grow, _UNKNOWN, np.int64)]
+        for i in missing.tolist():
+            row = repo.get(table, i)
+            if table == 'crops':
+                known[i] = row['farm_id'] if row and row['farm_id'] is not None else _NONE
+            else:
+                label = region_of(row['location_latitude'], row['location_longitude']) if row else None
+                known[i] = _NONE if label is None else self._names['region'].code(label)
+        out = np.full(len(ids), _NONE, np.int64)
+        out[ok] = known[ids[ok]]
+        return out, known
+
+    def _place(self, repo, crop_ids):
+        """Farm id and region code of each crop id, _NONE where unknown."""
+        crops = np.array([_NONE if c is None else c for c in crop_ids], dtype=np.int64)
+        farm, self._farm_of = self._lookup(repo, 'crops', crops, self._farm_of)
+        region, self._region_of = self._lookup(repo, 'farms', farm, self._region_of)
+        return farm, region
+
+    def _count(self, repo, table, rows):
+        """Add rows (tuples in ``SOURCES[table]`` order) to the rollups, replacing what they added before."""
+        if not rows:
+            return
+        cols = dict(zip(SOURCES[table], zip(*rows)))
+        ids = np.array(cols['id'], dtype=np.int64)
+        self._post(self._rows[table].take(ids), -1)
+        n = len(ids)
+        if table == 'advisories':
+            amount = water_saved(_float(cols['volume']), _float(cols['soil_moisture']), _float(cols['level']))
+            metric = np.zeros(n, np.int8)
+            farm, region = self._place(repo, cols['crop_id'])
+            day = _day_numbers(cols['created_at'])
+        elif table == 'surplus_listings':
+            amount = np.where([s == 'sold' for s in cols['status']], _float(cols['quantity']), 0.0)
+            metric = np.full(n, METRICS.index('food_rescued_kg'), np.int8)
+            farm, region = self._place(repo, cols['crop_id'])
+            day = _day_numbers(cols['created_at'])
+        else:
+            metric = np.array([_WASTE_METRIC.get(t, -1) for t in cols['waste_type']], dtype=np.int8)
+            counted = np.array([s in COUNTED_WASTE for s in cols['status']], dtype=bool) & (metric >= 0)
+            amount = np.where(counted, _float(cols['quantity_kg']), 0.0)
+            farm = np.full(n, _NONE, np.int64)
+            labels = _region_labels(_float(cols['location_latitude']), _float(cols['location_longitude']))
+            region = self._names['region'].codes(labels)
+            day = _day_numbers([m or c for m, c in zip(cols['matched_at'], cols['created_at'])])
+        keep = (np.nan_to_num(amount) > 0) & (day >= 0)
+        fields = {'day': day[keep], 'user': self._names['user'].codes([u for u, k in zip(cols['user'], keep) if k]),
+                  'farm': farm[keep], 'region': region[keep], 'metric': metric[keep], 'amount': amount[keep]}
+        self._rows[table].put(ids[keep], fields)
+        self._post(fields, 1)
+
+    def _post(self, c, sign):
+        """Add (``sign`` 1) or take out (-1) contributions in every bucket they fall in."""
+        if not len(c['day']):
+            return
+        periods = _periods(c['day'])
+        metric, amount = c['metric'].astype(np.int64), sign * c['amount']
+        for dim in DIMENSIONS:
+            entity = np.zeros(len(metric), np.int64) if dim == 'all' else c[dim]
+            ok = entity >= 0
+            if not ok.any():
+                continue
+            keys = [_key(entity[ok], g, periods[grain][ok], metric[ok]) for g, grain in enumerate(GRAINS)]
+            self._buckets[dim].add(np.concatenate(keys), np.tile(amount[ok], len(GRAINS)))
+
+    def _drain(self, repo):
+        """Apply queued writes in version order; False if one is missing."""
+        events = []
+        while self._pending:
+            events.append(self._pending.popleft())
+        self._pending_rows = 0
+        for table, op, items, version in sorted(events, key=lambda e: (e[0], e[3])):
+            if version <= self.versions[table]:
+                continue
+            if version != self.versions[table] + 1:
+                return False
+            if op == 'insert':
+                self._count(repo, table, [tuple(r.get(c) for c in SOURCES[table]) for r in items])
+            elif op == 'update':
+                watched = set(SOURCES[table])
+                keys = [k for k, changes in items if watched & changes.keys()]
+                rows = [repo.get(table, k) for k in keys]
+                self._post(self._rows[table].take([k for k, r in zip(keys, rows) if r is None]), -1)
+                self._count(repo, table, [tuple(r[c] for c in SOURCES[table]) for r in rows if r is not None])
+            else:
+                self._post(self._rows[table].take(list(items)), -1)
+            self.versions[table] = version
+        return True
+
+    def sync(self, repo):
+        """Bring the rollups up to date with ``repo``, patching them when possible and reloading otherwise."""
+        with self._lock:
+            if (self.versions is None or self._stale or not self._drain(repo)
+                    or any(self.versions[t] != repo.version(t) for t in SOURCES)):
+                self._load(repo)
+                self._drain(repo)
+
+    # ---------- queries ----------
+    def _entity(self, dimension, entity):
+        if dimension not in DIMENSIONS:
+            raise ValueError(f"unknown dimension {dimension!r}; choose from {', '.join(DIMENSIONS)}")
+        if dimension == 'all':
+            return 0
+        if dimension == 'farm':
+            return None if entity is None else int(entity)
+        return self._names[dimension].code(entity, add=False)
+
+    def _range(self, grain, since, until):
+        g = GRAINS.index(grain)
+        lo = _period_of(grain, since) if since else 0
+        hi = _period_of(grain, until) + 1 if until else 1 << _PERIOD_BITS
+        return g, lo, hi
+
+    def series(self, repo, dimension, entity=None, grain='month', since=None, until=None):
+        """One entity's buckets, oldest first: ``{'period': [ISO starts], metric: array, ...}`` over ``REPORTED``.
+
+        ``since``/``until`` (ISO dates, inclusive) keep the buckets holding those days and any between.
+        """
+        with self._lock:
+            self.sync(repo)
+            code = self._entity(dimension, entity)
+            g, lo, hi = self._range(grain, since, until)
+            if code is None:
+                keys, totals = np.zeros(0, np.int64), np.zeros(0)
+            else:
+                keys, totals = self._buckets[dimension].range(_key(code, g, lo, 0), _key(code, g, hi, 0))
+        period = keys >> _METRIC_BITS & ((1 << _PERIOD_BITS) - 1)
+        periods, row = np.unique(period, return_inverse=True)
+        table = np.zeros((len(periods), len(METRICS)))
+        np.add.at(table, (row, keys & ((1 << _METRIC_BITS) - 1)), totals)
+        return {'period': [_period_label(grain, p) for p in periods.tolist()], **_report(table)}
+
+    def totals(self, repo, dimension, entity=None, since=None, until=None):
+        """``{metric: total}`` over ``REPORTED`` for one entity, from its month buckets (day buckets with a range)."""
+        s = self.series(repo, dimension, entity, 'day' if since or until else 'month', since, until)
+        return {m: float(s[m].sum()) for m in REPORTED}
+
+    def ranking(self, repo, dimension, metric='co2e_avoided_kg', grain='month', since=None, until=None,
+                entities=None, limit=10):
+        """The ``limit`` entities of ``dimension`` with the largest ``metric``: ``[(entity, {metric: total}), ...]``.
+
+        ``entities`` restricts the ranking to those entities (e.g. one user's farms).
+        """
+        if metric not in REPORTED:
+            raise ValueError(f"unknown metric {metric!r}")
+        with self._lock:
+            self.sync(repo)
+            g, lo, hi = self._range(grain, since, until)
+            b = self._buckets[dimension]
+            b.merge()
+            keys, totals = b.keys, b.totals
+            period = keys >> _METRIC_BITS & ((1 << _PERIOD_BITS) - 1)
+            hit = ((keys >> (_METRIC_BITS + _PERIOD_BITS) & 3) == g) & (period >= lo) & (period < hi)
+            entity = keys[hit] >> _ENTITY_SHIFT
+            if entities is not None:
+                codes = [c for c in (self._entity(dimension, e) for e in entities) if c is not None]
+                inside = np.isin(entity, codes)
+                hit[hit] = inside
+                entity = entity[inside]
+            names, row = np.unique(entity, return_inverse=True)
+            table = np.zeros((len(names), len(METRICS)))
+            np.add.at(table, (row, keys[hit] & ((1 << _METRIC_BITS) - 1)), totals[hit])
+            report = _report(table)
+            top = np.argsort(-report[metric], kind='stable')[:limit]
+            label = (lambda c: int(c)) if dimension in ('farm', 'all') else (lambda c: self._names[dimension].names[c])
+            return [(label(names[i]), {m: float(report[m][i]) for m in REPORTED}) for i in top.tolist()]
+
+def _report(table):
+    """Metric columns of a ``(rows, METRICS)`` table plus the derived totals."""
+    out = {m: table[:, i] for i, m in enumerate(METRICS)}
+    waste = [_WASTE_METRIC[t] for t in WASTE_TYPES]
+    out['waste_diverted_kg'] = table[:, waste].sum(axis=1)
+    co2e = table * _FACTORS
+    out['co2e_water_kg'], out['co2e_food_kg'] = co2e[:, 0], co2e[:, 1]
+    out['co2e_waste_kg'] = co2e[:, waste].sum(axis=1)
+    out['co2e_avoided_kg'] = co2e.sum(axis=1)
+    return out
+
+# ============ PER-REPOSITORY ROLLUPS ============
+_rollups = weakref.WeakKeyDictionary()
+_rollups_lock = threading.Lock()
+
+def rollups_for(repo):
+    """The process-wide impact rollups following ``repo``; subscribed on first use, loaded on first query."""
+    with _rollups_lock:
+        rollups = _rollups.get(repo)
+        if rollups is None:
+            rollups = _rollups[repo] = ImpactRollups()
+            for table in (*SOURCES, *_MOVES):
+                repo.subscribe(table, rollups.listener(table))
+        return rollups
@@ -0,0 +1,148 @@
+"""Streaming bulk import of farms and crops from CSV or Parquet.
+
+Files are read in fixed-size chunks, each chunk is validated with vectorized
+pandas checks and its valid rows are inserted as one batch, so memory stays
+bounded by the chunk size rather than the file size. Rejected rows are
+reported with their 1-based data row number and reason; only the first
+``max_errors`` are kept, but all are counted.
+
+Large files can be imported from the command line::
+
+    python -m agriloop.importer farms fields.parquet --owner alice
+"""
+import argparse
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+SOIL_TYPES = ("clay", "sandy", "loamy", "silty", "peaty", "chalky")
+CROP_STATUSES = ("active", "harvested", "failed")
+
+REQUIRED = {
+    'farms': ['name', 'area_hectares', 'location_latitude', 'location_longitude'],
+    'crops': ['farm_id', 'crop_name', 'area_hectares'],
+}
+
+def iter_chunks(source, filename, chunksize=50_000):
+    """Yield DataFrames of at most ``chunksize`` rows from a CSV or Parquet path / file object."""
+    if str(filename).lower().endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Parquet import needs pyarrow: pip install pyarrow") from e
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(source, chunksize=chunksize, skipinitialspace=True)
+
+def _text(df, col):
+    return df[col].astype("string").str.strip() if col in df else pd.Series(pd.NA, index=df.index, dtype="string")
+
+def _number(df, col):
+    return pd.to_numeric(df[col], errors="coerce") if col in df else pd.Series(np.nan, index=df.index)
+
+def _date(df, col):
+    return pd.to_datetime(df[col], errors="coerce").dt.date.astype("string") if col in df else pd.Series(pd.NA, index=df.index, dtype="string")
+
+def validate_farms(df, owner, context=None):
+    """Return ``(rows, errors)``: repository-ready dicts and a Series of error text per rejected index."""
+    name, soil = _text(df, 'name'), _text(df, 'soil_type').str.lower()
+    area, lat, lng = _number(df, 'area_hectares'), _number(df, 'location_latitude'), _number(df, 'location_longitude')
+    checks = [
+        (name.isna() | (name == ""), "missing name"),
+        (~(area > 0), "area_hectares must be > 0"),
+        (~lat.between(-90, 90), "invalid latitude"),
+        (~lng.between(-180, 180), "invalid longitude"),
+        (soil.notna() & (soil != "") & ~soil.isin(SOIL_TYPES), "unknown soil_type"),
+    ]
+    errors = _collect(df.index, checks)
+    ok = ~df.index.isin(errors.index)
+    now = datetime.now().isoformat()
+    rows = pd.DataFrame({'name': name[ok], 'area_hectares': area[ok], 'location_latitude': lat[ok],
+                         'location_longitude': lng[ok], 'location_address': _text(df, 'location_address')[ok],
+                         'soil_type': soil[ok].replace("", pd.NA), 'owner': owner, 'created_at': now})
+    return _records(rows), errors
+
+def validate_crops(df, owner, context):
+    """Like ``validate_farms``; ``context['farm_ids']`` is the set of farm ids the owner may add crops to."""
+    farm_id, area = _number(df, 'farm_id'), _number(df, 'area_hectares')
+    crop, status = _text(df, 'crop_name'), _text(df, 'status').str.lower().fillna("active")
+    planted, harvest = _date(df, 'planting_date'), _date(df, 'expected_harvest_date')
+    checks = [
+        (~farm_id.isin(list(context['farm_ids'])), "unknown farm_id"),
+        (crop.isna() | (crop == ""), "missing crop_name"),
+        (~(area > 0), "area_hectares must be > 0"),
+        (~status.isin(CROP_STATUSES), "unknown status"),
+        (_text(df, 'planting_date').notna() & planted.isna(), "invalid planting_date"),
+        (_text(df, 'expected_harvest_date').notna() & harvest.isna(), "invalid expected_harvest_date"),
+    ]
+    errors = _collect(df.index, checks)
+    ok = ~df.index.isin(errors.index)
+    now = datetime.now().isoformat()
+    rows = pd.DataFrame({'farm_id': farm_id[ok].astype("Int64"), 'crop_name': crop[ok], 'area_hectares': area[ok],
+                         'planting_date': planted[ok], 'expected_harvest_date': harvest[ok], 'status': status[ok],
+                         'owner': owner, 'created_at': now})
+    return _records(rows), errors
+
+def _collect(index, checks):
+    """Join the messages of every failed check per row into one Series (only failing rows)."""
+    msgs = pd.Series("", index=index, dtype="string")
+    for failed, msg in checks:
+        failed = failed.fillna(True).astype(bool)
+        msgs[failed] = msgs[failed] + ("; " + msg)
+    msgs = msgs[msgs != ""]
+    return msgs.str.slice(2)
+
+def _records(df):
+    # NaN / <NA> -> None and numpy scalars -> Python scalars, ready for either backend
+    return [{k: (None if pd.isna(v) else (v.item() if hasattr(v, 'item') else v)) for k, v in r.items()}
+            for r in df.astype(object).to_dict('records')]
+
+VALIDATORS = {'farms': validate_farms, 'crops': validate_crops}
+
+def bulk_import(repo, kind, source, filename, owner, chunksize=50_000, max_errors=10_000, on_progress=None):
+    """Stream ``source`` into ``repo``'s ``kind`` table ('farms' or 'crops') on behalf of ``owner``.
+
+    Returns a dict with ``inserted``, ``rejected`` and ``errors`` (a DataFrame
+    of ``row``/``error`` for at most ``max_errors`` rejected rows).
+    """
+    validate = VALIDATORS[kind]
+    context = {'farm_ids': {f['id'] for f in repo.find('farms', owner=owner)}} if kind == 'crops' else None
+    inserted = rejected = seen = 0
+    kept = []
+    for chunk in iter_chunks(source, filename, chunksize):
+        missing = [c for c in REQUIRED[kind] if c not in chunk.columns]
+        if missing:
+            raise ValueError(f"missing required column(s): {', '.join(missing)}")
+        chunk.index = pd.RangeIndex(seen + 1, seen + 1 + len(chunk))
+        seen += len(chunk)
+        rows, errors = validate(chunk, owner, context)
+        if rows:
+            repo.insert_many(kind, rows)
+            inserted += len(rows)
+        rejected += len(errors)
+        if len(kept) < max_errors:
+            kept += list(zip(errors.index, errors))[:max_errors - len(kept)]
+        if on_progress:
+            on_progress(seen, inserted, rejected)
+    return {'inserted': inserted, 'rejected': rejected, 'errors': pd.DataFrame(kept, columns=['row', 'error'])}
+
+def main(argv=None):
+    from agriloop.storage import open_repository
+    ap = argparse.ArgumentParser(description="Bulk import farms or crops from CSV/Parquet.")
+    ap.add_argument("kind", choices=sorted(VALIDATORS))
+    ap.add_argument("path")
+    ap.add_argument("--owner", required=True, help="username that will own the imported rows")
+    ap.add_argument("--db", default=None, help="SQLite path (defaults to $AGRILOOP_DB / agriloop.db)")
+    ap.add_argument("--chunksize", type=int, default=50_000)
+    args = ap.parse_args(argv)
+    progress = lambda seen, ins, rej: print(f"\r{seen:,} rows read, {ins:,} inserted, {rej:,} rejected", end="", flush=True)
+    result = bulk_import(open_repository(args.db), args.kind, args.path, args.path, args.owner,
+                         chunksize=args.chunksize, on_progress=progress)
+    print()
+    if len(result['errors']):
+        print(result['errors'].head(20).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
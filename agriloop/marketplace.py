@@ -0,0 +1,427 @@
+"""Buyer-facing search over every seller's available surplus listings.
+
+``ListingIndex`` keeps the ``available`` listings in columnar numpy arrays
+with three secondary indexes over them:
+
+* an inverted index from crop to the positions listing it,
+* positions sorted by unit price and by harvest date,
+* a uniform lat/lng grid over the location of each listing's farm.
+
+A query starts from whichever index yields the fewest candidates, checks
+the remaining predicates on those vectorized, and then walks the requested
+ordering only as far as the page it needs, so no more than ``limit`` rows
+are ever read back from the repository.
+
+The index follows its repository through ``subscribe``. Writes are queued
+without blocking the writer and applied at the next query: changed rows go
+to an unsorted tail and leave a tombstone behind, and the sorted structures
+are rebuilt from the arrays (without touching the database) once the tail
+or the tombstones outgrow a fraction of the index. A gap in the table
+version -- writes this process did not see -- triggers a full reload.
+"""
+import math
+import threading
+import weakref
+from collections import deque
+
+import numpy as np
+
+from agriloop.matching import KM_PER_DEG, haversine_km
+
+TABLE = 'surplus_listings'
+SORT_KEYS = ('price', 'harvest_date', 'distance')
+CELL_DEG = 0.5
+MAX_PENDING = 5_000  # larger write batches (or backlogs) are dropped in favour of a reload
+_COLUMNS = ('id', 'crop_id', 'crop', 'quantity', 'unit_price', 'harvest_date')
+_WATCHED = {'crop_id', 'crop', 'quantity', 'unit_price', 'harvest_date', 'status'}
+_FIELDS = ('id', 'crop', 'qty', 'price', 'day', 'lat', 'lng', 'cell', 'alive')
+_DTYPES = {'id': np.int64, 'crop': np.int32, 'cell': np.int64, 'alive': bool}
+_GRID_WIDTH = int(360 / CELL_DEG) + 2
+
+def _days(values):
+    """ISO dates (or None) as float day numbers, NaN where missing or unparseable."""
+    text = [str(v)[:10] if v else 'NaT' for v in values]
+    try:
+        d = np.array(text, dtype='datetime64[D]')
+    except ValueError:
+        d = np.array([_day_or_nat(t) for t in text], dtype='datetime64[D]')
+    out = d.astype(np.int64).astype(float)
+    out[np.isnat(d)] = np.nan
+    return out
+
+def _day_or_nat(text):
+    try:
+        return np.datetime64(text, 'D')
+    except ValueError:
+        return np.datetime64('NaT', 'D')
+
+def _day(value):
+    return None if value is None else float(np.datetime64(str(value)[:10], 'D').astype(np.int64))
+
+def _cells(lat, lng):
+    ci = np.floor((np.nan_to_num(lat, nan=0.0) + 90) / CELL_DEG).astype(np.int64)
+    cj = np.floor((np.nan_to_num(lng, nan=0.0) + 180) / CELL_DEG).astype(np.int64)
+    return np.where(np.isnan(lat) | np.isnan(lng), -1, ci * _GRID_WIDTH + cj)
+
+def _lookup(rows, width):
+    """``rows`` of ``(id, value, ...)`` as a table indexed by id, NaN-filled."""
+    arr = np.array(rows, dtype=float).reshape(-1, width)
+    ids = arr[:, 0].astype(np.int64)
+    table = np.full((int(ids.max()) + 1 if len(ids) else 1, width - 1), np.nan)
+    table[ids] = arr[:, 1:]
+    return table
+
+def _take(table, keys):
+    keys = np.asarray(keys, dtype=float)
+    ok = np.isfinite(keys) & (keys >= 0) & (keys < len(table))
+    out = np.full((len(keys), table.shape[1]), np.nan)
+    out[ok] = table[keys[ok].astype(np.int64)]
+    return out
+
+class ListingIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pending = deque()
+        self._listening = False
+        self._stale = False
+        self.version = None  # table version the arrays reflect; None until first loaded
+        self.crop_names, self._crop_code = [], {}
+        self._reset(0)
+
+    def __len__(self):
+        return int(np.count_nonzero(self._a['alive'][:self.n]))
+
+    # ---------- storage ----------
+    def _reset(self, capacity):
+        self._a = {f: np.zeros(capacity, dtype=_DTYPES.get(f, float)) for f in _FIELDS}
+        self.n = self.n_base = self.n_dead = 0
+
+    def _grow(self, need):
+        cap = len(self._a['id'])
+        if need > cap:
+            cap = max(need, cap * 2, 1024)
+            for f, arr in self._a.items():
+                grown = np.zeros(cap, dtype=arr.dtype)
+                grown[:self.n] = arr[:self.n]
+                self._a[f] = grown
+
+    def _code(self, crop):
+        code = self._crop_code.get(crop)
+        if code is None:
+            code = self._crop_code[crop] = len(self.crop_names)
+            self.crop_names.append(crop)
+        return code
+
+    def _append(self, ids, crops, qty, price, days, lat, lng):
+        n, m = self.n, len(ids)
+        self._grow(n + m)
+        a = self._a
+        a['id'][n:n + m] = ids
+        a['crop'][n:n + m] = [self._code(c) for c in crops]
+        a['qty'][n:n + m] = np.array(qty, dtype=float)
+        a['price'][n:n + m] = np.array(price, dtype=float)
+        a['day'][n:n + m] = days
+        a['lat'][n:n + m], a['lng'][n:n + m] = lat, lng
+        a['cell'][n:n + m] = _cells(np.asarray(lat, dtype=float), np.asarray(lng, dtype=float))
+        a['alive'][n:n + m] = True
+        self.n += m
+
+    def _rebuild(self):
+        """Drop tombstones, merge the tail and rebuild the sorted structures; no database access."""
+        a = self._a
+        keep = np.flatnonzero(a['alive'][:self.n])
+        keep = keep[np.argsort(a['id'][keep], kind='stable')]
+        self._a = {f: arr[keep] for f, arr in a.items()}
+        n = self.n = self.n_base = len(keep)
+        self.n_dead = 0
+        a = self._a
+        # stable argsorts over id-ordered positions break ties by id
+        self._by_price = np.argsort(a['price'], kind='stable')
+        self._price_sorted = a['price'][self._by_price]
+        self._n_priced = int(np.count_nonzero(~np.isnan(a['price'])))
+        self._by_day = np.argsort(a['day'], kind='stable')
+        self._day_sorted = a['day'][self._by_day]
+        self._n_dated = int(np.count_nonzero(~np.isnan(a['day'])))
+        self._by_cell = np.argsort(a['cell'], kind='stable')
+        self._cell_sorted = a['cell'][self._by_cell]
+        by_crop = np.argsort(a['crop'], kind='stable')
+        bounds = np.searchsorted(a['crop'][by_crop], np.arange(len(self.crop_names) + 1))
+        self._postings = [by_crop[bounds[c]:bounds[c + 1]] for c in range(len(self.crop_names))]
+        self._all = np.arange(n)
+
+    # ---------- maintenance ----------
+    def on_write(self, op, items, version):
+        """Repository listener: queue the write for the next query."""
+        if not self._listening:
+            return
+        if len(items) > MAX_PENDING or len(self._pending) > MAX_PENDING:
+            self._pending.clear()
+            self._stale = True
+        else:
+            self._pending.append((op, items, version))
+
+    def _load(self, repo):
+        self._listening = True
+        self._pending.clear()
+        self._stale = False
+        version = repo.version(TABLE)
+        rows = repo.scan(TABLE, _COLUMNS, status='available')
+        self.crop_names, self._crop_code = [], {}
+        self._reset(len(rows))
+        if rows:
+            ids, crop_ids, crops, qty, price, dates = zip(*rows)
+            loc = self._locations(repo, crop_ids)
+            self._append(ids, crops, qty, price, _days(dates), loc[:, 0], loc[:, 1])
+        self._rebuild()
+        self.version = version
+
+    def _locations(self, repo, crop_ids):
+        farm_of = _lookup(repo.scan('crops', ('id', 'farm_id')), 2)
+        where = _lookup(repo.scan('farms', ('id', 'location_latitude', 'location_longitude')), 3)
+        return _take(where, _take(farm_of, crop_ids)[:, 0])
+
+    def _locate(self, repo, crop_id, memo):
+        if crop_id not in memo:
+            crop = repo.get('crops', crop_id) if crop_id is not None else None
+            farm = repo.get('farms', crop['farm_id']) if crop and crop['farm_id'] is not None else None
+            memo[crop_id] = ((farm['location_latitude'], farm['location_longitude'])
+                             if farm and farm['location_latitude'] is not None and farm['location_longitude'] is not None
+                             else (np.nan, np.nan))
+        return memo[crop_id]
+
+    def _remove(self, key):
+        a = self._a
+        i = int(np.searchsorted(a['id'][:self.n_base], key))
+        hit = [i] if i < self.n_base and a['id'][i] == key else []
+        hit += list(self.n_base + np.flatnonzero(a['id'][self.n_base:self.n] == key))
+        for i in hit:
+            if a['alive'][i]:
+                a['alive'][i] = False
+                self.n_dead += 1
+
+    def _upsert(self, repo, row, memo):
+        self._remove(row['id'])
+        if row['status'] == 'available':
+            lat, lng = self._locate(repo, row['crop_id'], memo)
+            self._append([row['id']], [row['crop']], [row['quantity']], [row['unit_price']],
+                         _days([row['harvest_date']]), [lat], [lng])
+
+    def _drain(self, repo):
+        """Apply queued writes in version order; False if one is missing."""
+        events = []
+        while self._pending:
+            events.append(self._pending.popleft())
+        memo = {}
+        for op, items, version in sorted(events, key=lambda e: e[2]):
+            if version <= self.version:
+                continue
+            if version != self.version + 1:
+                return False
+            if op == 'insert':
+                for row in items:
+                    self._upsert(repo, row, memo)
+            elif op == 'update':
+                for key, changes in items:
+                    if _WATCHED & changes.keys():
+                        row = repo.get(TABLE, key)
+                        if row is None:
+                            self._remove(key)
+                        else:
+                            self._upsert(repo, row, memo)
+            else:
+                for key in items:
+                    self._remove(key)
+            self.version = version
+        return True
+
+    def sync(self, repo):
+        """Bring the index up to date with ``repo``, patching it when possible and reloading otherwise."""
+        with self._lock:
+            if self.version is None or self._stale or not self._drain(repo) or self.version != repo.version(TABLE):
+                self._load(repo)
+                self._drain(repo)
+            if self.n - self.n_base > max(4096, self.n_base // 8) or self.n_dead > max(4096, self.n_base // 4):
+                self._rebuild()
+
+    # ---------- queries ----------
+    def _query(self, crops, min_quantity, max_quantity, min_price, max_price, harvest_from, harvest_to, near, radius_km):
+        q = {'ranges': [(f, lo, hi) for f, lo, hi in (('qty', min_quantity, max_quantity), ('price', min_price, max_price),
+                                                      ('day', _day(harvest_from), _day(harvest_to)))
+                        if lo is not None or hi is not None],
+             'crops': None, 'near': near, 'radius': radius_km if near is not None else None}
+        if crops:
+            q['crops'] = np.zeros(len(self.crop_names), bool)
+            q['crops'][[self._crop_code[c] for c in crops if c in self._crop_code]] = True
+        return q
+
+    def _matches(self, pos, q):
+        a = self._a
+        ok = a['alive'][pos]
+        if q['crops'] is not None:
+            ok &= q['crops'][a['crop'][pos]]
+        for f, lo, hi in q['ranges']:
+            v = a[f][pos]
+            if lo is not None: ok &= v >= lo
+            if hi is not None: ok &= v <= hi
+        if q['radius'] is not None:
+            idx = np.flatnonzero(ok)
+            ok[idx] = haversine_km(q['near'][0], q['near'][1], a['lat'][pos[idx]], a['lng'][pos[idx]]) <= q['radius']
+        return ok
+
+    def _cell_ranges(self, lat, lng, radius):
+        """``(lo, hi)`` cell-code ranges covering the circle, one or two per grid row."""
+        dlat = radius / KM_PER_DEG
+        lat_lo, lat_hi = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+        cos_lat = math.cos(math.radians(max(abs(lat_lo), abs(lat_hi))))
+        dlng = 180.0 if cos_lat < 1e-6 else radius / (KM_PER_DEG * cos_lat)
+        if dlng >= 180:
+            spans = [(-180.0, 180.0)]
+        else:
+            lo, hi = lng - dlng, lng + dlng
+            spans = [(max(lo, -180.0), min(hi, 180.0))]
+            if lo < -180: spans.append((lo + 360, 180.0))
+            if hi > 180: spans.append((-180.0, hi - 360))
+        rows = range(int((lat_lo + 90) // CELL_DEG), int((lat_hi + 90) // CELL_DEG) + 1)
+        return [(i * _GRID_WIDTH + int((a + 180) // CELL_DEG), i * _GRID_WIDTH + int((b + 180) // CELL_DEG))
+                for i in rows for a, b in spans]
+
+    def _drivers(self, q):
+        """Candidate generators as ``(size, name, positions)``; ``positions()`` is only called for the chosen one."""
+        out = []
+        if q['crops'] is not None:
+            lists = [self._postings[c] for c in np.flatnonzero(q['crops']) if c < len(self._postings)]
+            out.append((sum(map(len, lists)), 'crop',
+                        lambda: np.sort(np.concatenate(lists)) if lists else np.empty(0, np.int64)))
+        for f, lo, hi in q['ranges']:
+            if f == 'qty':
+                continue
+            perm, keys, valid = ((self._by_price, self._price_sorted, self._n_priced) if f == 'price'
+                                 else (self._by_day, self._day_sorted, self._n_dated))
+            i = int(np.searchsorted(keys[:valid], lo, 'left')) if lo is not None else 0
+            j = int(np.searchsorted(keys[:valid], hi, 'right')) if hi is not None else valid
+            out.append((max(0, j - i), 'price' if f == 'price' else 'harvest_date', lambda perm=perm, i=i, j=j: perm[i:j]))
+        if q['radius'] is not None:
+            spans = [(int(np.searchsorted(self._cell_sorted, lo, 'left')), int(np.searchsorted(self._cell_sorted, hi, 'right')))
+                     for lo, hi in self._cell_ranges(q['near'][0], q['near'][1], q['radius'])]
+            out.append((sum(j - i for i, j in spans), 'grid',
+                        lambda: np.concatenate([self._by_cell[i:j] for i, j in spans])))
+        return out
+
+    def _key(self, pos, sort, q):
+        a = self._a
+        if sort == 'distance':
+            return haversine_km(q['near'][0], q['near'][1], a['lat'][pos], a['lng'][pos])
+        return a['price' if sort == 'price' else 'day'][pos]
+
+    def _ordered(self, pos, sort, descending, q, k):
+        """The first ``k`` of ``pos`` in result order: by key (missing last), then id."""
+        key = self._key(pos, sort, q)
+        ids = self._a['id'][pos]
+        if descending:
+            key, ids = -key, -ids
+        if len(pos) > 4 * k:
+            # only keys up to the k-th smallest can make the page
+            cut = np.partition(np.nan_to_num(key, nan=np.inf), k - 1)[k - 1]
+            if np.isfinite(cut):
+                top = key <= cut
+                pos, key, ids = pos[top], key[top], ids[top]
+        order = np.lexsort((ids, key, np.isnan(key)))
+        return pos[order[:k]]
+
+    def _walk(self, mark, sort, descending, k):
+        """The first ``k`` marked base positions along the ``sort`` index, read in growing chunks."""
+        perm, valid = (self._by_price, self._n_priced) if sort == 'price' else (self._by_day, self._n_dated)
+        segments = [perm[:valid][::-1], perm[valid:]] if descending else [perm]
+        found, chunk = [], 1024
+        for seg in segments:
+            lo = 0
+            while lo < len(seg) and sum(map(len, found)) < k:
+                part = seg[lo:lo + chunk]
+                found.append(part[mark[part]])
+                lo, chunk = lo + chunk, chunk * 2
+        return np.concatenate(found)[:k] if found else np.empty(0, np.int64)
+
+    def _base_hits(self, q, sort, descending, k):
+        """``(first k matching base positions in order, total matches in the base)``."""
+        if not self.n_base or k <= 0:
+            return np.empty(0, np.int64), 0
+        drivers = self._drivers(q)
+        if drivers:
+            size, name, positions = min(drivers, key=lambda d: d[0])
+            pos = positions()
+            pos = pos[self._matches(pos, q)]
+            if name == sort:
+                return (pos[::-1] if descending else pos)[:k], len(pos)
+            if sort == 'distance' or len(pos) * 16 < self.n_base:
+                return self._ordered(pos, sort, descending, q, k), len(pos)
+            mark = np.zeros(self.n_base, bool)
+            mark[pos] = True
+            return self._walk(mark, sort, descending, k), len(pos)
+        mark = self._matches(self._all, q) if q['ranges'] else self._a['alive'][:self.n_base]
+        total = int(np.count_nonzero(mark))
+        if sort == 'distance':
+            return self._ordered(np.flatnonzero(mark), sort, descending, q, k), total
+        return self._walk(mark, sort, descending, k), total
+
+    def search(self, repo, crops=None, min_quantity=None, max_quantity=None, min_price=None, max_price=None,
+               harvest_from=None, harvest_to=None, near=None, radius_km=None, sort='price', descending=False,
+               offset=0, limit=20):
+        """One page of available listings matching every given filter: ``(rows, total)``.
+
+        ``crops`` is a collection of crop names, ``harvest_from``/``harvest_to``
+        are dates (or ISO strings) and ``near`` a ``(lat, lng)`` point that
+        ``radius_km`` measures from. ``sort`` is one of ``SORT_KEYS``
+        (``distance`` needs ``near``); listings without the sort value come
+        last. Rows are read from ``repo`` and carry ``distance_km`` when
+        ``near`` is given.
+        """
+        if sort not in SORT_KEYS or (sort == 'distance' and near is None):
+            raise ValueError(f"cannot sort by {sort!r}" + (" without a location" if sort == 'distance' else ""))
+        with self._lock:
+            self.sync(repo)
+            q = self._query(crops, min_quantity, max_quantity, min_price, max_price, harvest_from, harvest_to, near, radius_km)
+            k = offset + limit
+            hits, total = self._base_hits(q, sort, descending, k)
+            tail = np.arange(self.n_base, self.n)
+            tail = tail[self._matches(tail, q)]
+            if len(tail):
+                hits = self._ordered(np.r_[hits, tail], sort, descending, q, k)
+            total += len(tail)
+            page = hits[offset:k]
+            a = self._a
+            located = [(int(a['id'][p]), a['lat'][p], a['lng'][p]) for p in page]
+        rows = []
+        for key, lat, lng in located:
+            row = repo.get(TABLE, key)
+            if row is not None:
+                if near is not None:
+                    row['distance_km'] = None if np.isnan(lat) else float(haversine_km(near[0], near[1], lat, lng))
+                rows.append(row)
+        return rows, total
+
+    def crop_facets(self, repo, **filters):
+        """``{crop: matching listings}`` under every filter of ``search`` except ``crops``."""
+        filters.pop('crops', None)
+        with self._lock:
+            self.sync(repo)
+            q = self._query(None, *(filters.get(f) for f in ('min_quantity', 'max_quantity', 'min_price', 'max_price',
+                                                              'harvest_from', 'harvest_to', 'near', 'radius_km')))
+            drivers = self._drivers(q) if self.n_base else []
+            pos = min(drivers, key=lambda d: d[0])[2]() if drivers else self._all
+            pos = np.r_[pos, np.arange(self.n_base, self.n)]
+            pos = pos[self._matches(pos, q)]
+            counts = np.bincount(self._a['crop'][pos], minlength=len(self.crop_names))
+            return {c: int(n) for c, n in zip(self.crop_names, counts) if n}
+
+# ============ PER-REPOSITORY INDEXES ============
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+def index_for(repo):
+    """The process-wide listing index following ``repo``; subscribed on first use, loaded on first query."""
+    with _indexes_lock:
+        index = _indexes.get(repo)
+        if index is None:
+            index = _indexes[repo] = ListingIndex()
+            repo.subscribe(TABLE, index.on_write)
+        return index
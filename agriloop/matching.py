@@ -0,0 +1,381 @@
+"""Spatial partner matching for waste requests.
+
+``PartnerIndex`` buckets partners into a uniform lat/lng grid and answers
+k-nearest queries by scanning rings of cells outward from the request,
+scoring each ring's compatible partners with a vectorized haversine. The
+search stops as soon as the k-th best distance is closer than anything an
+unvisited ring could contain.
+
+``assign_batch`` assigns many pending requests at once under partner
+capacity limits (see its docstring).
+
+``PartnerLoad`` keeps each partner's committed kg per day up to date from
+repository writes (``load_for(repo)``), so checking capacity does not
+re-read every matched request.
+"""
+import math
+import threading
+import weakref
+from collections import deque
+from datetime import date
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG = math.pi * EARTH_RADIUS_KM / 180
+
+# Which partner types can take each waste type.
+WASTE_PARTNER_TYPES = {
+    'crop_residue': ('compost_facility', 'biogas_plant', 'recycling_center'),
+    'food_waste': ('biogas_plant', 'compost_facility'),
+    'organic_waste': ('compost_facility', 'biogas_plant'),
+    'surplus_produce': ('food_bank',),
+    'spoiled_produce': ('compost_facility', 'biogas_plant'),
+}
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def partner_load(waste_requests, day=None):
+    """kg already committed to each partner on ``day`` (default today) by matched requests."""
+    day = (day or date.today()).isoformat()
+    load = {}
+    for r in waste_requests:
+        if r['status'] == 'matched' and r.get('partner_id') and (r.get('matched_at') or '')[:10] == day:
+            load[r['partner_id']] = load.get(r['partner_id'], 0) + (r['quantity_kg'] or 0)
+    return load
+
+# ============ DAILY LOAD ============
+_LOAD_TABLE = 'waste_requests'
+_LOAD_COLUMNS = ('id', 'partner_id', 'quantity_kg', 'matched_at')
+_LOAD_WATCHED = {'status', 'partner_id', 'quantity_kg', 'matched_at'}
+MAX_PENDING_LOAD = 5_000  # larger write batches (or backlogs) are dropped in favour of a reload
+
+class PartnerLoad:
+    """``partner_load`` over a repository, kept up to date from its writes.
+
+    Matched requests are counted once at the first query; after that writes
+    are queued by ``on_write`` and applied in version order at the next one,
+    and a version gap reloads, as for ``marketplace.ListingIndex``. Only
+    today and later are kept: past days are dropped when the date changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pending = deque()
+        self._listening = False
+        self._stale = False
+        self.version = None
+        self._rows, self._days = {}, {}
+        self._since = date.today().isoformat()  # earliest day kept
+
+    def on_write(self, op, items, version):
+        """Repository listener: queue the write for the next query."""
+        if not self._listening:
+            return
+        if len(items) > MAX_PENDING_LOAD or len(self._pending) > MAX_PENDING_LOAD:
+            self._pending.clear()
+            self._stale = True
+        else:
+            self._pending.append((op, items, version))
+
+    def _add(self, key, partner_id, kg, matched_at):
+        if partner_id and matched_at and matched_at[:10] >= self._since:
+            day = matched_at[:10]
+            self._rows[key] = (partner_id, day, kg or 0)
+            per_partner = self._days.setdefault(day, {})
+            per_partner[partner_id] = per_partner.get(partner_id, 0) + (kg or 0)
+
+    def _remove(self, key):
+        hit = self._rows.pop(key, None)
+        if hit:
+            partner_id, day, kg = hit
+            per_partner = self._days[day]
+            per_partner[partner_id] -= kg
+            if abs(per_partner[partner_id]) < 1e-9:
+                del per_partner[partner_id]
+
+    def _upsert(self, row):
+        self._remove(row['id'])
+        if row['status'] == 'matched':
+            self._add(row['id'], row.get('partner_id'), row['quantity_kg'], row.get('matched_at'))
+
+    def _prune(self, today):
+        """Forget the days before ``today``."""
+        self._since = today
+        self._rows = {k: r for k, r in self._rows.items() if r[1] >= today}
+        self._days = {d: load for d, load in self._days.items() if d >= today}
+
+    def _load(self, repo):
+        self._listening = True
+        self._pending.clear()
+        self._stale = False
+        version = repo.version(_LOAD_TABLE)
+        self._rows, self._days = {}, {}
+        self._since = date.today().isoformat()
+        for key, partner_id, kg, matched_at in repo.scan(_LOAD_TABLE, _LOAD_COLUMNS, status='matched'):
+            self._add(key, partner_id, kg, matched_at)
+        self.version = version
+
+    def _drain(self, repo):
+        """Apply queued writes in version order; False if one is missing."""
+        events = []
+        while self._pending:
+            events.append(self._pending.popleft())
+        for op, items, version in sorted(events, key=lambda e: e[2]):
+            if version <= self.version:
+                continue
+            if version != self.version + 1:
+                return False
+            if op == 'insert':
+                for row in items:
+                    self._upsert(row)
+            elif op == 'update':
+                for key, changes in items:
+                    if _LOAD_WATCHED & changes.keys():
+                        row = repo.get(_LOAD_TABLE, key)
+                        if row is None:
+                            self._remove(key)
+                        else:
+                            self._upsert(row)
+            else:
+                for key in items:
+                    self._remove(key)
+            self.version = version
+        return True
+
+    def sync(self, repo):
+        """Bring the counts up to date with ``repo``, patching them when possible and reloading otherwise."""
+        with self._lock:
+            if self.version is None or self._stale or not self._drain(repo) or self.version != repo.version(_LOAD_TABLE):
+                self._load(repo)
+                self._drain(repo)
+
+    def load(self, repo, day=None):
+        """kg already committed to each partner on ``day`` (default today, and never earlier), as ``partner_load`` counts it."""
+        with self._lock:
+            self.sync(repo)
+            today = date.today().isoformat()
+            if today > self._since:
+                self._prune(today)
+            return dict(self._days.get((day or date.today()).isoformat(), {}))
+
+_loads = weakref.WeakKeyDictionary()
+_loads_lock = threading.Lock()
+
+def load_for(repo):
+    """The process-wide ``PartnerLoad`` following ``repo``; subscribed on first use, loaded on first query."""
+    with _loads_lock:
+        loads = _loads.get(repo)
+        if loads is None:
+            loads = _loads[repo] = PartnerLoad()
+            repo.subscribe(_LOAD_TABLE, loads.on_write)
+        return loads
+
+class PartnerIndex:
+    def __init__(self, partners, cell_deg=None):
+        self.partners = list(partners)
+        n = len(self.partners)
+        self.ids = np.array([p['id'] for p in self.partners], dtype=np.int64)
+        self.lat = np.array([p['lat'] for p in self.partners], dtype=float)
+        self.lng = np.array([p['lng'] for p in self.partners], dtype=float)
+        self.capacity = np.array([p['capacity'] or 0 for p in self.partners], dtype=float)
+        self.type_names = sorted({p['type'] for p in self.partners})
+        self.types = np.array([self.type_names.index(p['type']) for p in self.partners], dtype=np.int16)
+        self._pos = {int(i): j for j, i in enumerate(self.ids)}
+
+        if cell_deg is None:
+            # aim for a handful of partners per occupied cell
+            span = max(np.ptp(self.lat) * np.ptp(self.lng), 1e-6) if n else 1.0
+            cell_deg = float(np.clip(math.sqrt(span * 8 / max(n, 1)), 0.01, 5.0))
+        self.cell_deg = cell_deg
+        ci = np.floor(self.lat / cell_deg).astype(np.int64)
+        cj = np.floor(self.lng / cell_deg).astype(np.int64)
+        self.ci_range = (int(ci.min()), int(ci.max())) if n else (0, -1)
+        self.cj_range = (int(cj.min()), int(cj.max())) if n else (0, -1)
+        # cells as contiguous runs of a sorted linear cell code, plus a dict view for ring scans
+        self._order = np.argsort(self._code(ci, cj), kind='stable')
+        self._codes = self._code(ci, cj)[self._order]
+        self.cells = {}
+        if n:
+            starts = np.flatnonzero(np.r_[True, self._codes[1:] != self._codes[:-1]])
+            for s, e in zip(starts, np.r_[starts[1:], n]):
+                p = self._order[s]
+                self.cells[(int(ci[p]), int(cj[p]))] = self._order[s:e]
+
+    def _code(self, ci, cj):
+        width = self.cj_range[1] - self.cj_range[0] + 3
+        return (ci - self.ci_range[0] + 1) * width + (cj - self.cj_range[0] + 1)
+
+    def __len__(self):
+        return len(self.partners)
+
+    def _type_mask(self, waste_type):
+        allowed = [self.type_names.index(t) for t in WASTE_PARTNER_TYPES.get(waste_type, ()) if t in self.type_names]
+        return np.isin(np.arange(len(self.type_names)), allowed)
+
+    def _ring(self, i0, j0, r):
+        if r == 0:
+            return [self.cells.get((i0, j0))]
+        out = []
+        for j in range(j0 - r, j0 + r + 1):
+            out += [self.cells.get((i0 - r, j)), self.cells.get((i0 + r, j))]
+        for i in range(i0 - r + 1, i0 + r):
+            out += [self.cells.get((i, j0 - r)), self.cells.get((i, j0 + r))]
+        return out
+
+    def nearest(self, lat, lng, k=3, waste_type=None, quantity=0, load=None):
+        """Up to ``k`` partners closest to (lat, lng) as ``(partner, distance_km, remaining_kg)``.
+
+        Only partners whose type accepts ``waste_type`` (any type if None) and
+        whose remaining daily capacity (``capacity`` minus ``load[id]``) covers
+        ``quantity`` are returned, nearest first.
+        """
+        if not self.partners:
+            return []
+        ok_type = self._type_mask(waste_type) if waste_type else None
+        i0, j0 = math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg)
+        max_r = max(abs(i0 - self.ci_range[0]), abs(i0 - self.ci_range[1]),
+                    abs(j0 - self.cj_range[0]), abs(j0 - self.cj_range[1]))
+        cos_edge = lambda r: max(math.cos(math.radians(min(90.0, abs(lat) + r * self.cell_deg))), 1e-3)
+        best_pos, best_d = np.empty(0, dtype=np.int64), np.empty(0)
+        for r in range(max_r + 1):
+            found = [c for c in self._ring(i0, j0, r) if c is not None]
+            if found:
+                pos = np.concatenate(found)
+                if ok_type is not None:
+                    pos = pos[ok_type[self.types[pos]]]
+                if load:
+                    remaining = self.capacity[pos] - np.array([load.get(int(i), 0) for i in self.ids[pos]])
+                else:
+                    remaining = self.capacity[pos]
+                pos = pos[remaining >= quantity]
+                if len(pos):
+                    d = haversine_km(lat, lng, self.lat[pos], self.lng[pos])
+                    best_pos, best_d = np.r_[best_pos, pos], np.r_[best_d, d]
+                    keep = np.argsort(best_d, kind='stable')[:k]
+                    best_pos, best_d = best_pos[keep], best_d[keep]
+            # anything in ring r+1 is at least r full cells away
+            if len(best_d) >= k and best_d[-1] <= r * self.cell_deg * KM_PER_DEG * cos_edge(r + 1):
+                break
+        load = load or {}
+        return [(self.partners[p], float(d), float(self.capacity[p] - load.get(int(self.ids[p]), 0)))
+                for p, d in zip(best_pos, best_d)]
+
+    def candidates(self, lat, lng, waste_types, k=8):
+        """Vectorized candidate lists for many requests at once.
+
+        Returns ``(pos, dist)``, both shaped ``(n, k)``: positions into this
+        index of the nearest compatible partners found in each request's 3x3
+        cell neighbourhood, sorted by distance, padded with -1 / inf.
+        Requests that find fewer than ``k`` there fall back to ``nearest``.
+        """
+        lat, lng = np.asarray(lat, dtype=float), np.asarray(lng, dtype=float)
+        n = len(lat)
+        pos_out, dist_out = np.full((n, k), -1, dtype=np.int64), np.full((n, k), np.inf)
+        if not n or not self.partners:
+            return pos_out, dist_out
+        waste_names = sorted(WASTE_PARTNER_TYPES)
+        compat = np.array([self._type_mask(w) for w in waste_names] + [np.zeros(len(self.type_names), bool)])
+        wcode = np.array([waste_names.index(w) if w in WASTE_PARTNER_TYPES else len(waste_names) for w in waste_types])
+
+        ci = np.floor(lat / self.cell_deg).astype(np.int64)
+        cj = np.floor(lng / self.cell_deg).astype(np.int64)
+        in_grid = lambda i, j: ((i >= self.ci_range[0]) & (i <= self.ci_range[1]) &
+                                (j >= self.cj_range[0]) & (j <= self.cj_range[1]))
+        req_parts, pos_parts = [], []
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                i, j = ci + di, cj + dj
+                ok = np.flatnonzero(in_grid(i, j))
+                code = self._code(i[ok], j[ok])
+                lo = np.searchsorted(self._codes, code, side='left')
+                hi = np.searchsorted(self._codes, code, side='right')
+                lens = hi - lo
+                total = int(lens.sum())
+                if not total:
+                    continue
+                offsets = np.repeat(lo - np.r_[0, np.cumsum(lens)[:-1]], lens) + np.arange(total)
+                req_parts.append(np.repeat(ok, lens))
+                pos_parts.append(self._order[offsets])
+        if req_parts:
+            req, pos = np.concatenate(req_parts), np.concatenate(pos_parts)
+            keep = compat[wcode[req], self.types[pos]]
+            req, pos = req[keep], pos[keep]
+            d = haversine_km(lat[req], lng[req], self.lat[pos], self.lng[pos])
+            # one float sort on "request + scaled distance" groups by request, nearest first
+            order = np.argsort(req + d / (d.max() + 1.0))
+            req, pos, d = req[order], pos[order], d[order]
+            starts = np.flatnonzero(np.r_[True, req[1:] != req[:-1]])
+            rank = np.arange(len(req)) - np.repeat(starts, np.diff(np.r_[starts, len(req)]))
+            top = rank < k
+            pos_out[req[top], rank[top]] = pos[top]
+            dist_out[req[top], rank[top]] = d[top]
+        for i in np.flatnonzero(pos_out[:, -1] < 0):
+            if wcode[i] == len(waste_names):
+                continue
+            found = self.nearest(lat[i], lng[i], k=k, waste_type=waste_types[i])
+            for r, (p, d, _) in enumerate(found):
+                pos_out[i, r], dist_out[i, r] = self._pos[p['id']], d
+        return pos_out, dist_out
+
+def assign_batch(requests, index, load=None, k=8, iterations=60):
+    """Assign all ``requests`` to partners at once, minimizing total distance under capacity.
+
+    Each request keeps its ``k`` nearest compatible partners as candidates.
+    A price-based auction then runs over the candidate matrix: every request
+    bids for the candidate minimizing ``distance + price[partner] * kg`` and
+    partners raise their per-kg price in proportion to how far they are over
+    their remaining daily capacity (lowering it again when under-used). A
+    final pass hands out capacity in order of regret -- requests with the
+    most to lose from their first choice go first -- so the result is always
+    feasible. Requests that cannot be served anywhere are left unassigned.
+
+    Returns a list of ``(request, partner or None, distance_km or None)``.
+    """
+    n = len(requests)
+    if not n or not len(index):
+        return [(r, None, None) for r in requests]
+    qty = np.array([r['quantity_kg'] or 0 for r in requests], dtype=float)
+    load = load or {}
+    cap = index.capacity - np.array([load.get(int(i), 0) for i in index.ids], dtype=float)
+    pos, dist = index.candidates([r['location_latitude'] for r in requests], [r['location_longitude'] for r in requests],
+                                 [r['waste_type'] for r in requests], k=k)
+    valid = (pos >= 0) & (qty[:, None] <= cap[np.maximum(pos, 0)])
+    safe = np.maximum(pos, 0)
+    rows = np.arange(n)
+
+    price = np.zeros(len(index))
+    finite = dist[valid]
+    step = (np.median(finite) / max(np.median(qty), 1e-9)) if finite.size else 0.0
+    for it in range(iterations):
+        cost = np.where(valid, dist + price[safe] * qty[:, None], np.inf)
+        choice = np.argmin(cost, axis=1)
+        has = valid[rows, choice]
+        chosen = pos[rows, choice][has]
+        used = np.bincount(chosen, weights=qty[has], minlength=len(index))
+        excess = (used - cap) / np.maximum(cap, 1.0)
+        if (excess <= 0).all():
+            break
+        price = np.maximum(0.0, price + step / math.sqrt(it + 1) * excess)
+
+    cost = np.where(valid, dist + price[safe] * qty[:, None], np.inf)
+    ranked = np.argsort(cost, axis=1)
+    sorted_cost = np.take_along_axis(cost, ranked, axis=1)
+    regret = (sorted_cost[:, 1] if k > 1 else np.full(n, np.inf)) - sorted_cost[:, 0]
+    regret = np.where(np.isfinite(sorted_cost[:, 0]), np.nan_to_num(regret, posinf=1e18), -1.0)
+    remaining = cap.copy()
+    out = [None] * n
+    for i in np.argsort(-regret, kind='stable'):
+        out[i] = (requests[i], None, None)
+        for j in ranked[i]:
+            if not valid[i, j]:
+                break
+            p = pos[i, j]
+            if remaining[p] >= qty[i]:
+                remaining[p] -= qty[i]
+                out[i] = (requests[i], index.partners[p], float(dist[i, j]))
+                break
+    return out
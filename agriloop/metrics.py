@@ -0,0 +1,207 @@
+"""Process-wide performance metrics with Prometheus text export.
+
+Counters, gauges and histograms live in one registry shared by every
+session of the process. ``timed`` wraps a function (or block) and records
+its duration under ``agriloop_call_seconds{fn=...}``; ``rerun`` does the
+same for whole script reruns and also counts them per page. Gauges that are
+cheaper to read on demand (entity counts) come from collectors registered
+with ``collector`` and evaluated at scrape time.
+
+Metrics are served as Prometheus text on ``GET /metrics`` by
+``start_metrics_server``; every rerun is also logged as one JSON line on
+the ``agriloop.metrics`` logger (enabled with ``configure_log``).
+"""
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SESSION_TTL = 300  # a session counts as active this long after its last rerun
+
+HELP = {
+    'agriloop_call_seconds': ('histogram', "Duration of instrumented helpers."),
+    'agriloop_rerun_seconds': ('histogram', "Duration of full script reruns per page."),
+    'agriloop_reruns_total': ('counter', "Full script reruns per page."),
+    'agriloop_slow_reruns_total': ('counter', "Reruns slower than the profiling threshold."),
+    'agriloop_active_sessions': ('gauge', "Sessions that reran within the last five minutes."),
+    'agriloop_entities': ('gauge', "Stored rows per table."),
+    'agriloop_weather_lookups_total': ('counter', "Weather cell lookups by result (hit, miss, coalesced, error)."),
+}
+
+log = logging.getLogger("agriloop.metrics")
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        i = bisect.bisect_left(BUCKETS, value)
+        if i < len(BUCKETS):
+            self.counts[i] += 1
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters, self.gauges, self.histograms = {}, {}, {}
+        self.collectors = {}
+        self.sessions = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram()
+            h.observe(value)
+
+    def touch_session(self, session_id, now=None):
+        now = now or time.time()
+        with self._lock:
+            self.sessions[session_id] = now
+
+    def snapshot(self):
+        """``{(name, labels): value}`` for counters and gauges (collectors included) and the histograms."""
+        now = time.time()
+        with self._lock:
+            values = dict(self.counters)
+            values.update(self.gauges)
+            self.sessions = {s: t for s, t in self.sessions.items() if now - t <= SESSION_TTL}
+            values[('agriloop_active_sessions', ())] = len(self.sessions)
+            histograms = {k: (list(h.counts), h.count, h.sum) for k, h in self.histograms.items()}
+            collectors = list(self.collectors.values())
+        for fn in collectors:
+            try:
+                for name, labels, value in fn():
+                    values[(name, tuple(sorted(labels.items())))] = value
+            except Exception:  # a broken collector must not break the scrape
+                log.exception("metrics collector failed")
+        return values, histograms
+
+REGISTRY = Registry()
+inc, set_gauge, observe = REGISTRY.inc, REGISTRY.set, REGISTRY.observe
+
+def collector(name, fn):
+    """Register ``fn() -> [(metric, labels, value)]`` to run at scrape time; a later call with ``name`` replaces it."""
+    with REGISTRY._lock:
+        REGISTRY.collectors[name] = fn
+
+@contextmanager
+def timer(name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('agriloop_call_seconds', time.perf_counter() - t0, fn=name)
+
+def timed(func=None, name=None):
+    """Decorator recording each call's duration; usable bare or as ``@timed(name=...)``."""
+    if func is None:
+        return functools.partial(timed, name=name)
+    label = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with timer(label):
+            return func(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def rerun(page, session_id, profiler=None):
+    """Time one script rerun of ``page``; hands the sample to ``profiler`` (if any) when it ends."""
+    REGISTRY.touch_session(session_id)
+    if profiler:
+        profiler.start()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        inc('agriloop_reruns_total', page=page)
+        observe('agriloop_rerun_seconds', elapsed, page=page)
+        dumped = profiler.stop(elapsed, page) if profiler else None
+        if dumped:
+            inc('agriloop_slow_reruns_total', page=page)
+        if log.isEnabledFor(logging.INFO):
+            log.info(json.dumps({'event': 'rerun', 'ts': round(time.time(), 3), 'page': page, 'session': session_id,
+                                 'seconds': round(elapsed, 6), 'profile': dumped}))
+
+# ============ EXPORT ============
+def _labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+def render_prometheus(registry=REGISTRY):
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    values, histograms = registry.snapshot()
+    lines, seen = [], set()
+
+    def header(name):
+        if name not in seen:
+            seen.add(name)
+            kind, text = HELP.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(values.items()):
+        header(name)
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), (counts, count, total) in sorted(histograms.items()):
+        header(name)
+        cumulative = 0
+        for b, c in zip(BUCKETS, counts):
+            cumulative += c
+            lines.append(f"{name}_bucket{_labels(labels, [('le', b)])} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_labels(labels)} {total}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def configure_log(target):
+    """Send rerun JSON lines to ``target``: ``-`` for stderr, otherwise a file path (appended)."""
+    handler = logging.StreamHandler() if target == "-" else logging.FileHandler(target)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+def start_metrics_server(port, host="127.0.0.1", registry=REGISTRY):
+    """Serve ``GET /metrics`` on a daemon thread; returns the server."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            data = render_prometheus(registry).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    return server
@@ -0,0 +1,67 @@
+"""Sampling profiler for slow Streamlit reruns.
+
+While a rerun is in progress a daemon thread samples the script thread's
+Python stack every ``interval`` seconds via ``sys._current_frames``. If the
+rerun took at least ``slow_seconds`` the samples are written as collapsed
+stacks (``frame;frame;frame count`` per line), the input format of
+``flamegraph.pl``, speedscope and inferno; faster reruns are discarded.
+
+Enabled from the environment by ``from_env``::
+
+    AGRILOOP_PROFILE_DIR=profiles AGRILOOP_PROFILE_SLOW_MS=250 streamlit run app.py
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+class SamplingProfiler:
+    def __init__(self, out_dir, slow_seconds=0.25, interval=0.005):
+        self.out_dir, self.slow_seconds, self.interval = out_dir, slow_seconds, interval
+        self._local = threading.local()
+
+    def start(self):
+        """Begin sampling the calling thread."""
+        stacks, done = Counter(), threading.Event()
+        target = threading.get_ident()
+        sampler = threading.Thread(target=self._sample, args=(target, stacks, done), daemon=True, name="rerun-profiler")
+        self._local.run = (stacks, done, sampler)
+        sampler.start()
+
+    def stop(self, elapsed, label):
+        """Stop sampling; returns the dump path if the rerun was slow, else None."""
+        run = getattr(self._local, 'run', None)
+        if run is None:
+            return None
+        stacks, done, sampler = run
+        self._local.run = None
+        done.set()
+        sampler.join()
+        if elapsed < self.slow_seconds or not stacks:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f"rerun-{time.strftime('%Y%m%d-%H%M%S')}-{int(elapsed * 1000)}ms-{label}.folded")
+        with open(path, "w") as f:
+            for stack, n in stacks.most_common():
+                f.write(f"{stack} {n}\n")
+        return path
+
+    def _sample(self, target, stacks, done):
+        while not done.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                return
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+
+def from_env(environ=os.environ):
+    """A profiler configured by ``AGRILOOP_PROFILE_DIR`` / ``AGRILOOP_PROFILE_SLOW_MS``, or None when unset."""
+    out_dir = environ.get('AGRILOOP_PROFILE_DIR')
+    if not out_dir:
+        return None
+    return SamplingProfiler(out_dir, slow_seconds=float(environ.get('AGRILOOP_PROFILE_SLOW_MS', 250)) / 1000)
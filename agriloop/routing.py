@@ -0,0 +1,140 @@
+"""Multi-stop pickup route planning for matched waste requests.
+
+Each partner depot gets its own vehicle routes. Planning runs Clarke-Wright
+savings (restricted to each stop's nearest neighbours) under a vehicle
+capacity limit, then improves every route with vectorized 2-opt. Pairwise
+distances come from a ``DistanceMatrix`` that is kept between runs and only
+computes rows for stops it has not seen before.
+"""
+import numpy as np
+
+from agriloop.matching import haversine_km
+
+class DistanceMatrix:
+    """Symmetric great-circle distance matrix (km, float32) over keyed points."""
+
+    def __init__(self):
+        self.keys, self.lat, self.lng = [], np.empty(0), np.empty(0)
+        self.d = np.zeros((0, 0), dtype=np.float32)
+        self.computed_rows = 0  # rows computed by the last update, for reuse diagnostics
+
+    def update(self, keys, lat, lng):
+        """Re-key the matrix to ``keys``, reusing every distance whose endpoints are unchanged."""
+        lat, lng = np.asarray(lat, dtype=float), np.asarray(lng, dtype=float)
+        old = {k: i for i, k in enumerate(self.keys)}
+        reuse_new, reuse_old, fresh = [], [], []
+        for i, k in enumerate(keys):
+            j = old.get(k)
+            if j is not None and self.lat[j] == lat[i] and self.lng[j] == lng[i]:
+                reuse_new.append(i); reuse_old.append(j)
+            else:
+                fresh.append(i)
+        n = len(keys)
+        d = np.empty((n, n), dtype=np.float32)
+        if reuse_new:
+            d[np.ix_(reuse_new, reuse_new)] = self.d[np.ix_(reuse_old, reuse_old)]
+        for i in fresh:
+            row = haversine_km(lat[i], lng[i], lat, lng)
+            d[i, :] = row
+            d[:, i] = row
+        self.keys, self.lat, self.lng, self.d = list(keys), lat, lng, d
+        self.computed_rows = len(fresh)
+        return self
+
+def _savings_routes(d, demand, capacity, neighbours):
+    """Parallel Clarke-Wright savings. Node 0 is the depot; returns lists of stop nodes."""
+    n = len(demand)
+    if n <= 1:
+        return [[1]] if n else []
+    stops = np.arange(1, n + 1)
+    # k nearest neighbours per stop (the k + 1 smallest include the stop itself, dropped by i < j)
+    k = min(neighbours + 1, n)
+    nbr = np.argpartition(d[1:, 1:], k - 1, axis=1)[:, :k] + 1 if k < n else np.tile(stops, (n, 1))
+    i = np.repeat(stops, nbr.shape[1])
+    j = nbr.ravel()
+    keep = i < j
+    code = np.unique(i[keep] * (n + 1) + j[keep])
+    i, j = code // (n + 1), code % (n + 1)
+    saving = d[0, i] + d[0, j] - d[i, j]
+    order = np.argsort(-saving, kind='stable')
+
+    route_of = {s: [s] for s in range(1, n + 1)}
+    load = {id(r): float(demand[s - 1]) for s, r in route_of.items()}
+    for a, b, s in zip(i[order], j[order], saving[order]):
+        if s <= 0:
+            break
+        ra, rb = route_of[a], route_of[b]
+        if ra is rb or load[id(ra)] + load[id(rb)] > capacity:
+            continue
+        # a and b must be route endpoints; orient so a ends ra and b starts rb
+        if ra[-1] != a:
+            if ra[0] != a: continue
+            ra.reverse()
+        if rb[0] != b:
+            if rb[-1] != b: continue
+            rb.reverse()
+        load[id(ra)] += load.pop(id(rb))
+        ra.extend(rb)
+        for s_ in rb:
+            route_of[s_] = ra
+    seen, routes = set(), []
+    for r in route_of.values():
+        if id(r) not in seen:
+            seen.add(id(r)); routes.append(r)
+    return routes
+
+def two_opt(d, route, max_passes=50):
+    """Best-improvement 2-opt over the depot-to-depot tour of ``route``; returns the new stop order."""
+    tour = np.array([0] + list(route) + [0])
+    m = len(tour)
+    if m < 5:
+        return list(tour[1:-1])
+    for _ in range(max_passes):
+        a, b = tour[:-1], tour[1:]
+        # delta of reversing tour[i+1..j]: d[a_i, a_j] + d[b_i, b_j] - d[a_i, b_i] - d[a_j, b_j]
+        delta = (d[np.ix_(a, a)] + d[np.ix_(b, b)]) - (d[a, b][:, None] + d[a, b][None, :])
+        delta = np.triu(delta, k=2)
+        i, j = np.unravel_index(np.argmin(delta), delta.shape)
+        if delta[i, j] >= -1e-6:
+            break
+        tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1]
+    return list(tour[1:-1])
+
+def route_length(d, route):
+    tour = [0] + list(route) + [0]
+    return float(sum(d[tour[x], tour[x + 1]] for x in range(len(tour) - 1)))
+
+class RoutePlanner:
+    """Plans pickup routes per partner depot, keeping one distance matrix per depot between runs."""
+
+    def __init__(self, neighbours=30):
+        self.neighbours = neighbours
+        self.matrices = {}
+
+    def plan(self, partner, requests, capacity_kg):
+        """Routes for one depot as dicts with ``stops`` (request dicts in visit order), ``load_kg`` and ``distance_km``."""
+        if not requests:
+            return []
+        dm = self.matrices.setdefault(partner['id'], DistanceMatrix())
+        dm.update([('depot', partner['id'])] + [('stop', r['id']) for r in requests],
+                  [partner['lat']] + [r['location_latitude'] for r in requests],
+                  [partner['lng']] + [r['location_longitude'] for r in requests])
+        demand = np.array([r['quantity_kg'] or 0 for r in requests], dtype=float)
+        routes = []
+        for route in _savings_routes(dm.d, demand, capacity_kg, self.neighbours):
+            route = two_opt(dm.d, route)
+            routes.append({'partner': partner, 'stops': [requests[s - 1] for s in route],
+                           'load_kg': float(demand[np.array(route) - 1].sum()),
+                           'distance_km': route_length(dm.d, route)})
+        return routes
+
+    def plan_all(self, partners, requests, capacity_kg):
+        """Group matched ``requests`` by ``partner_id`` and plan each depot."""
+        by_partner = {}
+        for r in requests:
+            if r.get('partner_id') is not None:
+                by_partner.setdefault(r['partner_id'], []).append(r)
+        routes = []
+        for p in partners:
+            routes += self.plan(p, by_partner.get(p['id'], []), capacity_kg)
+        return routes
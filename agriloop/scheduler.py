@@ -0,0 +1,155 @@
+"""Multi-day irrigation planning under a shared daily water budget.
+
+Each field is a single-bucket soil water balance: moisture is the percent
+of a ``ROOT_ZONE_MM`` root zone that holds water. Every day a field loses
+the evaporative demand of its weather (``engine.evaporation``, in mm), gains
+rain and irrigation, and is capped at field capacity. A day that ends
+below ``TRIGGER`` costs ``area * (TRIGGER - moisture)**2`` of stress.
+
+``plan_irrigation`` simulates all fields together, one vectorized step per
+day. Fields that drop below ``TRIGGER`` are topped up to ``REFILL``. With a
+daily ``budget`` (litres shared by all fields) the day's water goes to the
+driest fields first: it raises the lowest moistures to one common level
+(water filling). For this stress, that is the least-stress use of the
+day's water.
+
+``IrrigationPlanner`` keeps the inputs of a set of fields between calls.
+Callers pass every field each time and only the changed ones are
+re-planned. An unbudgeted plan re-simulates just those rows. A budget
+couples all fields, so any change reruns the whole (vectorized) plan.
+"""
+import numpy as np
+
+from agriloop.engine import MOISTURE_BANDS, evaporation
+
+ROOT_ZONE_MM = 100.0                 # plant-available water at 100% moisture
+TRIGGER, REFILL = MOISTURE_BANDS[1], MOISTURE_BANDS[2]
+LITRES_PER_POINT = ROOT_ZONE_MM * 100  # litres to raise one hectare by one moisture point (1 mm/ha = 10,000 L)
+HORIZONS = (7, 14)
+
+def _grid(x, n, days):
+    """``x`` (scalar, per-field, or per-field-per-day) as an ``(n, days)`` float array."""
+    x = np.asarray(x, dtype=float)
+    if x.ndim == 1:
+        x = x[:, None]
+    return np.array(np.broadcast_to(x, (n, days)))
+
+def _fill(moisture, litres_per_point, budget):
+    """Moisture points to add per field: dry fields to ``REFILL``, or the driest up to a common level within ``budget``."""
+    add = np.zeros(len(moisture))
+    dry = np.flatnonzero(moisture < TRIGGER)
+    if not len(dry):
+        return add
+    if budget is None or ((REFILL - moisture[dry]) * litres_per_point[dry]).sum() <= budget:
+        add[dry] = REFILL - moisture[dry]
+        return add
+    order = dry[np.argsort(moisture[dry], kind='stable')]
+    m, w = moisture[order], litres_per_point[order]
+    weight, mass = np.cumsum(w), np.cumsum(w * m)
+    # litres needed to lift the k driest fields up to the (k+1)-th driest
+    lift = m * np.concatenate(([0.0], weight[:-1])) - np.concatenate(([0.0], mass[:-1]))
+    k = np.searchsorted(lift, budget, side='right')
+    level = (budget + mass[k - 1]) / weight[k - 1]
+    add[order[:k]] = level - m[:k]
+    return add
+
+def plan_irrigation(soil_moisture, area, temp, humidity, rain_mm=0.0, days=7, budget=None):
+    """Daily irrigation for every field over ``days``.
+
+    ``temp``, ``humidity`` and ``rain_mm`` are scalars, per-field values or
+    ``(fields, days)`` forecasts. Returns a dict of arrays: ``litres`` and
+    end-of-day ``moisture`` per field per day, ``stress`` per field and the
+    daily total ``used``.
+    """
+    m = np.clip(np.asarray(soil_moisture, dtype=float), 0, 100)
+    n = len(m)
+    return _simulate(m, np.asarray(area, dtype=float), _grid(evaporation(temp, humidity), n, days),
+                     _grid(rain_mm, n, days), budget)
+
+def _simulate(moisture, area, et_mm, rain_mm, budget):
+    n, days = et_mm.shape
+    per_point = area * LITRES_PER_POINT
+    delta = (rain_mm - et_mm) * (100 / ROOT_ZONE_MM)
+    litres, level = np.zeros((n, days)), np.zeros((n, days))
+    m = moisture.copy()
+    for d in range(days):
+        m = np.clip(m + delta[:, d], 0, 100)
+        add = _fill(m, per_point, budget)
+        m += add
+        litres[:, d] = add * per_point
+        level[:, d] = m
+    stress = (area[:, None] * np.maximum(0, TRIGGER - level) ** 2).sum(axis=1)
+    return {'litres': litres, 'moisture': level, 'stress': stress, 'used': litres.sum(axis=0)}
+
+class IrrigationPlanner:
+    """Plan for a changing set of fields, re-simulating only what changed."""
+
+    def __init__(self, days=7):
+        self.days = days
+        self.ids = []
+        self._row = {}
+        self.moisture, self.area = np.zeros(0), np.zeros(0)
+        self.et, self.rain = np.zeros((0, days)), np.zeros((0, days))
+        self._dirty = np.zeros(0, dtype=bool)
+        self._result, self._budget, self._reshaped = None, None, False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, field_id):
+        return self._row.get(field_id)
+
+    def update(self, ids, soil_moisture, area, temp, humidity, rain_mm=0.0):
+        """Set the inputs of ``ids`` (columnar, same shapes as ``plan_irrigation``); fields not listed are removed.
+
+        Plan rows follow the order of ``ids``. Returns the number of fields that are new or changed.
+        """
+        ids = list(ids)
+        n = len(ids)
+        if ids != self.ids:
+            self._reindex(ids)
+        rows = np.fromiter((self._row[i] for i in ids), dtype=np.int64, count=n)
+        m, a = np.clip(np.asarray(soil_moisture, dtype=float), 0, 100), np.asarray(area, dtype=float)
+        et, rain = _grid(evaporation(temp, humidity), n, self.days), _grid(rain_mm, n, self.days)
+        changed = ((self.moisture[rows] != m) | (self.area[rows] != a)
+                   | (self.et[rows] != et).any(axis=1) | (self.rain[rows] != rain).any(axis=1))
+        r = rows[changed]
+        self.moisture[r], self.area[r], self.et[r], self.rain[r] = m[changed], a[changed], et[changed], rain[changed]
+        self._dirty[r] = True
+        return int(changed.sum())
+
+    def _reindex(self, ids):
+        """Keep the rows of surviving fields and add empty, dirty rows for new ones."""
+        keep = [(self._row[i], j) for j, i in enumerate(ids) if i in self._row]
+        old, new = (np.array(x, dtype=np.int64) for x in zip(*keep)) if keep else (np.zeros(0, np.int64),) * 2
+        n = len(ids)
+        moisture, area, et, rain = np.full(n, np.nan), np.full(n, np.nan), np.full((n, self.days), np.nan), np.full((n, self.days), np.nan)
+        moisture[new], area[new], et[new], rain[new] = self.moisture[old], self.area[old], self.et[old], self.rain[old]
+        dirty = np.ones(n, dtype=bool)
+        dirty[new] = self._dirty[old]
+        if self._result is not None:
+            result = {k: np.zeros((n,) + v.shape[1:]) for k, v in self._result.items() if k != 'used'}
+            for k in result:
+                result[k][new] = self._result[k][old]
+            self._result = {**result, 'used': self._result['used']}
+        self.ids, self._row = ids, {i: j for j, i in enumerate(ids)}
+        self.moisture, self.area, self.et, self.rain, self._dirty = moisture, area, et, rain, dirty
+        self._reshaped = True
+
+    def plan(self, budget=None):
+        """The current plan (see ``plan_irrigation``); ``ids`` gives the field of each row."""
+        # a budget couples every field, so adding or removing one changes the others' share too
+        if (self._result is None or budget != self._budget
+                or (budget is not None and (self._dirty.any() or self._reshaped))):
+            self._result = _simulate(self.moisture, self.area, self.et, self.rain, budget)
+        elif self._dirty.any() or self._reshaped:
+            rows = np.flatnonzero(self._dirty)
+            if len(rows):
+                part = _simulate(self.moisture[rows], self.area[rows], self.et[rows], self.rain[rows], None)
+                for k in ('litres', 'moisture', 'stress'):
+                    self._result[k][rows] = part[k]
+            self._result['used'] = self._result['litres'].sum(axis=0)
+        self._budget = budget
+        self._dirty[:] = False
+        self._reshaped = False
+        return self._result
@@ -0,0 +1,307 @@
+"""Append-only sensor time-series store feeding irrigation advisories.
+
+Readings are kept per crop in compact array-backed columns (int64 epoch
+seconds plus float32 metrics) that grow by doubling. Raw points older than
+the retention window are folded into hourly means, and those are dropped
+once they age out too. Every write marks the crop dirty, and
+``refresh_advisories`` re-scores only dirty crops through the batch
+irrigation engine.
+
+Readings arrive through ``write``/``write_frame``, CSV files dropped into a
+watched directory (``ingest_drop_dir``, polled by ``watch_drop_dir``) or a local HTTP endpoint
+(``start_ingest_server``) accepting CSV or NDJSON POSTs to ``/readings``.
+Each reading row has ``crop_id``, ``ts`` (ISO time or epoch seconds) and
+any of ``soil_moisture``, ``temperature``, ``humidity``, ``rainfall`` (mm
+since the previous reading).
+"""
+import glob
+import io
+import json
+import os
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from agriloop.engine import irrigation_batch
+
+METRICS = ('soil_moisture', 'temperature', 'humidity', 'rainfall')
+HOUR, DAY = 3600, 86400
+
+class Series:
+    """Growable columnar buffer of (ts, *METRICS) kept sorted by ts."""
+
+    def __init__(self, capacity=64):
+        self.n = 0
+        self.ts = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty((capacity, len(METRICS)), dtype=np.float32)
+
+    def _reserve(self, extra):
+        if self.n + extra > len(self.ts):
+            cap = max(len(self.ts) * 2, self.n + extra)
+            self.ts = np.resize(self.ts, cap)
+            self.values = np.resize(self.values, (cap, len(METRICS)))
+
+    def append(self, ts, values):
+        """Append rows (``ts`` 1-D, ``values`` n x len(METRICS), NaN = not measured)."""
+        ts, values = np.asarray(ts, dtype=np.int64), np.asarray(values, dtype=np.float32).reshape(-1, len(METRICS))
+        if not len(ts): return
+        if np.any(ts[1:] < ts[:-1]):
+            order = np.argsort(ts, kind='stable')
+            ts, values = ts[order], values[order]
+        late = self.n and ts[0] < self.ts[self.n - 1]
+        self._reserve(len(ts))
+        self.ts[self.n:self.n + len(ts)] = ts
+        self.values[self.n:self.n + len(ts)] = values
+        self.n += len(ts)
+        if late:  # out-of-order delivery: re-sort (rare; sensors normally append in time order)
+            order = np.argsort(self.ts[:self.n], kind='stable')
+            self.ts[:self.n], self.values[:self.n] = self.ts[:self.n][order], self.values[:self.n][order]
+
+    def since(self, t0):
+        i = np.searchsorted(self.ts[:self.n], t0, side='left')
+        return self.ts[i:self.n], self.values[i:self.n]
+
+    def drop_before(self, t0):
+        i = int(np.searchsorted(self.ts[:self.n], t0, side='left'))
+        if i:
+            self.ts[:self.n - i], self.values[:self.n - i] = self.ts[i:self.n].copy(), self.values[i:self.n].copy()
+            self.n -= i
+        return i
+
+    def __len__(self):
+        return self.n
+
+def downsample(ts, values, bucket_seconds):
+    """Mean of each metric per time bucket, ignoring NaNs; returns (bucket_start_ts, means)."""
+    if not len(ts):
+        return ts, values
+    b = ts // bucket_seconds
+    starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+    present = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(present, values, 0), starts, axis=0)
+    counts = np.add.reduceat(present, starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan).astype(np.float32)
+    return b[starts] * bucket_seconds, means
+
+class SensorStore:
+    """Per-crop raw + hourly-rollup series with retention, dirty tracking and cached advisories."""
+
+    def __init__(self, raw_retention=7 * DAY, rollup_retention=90 * DAY, window=HOUR, rain_window=7 * DAY):
+        self.raw_retention, self.rollup_retention = raw_retention, rollup_retention
+        self.window, self.rain_window = window, rain_window
+        self.raw, self.rollup = {}, {}
+        self.dirty = set()
+        self.advisories = {}
+        self.retained_at = 0
+        self._lock = threading.RLock()
+
+    def write(self, crop_id, ts, **metrics):
+        self.write_frame(pd.DataFrame([{'crop_id': crop_id, 'ts': ts, **metrics}]))
+
+    def write_frame(self, df):
+        """Append a frame of readings (see module docstring for columns); returns rows accepted."""
+        df = df.dropna(subset=['crop_id', 'ts'])
+        if df.empty: return 0
+        ts = _epoch(df['ts'])
+        vals = np.column_stack([pd.to_numeric(df[m], errors='coerce') if m in df else np.full(len(df), np.nan) for m in METRICS])
+        crop = pd.to_numeric(df['crop_id'], errors='coerce').to_numpy()
+        ok = ~np.isnan(crop) & (ts > 0)
+        crop, ts, vals = crop[ok].astype(np.int64), ts[ok], vals[ok]
+        order = np.lexsort((ts, crop))
+        crop, ts, vals = crop[order], ts[order], vals[order]
+        starts = np.flatnonzero(np.r_[True, crop[1:] != crop[:-1]]) if len(crop) else []
+        with self._lock:
+            for s, e in zip(starts, np.r_[starts[1:], len(crop)]):
+                cid = int(crop[s])
+                self.raw.setdefault(cid, Series()).append(ts[s:e], vals[s:e])
+                self.dirty.add(cid)
+        return int(len(crop))
+
+    def apply_retention(self, now=None, min_interval=0):
+        """Fold raw points past ``raw_retention`` into hourly means; drop rollups past ``rollup_retention``.
+
+        Skipped if the last pass ran less than ``min_interval`` seconds ago.
+        """
+        now = int(now or time.time())
+        if now - self.retained_at < min_interval:
+            return
+        with self._lock:
+            self.retained_at = now
+            for cid, series in self.raw.items():
+                cut = now - self.raw_retention
+                old_ts, old_vals = series.ts[:series.n], series.values[:series.n]
+                k = int(np.searchsorted(old_ts, cut, side='left'))
+                if k:
+                    self.rollup.setdefault(cid, Series()).append(*downsample(old_ts[:k], old_vals[:k], HOUR))
+                    series.drop_before(cut)
+            for series in self.rollup.values():
+                series.drop_before(now - self.rollup_retention)
+
+    def latest(self, crop_id, now=None):
+        """Advisory inputs from recent readings: window means, rainfall summed over ``rain_window``; None if no data."""
+        with self._lock:
+            series = self.raw.get(crop_id)
+            if not series:
+                return None
+            now = int(now or series.ts[series.n - 1])
+            _, recent = series.since(now - self.window)
+            if not len(recent):
+                recent = series.values[series.n - 1:series.n]
+            _, rain = series.since(now - self.rain_window)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN metric -> NaN, filled by the caller
+                means = np.nanmean(recent, axis=0)
+            out = dict(zip(METRICS, means.tolist()))
+            out['rainfall'] = float(np.nansum(rain[:, METRICS.index('rainfall')]))
+            out['ts'] = int(series.ts[series.n - 1])
+            return out
+
+    def history(self, crop_id, since, bucket_seconds=HOUR):
+        """Downsampled readings for charts, merging hourly rollups with raw data."""
+        with self._lock:
+            parts = [s.since(since) for s in (self.rollup.get(crop_id), self.raw.get(crop_id)) if s]
+        if not parts:
+            return pd.DataFrame(columns=['ts', *METRICS])
+        ts, vals = downsample(np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]), bucket_seconds)
+        df = pd.DataFrame(vals, columns=list(METRICS))
+        df.insert(0, 'ts', pd.to_datetime(ts, unit='s'))
+        return df
+
+    def refresh_advisories(self, crops, weather=None):
+        """Re-score dirty crops among ``crops`` (dicts with id, area_hectares) in one batch; returns ids updated.
+
+        Crops whose recent readings carry no soil moisture are skipped.
+
+        ``weather(crops)``, if given, returns per-crop ``{temperature, humidity, rainfall}`` (or None)
+        used for metrics the sensors did not report.
+        """
+        with self._lock:
+            todo = [c for c in crops if c['id'] in self.dirty]
+            inputs = [(c, self.latest(c['id'])) for c in todo]
+            # without a moisture reading there is nothing to score: crops that only sent
+            # weather keep their previous advisory (if any) until moisture arrives
+            inputs = [(c, x) for c, x in inputs if x is not None and not np.isnan(x['soil_moisture'])]
+            self.dirty.difference_update(c['id'] for c in todo)
+        if not inputs:
+            return []
+        # the weather lookup may go to the network, so it runs outside the lock; readings that
+        # arrive meanwhile mark their crop dirty again and are picked up by the next refresh
+        gaps = [c for c, x in inputs if any(np.isnan(x[m]) for m in ('temperature', 'humidity', 'rainfall'))]
+        fill = dict(zip((c['id'] for c in gaps), weather(gaps))) if weather and gaps else {}
+        col = lambda m, default: [x[m] if not np.isnan(x[m]) else (fill.get(c['id']) or {}).get(m, default) for c, x in inputs]
+        sm = [x['soil_moisture'] for _, x in inputs]
+        batch = irrigation_batch(sm, col('temperature', 25.0), col('humidity', 60.0),
+                                 col('rainfall', 0.0), [c['area_hectares'] for c, _ in inputs])
+        with self._lock:
+            for i, (c, x) in enumerate(inputs):
+                if self.advisories.get(c['id'], {}).get('ts', -1) <= x['ts']:
+                    self.advisories[c['id']] = {'ts': x['ts'], 'soil_moisture': round(sm[i], 1), 'inputs': x,
+                                                **{k: batch[k][i] for k in ('volume', 'frequency', 'level', 'urgency', 'risks')}}
+        return [c['id'] for c, _ in inputs]
+
+def _epoch(col):
+    num = pd.to_numeric(col, errors='coerce')
+    parsed = pd.to_datetime(col.where(num.isna()), errors='coerce', utc=True)
+    secs = (parsed - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    return num.fillna(secs).fillna(0).to_numpy(dtype=np.int64)
+
+# ============ INGEST ============
+def import_readings(store, source, filename, crop_ids, chunksize=50_000, max_errors=10_000):
+    """Bulk-load readings via the importer's chunked reader, rejecting crops outside ``crop_ids``."""
+    from agriloop.importer import iter_chunks
+    inserted = rejected = seen = 0
+    errors = []
+    for chunk in iter_chunks(source, filename, chunksize):
+        if 'crop_id' not in chunk or 'ts' not in chunk:
+            raise ValueError("missing required column(s): crop_id, ts")
+        rows = np.arange(seen + 1, seen + 1 + len(chunk))
+        seen += len(chunk)
+        known = pd.to_numeric(chunk['crop_id'], errors='coerce').isin(list(crop_ids)).to_numpy()
+        accepted = store.write_frame(chunk[known])
+        inserted += accepted
+        rejected += len(chunk) - accepted
+        errors += [(int(r), "unknown crop_id") for r in rows[~known][:max_errors - len(errors)]]
+    return {'inserted': inserted, 'rejected': rejected, 'errors': pd.DataFrame(errors, columns=['row', 'error'])}
+
+def ingest_drop_dir(store, path, min_age=2.0):
+    """Load every ``*.csv`` in ``path`` and rename it to ``*.csv.done``; returns readings accepted.
+
+    Each file is first claimed by renaming it to ``*.csv.processing``, so
+    concurrent callers never load the same file twice. Files modified in the
+    last ``min_age`` seconds are left for the next pass, as the producer may
+    still be writing them (producers should still write elsewhere and rename
+    into ``path``). A file that fails to parse is renamed ``*.csv.failed``
+    with none of its readings kept.
+    """
+    total = 0
+    for f in sorted(glob.glob(os.path.join(path, "*.csv"))):
+        claimed = f + ".processing"
+        try:
+            if time.time() - os.path.getmtime(f) < min_age:
+                continue
+            os.replace(f, claimed)
+        except FileNotFoundError:  # claimed by another caller
+            continue
+        try:
+            chunks = list(pd.read_csv(claimed, chunksize=50_000))
+            if chunks and not {'crop_id', 'ts'} <= set(chunks[0].columns):
+                raise ValueError("missing required column(s): crop_id, ts")
+        except (ValueError, pd.errors.ParserError):
+            os.replace(claimed, f + ".failed")
+            continue
+        total += sum(store.write_frame(chunk) for chunk in chunks)
+        os.replace(claimed, f + ".done")
+    return total
+
+def watch_drop_dir(store, path, interval=5.0):
+    """Run ``ingest_drop_dir`` on ``path`` every ``interval`` seconds on a daemon thread; returns the thread.
+
+    The directory need not exist yet; it is picked up once created.
+    """
+    def loop():
+        while True:
+            try:
+                if os.path.isdir(path):
+                    ingest_drop_dir(store, path)
+            except OSError:
+                pass  # e.g. the directory was removed mid-pass; retry on the next one
+            time.sleep(interval)
+    thread = threading.Thread(target=loop, daemon=True, name="sensor-drop")
+    thread.start()
+    return thread
+
+def start_ingest_server(store, port, host="127.0.0.1"):
+    """Serve ``POST /readings`` (text/csv or NDJSON) on a daemon thread; returns the server."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.rstrip("/") != "/readings":
+                return self._reply(404, {"error": "not found"})
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+            try:
+                if "csv" in (self.headers.get("Content-Type") or ""):
+                    df = pd.read_csv(io.StringIO(body))
+                else:
+                    df = pd.DataFrame([json.loads(line) for line in body.splitlines() if line.strip()])
+                self._reply(200, {"accepted": store.write_frame(df)})
+            except (ValueError, KeyError) as e:
+                self._reply(400, {"error": str(e)})
+
+        def _reply(self, code, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="sensor-ingest").start()
+    return server
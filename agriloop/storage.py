@@ -0,0 +1,842 @@
+"""Pluggable repository layer for app entities.
+
+Two interchangeable backends implement the same small API:
+
+* ``MemoryRepository`` keeps everything in process memory (tests, demos).
+* ``SqliteRepository`` persists to an embedded SQLite file in WAL mode with
+  indexes on the owner, farm, status and timestamp columns, a small pool of
+  reusable connections and parameterized statements that hit sqlite's
+  prepared-statement cache.
+
+``open_repository()`` picks the backend from the ``AGRILOOP_DB`` environment
+variable: ``memory`` for the in-memory store, anything else is a SQLite path
+(default ``agriloop.db``).
+
+Derived structures that must follow a table incrementally (rather than
+rebuilding when its ``version`` moves) can ``subscribe`` to its writes.
+"""
+import heapq
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+# ============ SCHEMA ============
+# table -> (primary key, [(column, sqlite type), ...], [indexed columns or column tuples])
+SCHEMA = {
+    'users': ('username', [('username', 'TEXT'), ('password', 'TEXT'), ('email', 'TEXT'), ('full_name', 'TEXT'),
+                           ('role', 'TEXT'), ('phone', 'TEXT'), ('created_at', 'TEXT')],
+              ['role', 'created_at']),
+    'farms': ('id', [('id', 'INTEGER'), ('name', 'TEXT'), ('area_hectares', 'REAL'), ('location_latitude', 'REAL'),
+                     ('location_longitude', 'REAL'), ('location_address', 'TEXT'), ('soil_type', 'TEXT'),
+                     ('owner', 'TEXT'), ('created_at', 'TEXT')],
+              ['owner', 'created_at']),
+    'crops': ('id', [('id', 'INTEGER'), ('farm_id', 'INTEGER'), ('crop_name', 'TEXT'), ('area_hectares', 'REAL'),
+                     ('planting_date', 'TEXT'), ('expected_harvest_date', 'TEXT'), ('status', 'TEXT'),
+                     ('owner', 'TEXT'), ('created_at', 'TEXT')],
+              ['owner', 'farm_id', 'status', 'created_at', ('owner', 'status')]),
+    'advisories': ('id', [('id', 'INTEGER'), ('user', 'TEXT'), ('crop_id', 'INTEGER'), ('type', 'TEXT'),
+                          ('status', 'TEXT'), ('recommendation', 'TEXT'), ('volume', 'REAL'),
+                          ('frequency', 'INTEGER'), ('created_at', 'TEXT'), ('level', 'INTEGER'),
+                          ('soil_moisture', 'REAL')],
+                   ['user', 'crop_id', 'status', 'created_at']),
+    'surplus_listings': ('id', [('id', 'INTEGER'), ('user', 'TEXT'), ('crop_id', 'INTEGER'), ('crop', 'TEXT'),
+                                ('quantity', 'NUMERIC'), ('harvest_date', 'TEXT'), ('unit_price', 'REAL'),
+                                ('status', 'TEXT'), ('created_at', 'TEXT')],
+                         ['user', 'crop_id', 'status', 'created_at']),
+    'waste_requests': ('id', [('id', 'INTEGER'), ('user', 'TEXT'), ('waste_type', 'TEXT'), ('quantity_kg', 'NUMERIC'),
+                              ('location_latitude', 'REAL'), ('location_longitude', 'REAL'),
+                              ('location_address', 'TEXT'), ('status', 'TEXT'), ('partner_id', 'INTEGER'),
+                              ('created_at', 'TEXT'), ('matched_at', 'TEXT')],
+                       ['user', 'status', 'partner_id', 'created_at']),
+    'partners': ('id', [('id', 'INTEGER'), ('name', 'TEXT'), ('type', 'TEXT'), ('capacity', 'NUMERIC'),
+                        ('lat', 'REAL'), ('lng', 'REAL'), ('rating', 'NUMERIC')],
+                 ['type']),
+}
+
+# Equality lookups the in-memory backend answers from maintained hash indexes
+# instead of a full scan; the widest index covered by a query's filters wins.
+HASH_INDEXES = {
+    'users': [('role',)],
+    'farms': [('owner',)],
+    'crops': [('owner',), ('farm_id',), ('status',), ('owner', 'status')],
+    'advisories': [('user',), ('crop_id',)],
+    'surplus_listings': [('user',), ('crop_id',), ('status',)],
+    'waste_requests': [('user',), ('status',), ('partner_id',)],
+    'partners': [('type',)],
+}
+
+# Range scans (``before``) the in-memory backend answers from a maintained
+# ordering instead of a full scan (see ``_OrderedIndex``).
+ORDERED_INDEXES = {
+    'advisories': ['created_at'],
+}
+
+# Per-value row counts kept up to date on every write (SQLite: triggers into
+# "_aggregates"; memory: the matching hash index buckets). Table totals are
+# always maintained too.
+AGGREGATES = {
+    'users': ['role'],
+    'crops': ['status'],
+    'surplus_listings': ['status'],
+    'waste_requests': ['status'],
+}
+
+# Rows removed together with the row they reference: parent table ->
+# [(child table, referencing column)]. ``delete_cascade`` follows these
+# through the hash/SQL indexes on the referencing columns, so its cost is
+# proportional to the rows it deletes.
+CASCADES = {
+    'users': [('farms', 'owner'), ('crops', 'owner'), ('advisories', 'user'), ('surplus_listings', 'user'),
+              ('waste_requests', 'user')],
+    'farms': [('crops', 'farm_id')],
+    'crops': [('advisories', 'crop_id'), ('surplus_listings', 'crop_id')],
+}
+
+# Text columns matched by the ``search`` argument of ``page``.
+SEARCH_COLUMNS = {
+    'users': ['username', 'email', 'full_name'],
+    'farms': ['name', 'owner', 'location_address'],
+    'crops': ['crop_name', 'owner'],
+    'advisories': ['user', 'type'],
+    'surplus_listings': ['user', 'crop'],
+    'waste_requests': ['user', 'waste_type'],
+    'partners': ['name', 'type'],
+}
+
+def key_of(table): return SCHEMA[table][0]
+def columns_of(table): return [c for c, _ in SCHEMA[table][1]]
+def _q(col): return f'"{col}"'
+
+class DuplicateKeyError(Exception):
+    pass
+
+class RWLock:
+    """Any number of readers or one writer; a waiting writer holds back new readers.
+
+    Reentrant on both sides, and the writing thread may also read. A reader
+    cannot upgrade to writing.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0     # threads holding the read side
+        self._writer = None   # ident of the thread holding the write side
+        self._waiting = 0     # writers queued
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        depth = getattr(self._local, 'reads', 0)
+        if self._writer == threading.get_ident():
+            yield
+            return
+        if not depth:
+            with self._cond:
+                while self._writer is not None or self._waiting:
+                    self._cond.wait()
+                self._readers += 1
+        self._local.reads = depth + 1
+        try:
+            yield
+        finally:
+            self._local.reads = depth
+            if not depth:
+                with self._cond:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        if getattr(self._local, 'reads', 0):
+            raise RuntimeError("cannot take the write lock while holding the read lock")
+        with self._cond:
+            self._waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+def _cascade(table, keys, referencing):
+    """``{table: [keys]}`` for ``keys`` and every row reached from them through ``CASCADES``.
+
+    ``referencing(child, column, values)`` returns the keys of the ``child`` rows whose ``column`` is in ``values``.
+    """
+    doomed = {table: dict.fromkeys(keys)}
+    todo = [(table, list(doomed[table]))]
+    while todo:
+        parent, parent_keys = todo.pop()
+        for child, column in CASCADES.get(parent, ()):
+            seen = doomed.setdefault(child, {})
+            new = [k for k in referencing(child, column, parent_keys) if k not in seen]
+            if new:
+                seen.update(dict.fromkeys(new))
+                todo.append((child, new))
+    return {t: list(ks) for t, ks in doomed.items() if ks}
+
+# ============ IN-MEMORY BACKEND ============
+class _OrderedIndex:
+    """``(value, key)`` pairs of one column kept in sorted order for range scans.
+
+    Writes only append to an unsorted tail or count a dead entry; the tail
+    is merged in at the next scan, and entries whose row is gone or has
+    moved are skipped then (dropped for good once they outnumber the live
+    ones, or as soon as they reach the front). Scans may run under the
+    store's shared lock, so they serialize on their own lock.
+    """
+
+    def __init__(self, column):
+        self.column = column
+        self.entries, self.start, self.tail, self.dead = [], 0, [], 0
+        self._lock = threading.Lock()
+
+    def add(self, key, row):
+        if row[self.column] is not None:
+            self.tail.append((row[self.column], key))
+
+    def remove(self):
+        self.dead += 1
+
+    def before(self, rows, value, limit):
+        """Keys of up to ``limit`` rows whose column is below ``value``, lowest first."""
+        live = lambda v, k: k in rows and rows[k][self.column] == v
+        with self._lock:
+            if self.dead > max(1024, (len(self.entries) - self.start) // 2):
+                self.entries, self.start, self.dead = sorted(set(e for e in self.entries[self.start:] if live(*e))), 0, 0
+            if self.tail:
+                self.entries, self.start = sorted(self.entries[self.start:] + self.tail), 0
+                self.tail = []
+            out, seen, i, n = [], set(), self.start, len(self.entries)
+            while i < n and len(out) < limit:
+                v, k = self.entries[i]
+                if v >= value:
+                    break
+                if live(v, k):
+                    if k not in seen:
+                        seen.add(k)
+                        out.append(k)
+                elif i == self.start:
+                    self.start += 1
+                i += 1
+            return out
+
+class MemoryRepository:
+    """Dict-of-dicts store; rows are copied in and out so callers never alias stored state.
+
+    Every table keeps the hash indexes listed in ``HASH_INDEXES``, mapping a
+    tuple of column values to an insertion-ordered set of primary keys. They
+    are updated on insert, update and delete, so ``find`` costs as much as the
+    matching rows rather than the whole table. Columns listed in
+    ``ORDERED_INDEXES`` also keep a sorted ordering for ``before``.
+
+    ``version(table)`` is bumped on every write so derived structures (spatial
+    indexes, cached frames) know when to rebuild.
+
+    ``subscribe(table, fn)`` calls ``fn(op, items, version)`` after every
+    write: ``op`` is ``insert`` (items are the stored rows), ``update``
+    (``(key, changes)`` pairs) or ``delete`` (keys), and ``version`` is the
+    table version the write produced. Memory listeners run under the store
+    lock; SQLite listeners run after the transaction commits.
+
+    One instance is meant to be shared by every session of the process:
+    reads take the shared side of an ``RWLock`` and never wait for each
+    other, writes take the exclusive side and are serialized.
+    """
+
+    def __init__(self):
+        self._tables = {t: {} for t in SCHEMA}
+        self._next_id = {t: 1 for t in SCHEMA}
+        self._indexes = {t: {cols: {} for cols in HASH_INDEXES[t]} for t in SCHEMA}
+        self._ordered = {t: {c: _OrderedIndex(c) for c in ORDERED_INDEXES.get(t, ())} for t in SCHEMA}
+        self._versions = {t: 0 for t in SCHEMA}
+        self._sorted = {}  # table -> (version, query, sorted keys) for page()
+        self._subscribers = {t: [] for t in SCHEMA}
+        self._lock = RWLock()
+
+    def version(self, table):
+        return self._versions[table]
+
+    def subscribe(self, table, fn):
+        with self._lock.write():
+            self._subscribers[table].append(fn)
+
+    def _notify(self, table, op, items):
+        for fn in self._subscribers[table]:
+            fn(op, items, self._versions[table])
+
+    def _exact_index(self, table, filters):
+        for cols, index in self._indexes[table].items():
+            if set(cols) == filters.keys():
+                return index, tuple(filters[c] for c in cols)
+        return None, None
+
+    def _index_add(self, table, key, row):
+        for cols, index in self._indexes[table].items():
+            index.setdefault(tuple(row[c] for c in cols), {})[key] = None
+        for ordered in self._ordered[table].values():
+            ordered.add(key, row)
+
+    def _index_remove(self, table, key, row):
+        for cols, index in self._indexes[table].items():
+            vals = tuple(row[c] for c in cols)
+            bucket = index.get(vals)
+            if bucket is not None:
+                bucket.pop(key, None)
+                if not bucket: del index[vals]
+        for ordered in self._ordered[table].values():
+            ordered.remove()
+
+    def _candidates(self, table, filters):
+        """Rows that may match ``filters``: an index bucket if one applies, else the whole table."""
+        rows = self._tables[table]
+        best = max((cols for cols in self._indexes[table] if set(cols) <= filters.keys()), key=len, default=None)
+        if best is None:
+            return list(rows.values())
+        bucket = self._indexes[table][best].get(tuple(filters[c] for c in best), {})
+        return [rows[k] for k in bucket]
+
+    def insert(self, table, row, or_ignore=False):
+        k = key_of(table)
+        row = {c: row.get(c) for c in columns_of(table)}
+        with self._lock.write():
+            rows = self._tables[table]
+            if row[k] is None:
+                row[k] = self._next_id[table]
+            if row[k] in rows:
+                if or_ignore: return dict(rows[row[k]])
+                raise DuplicateKeyError(f"{table}: {row[k]!r} already exists")
+            if isinstance(row[k], int):
+                self._next_id[table] = max(self._next_id[table], row[k] + 1)
+            rows[row[k]] = row
+            self._index_add(table, row[k], row)
+            self._versions[table] += 1
+            self._notify(table, 'insert', [dict(row)])
+        return dict(row)
+
+    def insert_many(self, table, rows):
+        """Insert a batch of new rows as one write, allocating their ids as one block; returns the ids."""
+        k = key_of(table)
+        rows = [{c: r.get(c) for c in columns_of(table)} for r in rows]
+        if not rows: return []
+        with self._lock.write():
+            stored = self._tables[table]
+            if dict(SCHEMA[table][1])[k] == 'INTEGER':
+                top = self._next_id[table]
+                for key, row in enumerate(rows, top):
+                    row[k] = key
+                self._next_id[table] = top + len(rows)
+            elif len({r[k] for r in rows}) < len(rows) or any(r[k] in stored for r in rows):
+                raise DuplicateKeyError(f"{table}: duplicate key in batch")
+            for row in rows:
+                stored[row[k]] = row
+                self._index_add(table, row[k], row)
+            self._versions[table] += 1
+            self._notify(table, 'insert', [dict(r) for r in rows])
+        return [r[k] for r in rows]
+
+    def get(self, table, key):
+        row = self._tables[table].get(key)
+        return dict(row) if row is not None else None
+
+    def find(self, table, **filters):
+        with self._lock.read():
+            rows = self._candidates(table, filters)
+            return [dict(r) for r in rows if all(r.get(c) == v for c, v in filters.items())]
+
+    def scan(self, table, columns, **filters):
+        """``columns`` of every matching row as tuples; cheaper than ``find`` for bulk loads."""
+        with self._lock.read():
+            return [tuple(r[c] for c in columns) for r in self._candidates(table, filters)
+                    if all(r.get(c) == v for c, v in filters.items())]
+
+    def before(self, table, column, value, limit):
+        """Up to ``limit`` rows whose ``column`` is below ``value``, lowest first; None never matches."""
+        k = key_of(table)
+        with self._lock.read():
+            rows, ordered = self._tables[table], self._ordered[table].get(column)
+            if ordered is not None:
+                return [dict(rows[key]) for key in ordered.before(rows, value, limit)]
+            matching = (r for r in rows.values() if r[column] is not None and r[column] < value)
+            return [dict(r) for r in heapq.nsmallest(limit, matching, key=lambda r: (r[column], r[k]))]
+
+    def chunks(self, table, size=5000, since=None, until=None, **filters):
+        """Matching rows in key order, ``size`` at a time; ``since <= created_at < until`` when given.
+
+        Each chunk is read separately, so writers are not held up for the
+        whole walk and rows written meanwhile may or may not be included.
+        """
+        k = key_of(table)
+        with self._lock.read():
+            keys = sorted(r[k] for r in self._candidates(table, filters))
+        match = lambda r: (r is not None and all(r.get(c) == v for c, v in filters.items())
+                           and (since is None or (r['created_at'] or '') >= since)
+                           and (until is None or (r['created_at'] or '') < until))
+        for lo in range(0, len(keys), size):
+            with self._lock.read():
+                rows = [dict(r) for r in map(self._tables[table].get, keys[lo:lo + size]) if match(r)]
+            if rows:
+                yield rows
+
+    def count(self, table, **filters):
+        if not filters: return len(self._tables[table])
+        index, vals = self._exact_index(table, filters)
+        if index is not None: return len(index.get(vals, ()))
+        return len(self.find(table, **filters))
+
+    def aggregate(self, table, column):
+        """``{value: row count}`` for ``column``, read from its maintained index when there is one."""
+        with self._lock.read():
+            index = self._indexes[table].get((column,))
+            if index is not None:
+                return {vals[0]: len(bucket) for vals, bucket in index.items()}
+            counts = {}
+            for r in self._tables[table].values():
+                counts[r[column]] = counts.get(r[column], 0) + 1
+            return counts
+
+    def page(self, table, offset=0, limit=50, order_by=None, descending=False, search=None, **filters):
+        """One page of rows plus the total match count: ``(rows, total)``.
+
+        The sorted key list for a query is cached until the table's version
+        changes, so paging through a large table sorts it once.
+        """
+        query = (order_by, descending, search, tuple(sorted(filters.items())))
+        with self._lock.read():
+            version = self._versions[table]
+            cached = self._sorted.get(table)
+            if not cached or cached[0] != version or cached[1] != query:
+                rows = [r for r in self._candidates(table, filters) if all(r.get(c) == v for c, v in filters.items())]
+                if search:
+                    needle = search.lower()
+                    rows = [r for r in rows if any(needle in str(r[c] or '').lower() for c in SEARCH_COLUMNS[table])]
+                k = key_of(table)
+                if order_by:
+                    # None sorts last in either direction, ties broken by key
+                    present = sorted((r for r in rows if r[order_by] is not None), key=lambda r: (r[order_by], r[k]), reverse=descending)
+                    rows = present + [r for r in rows if r[order_by] is None]
+                else:
+                    rows = sorted(rows, key=lambda r: r[k], reverse=descending)
+                cached = self._sorted[table] = (version, query, [r[k] for r in rows])
+            keys = cached[2]
+            return [dict(self._tables[table][k]) for k in keys[offset:offset + limit]], len(keys)
+
+    def update(self, table, key, **changes):
+        with self._lock.write():
+            row = self._tables[table].get(key)
+            if row is not None:
+                self._index_remove(table, key, row)
+                row.update({c: v for c, v in changes.items() if c in row})
+                self._index_add(table, key, row)
+                self._versions[table] += 1
+                self._notify(table, 'update', [(key, changes)])
+
+    def update_many(self, table, updates):
+        """Apply ``[(key, {column: value}), ...]`` as one batch under a single lock."""
+        with self._lock.write():
+            for key, changes in updates:
+                self.update(table, key, **changes)
+
+    def delete(self, table, key):
+        with self._lock.write():
+            row = self._tables[table].pop(key, None)
+            if row is not None:
+                self._index_remove(table, key, row)
+                self._versions[table] += 1
+                self._notify(table, 'delete', [key])
+
+    def delete_many(self, table, keys):
+        """Delete every row in ``keys`` as one write."""
+        with self._lock.write():
+            deleted = []
+            for key in keys:
+                row = self._tables[table].pop(key, None)
+                if row is not None:
+                    self._index_remove(table, key, row)
+                    deleted.append(key)
+            if deleted:
+                self._versions[table] += 1
+                self._notify(table, 'delete', deleted)
+
+    def _referencing(self, table, column, values):
+        index = self._indexes[table].get((column,))
+        if index is None:
+            values = set(values)
+            return [k for k, r in self._tables[table].items() if r[column] in values]
+        return [k for v in values for k in index.get((v,), ())]
+
+    def delete_cascade(self, table, keys):
+        """Delete ``keys`` and every row depending on them (``CASCADES``) as one write; returns ``{table: rows deleted}``."""
+        with self._lock.write():
+            doomed = _cascade(table, [k for k in keys if k in self._tables[table]], self._referencing)
+            for t, ks in doomed.items():
+                self.delete_many(t, ks)
+            return {t: len(ks) for t, ks in doomed.items()}
+
+    def delete_where(self, table, **filters):
+        k = key_of(table)
+        with self._lock.write():
+            self.delete_many(table, [r[k] for r in self.find(table, **filters)])
+
+# ============ SQLITE BACKEND ============
+@lru_cache(maxsize=None)
+def _select_sql(table, cols):
+    where = " AND ".join(f"{_q(c)} = ?" for c in cols)
+    return f'SELECT * FROM "{table}"' + (f" WHERE {where}" if where else "") + f' ORDER BY "{key_of(table)}"'
+
+@lru_cache(maxsize=None)
+def _count_sql(table, cols):
+    where = " AND ".join(f"{_q(c)} = ?" for c in cols)
+    return f'SELECT COUNT(*) FROM "{table}"' + (f" WHERE {where}" if where else "")
+
+@lru_cache(maxsize=None)
+def _insert_sql(table, with_key, or_ignore):
+    cols = [c for c in columns_of(table) if with_key or c != key_of(table)]
+    verb = "INSERT OR IGNORE" if or_ignore else "INSERT"
+    return f'{verb} INTO "{table}" ({", ".join(map(_q, cols))}) VALUES ({", ".join("?" * len(cols))})', cols
+
+@lru_cache(maxsize=None)
+def _update_sql(table, cols):
+    return f'UPDATE "{table}" SET {", ".join(f"{_q(c)} = ?" for c in cols)} WHERE "{key_of(table)}" = ?'
+
+@lru_cache(maxsize=None)
+def _delete_sql(table, cols):
+    where = " AND ".join(f"{_q(c)} = ?" for c in cols)
+    return f'DELETE FROM "{table}"' + (f" WHERE {where}" if where else "")
+
+class SqliteRepository:
+    """SQLite-backed store. Safe to share between sessions and threads.
+
+    Table versions live in a ``_versions`` table bumped inside each write's
+    transaction, so they stay correct when other processes share the file.
+    Row totals and the ``AGGREGATES`` per-value counts are maintained by
+    triggers in ``_aggregates``, so counting never scans a table.
+    Subscribers only hear about writes made through this object, so
+    ``version`` is still the way to notice other processes' writes.
+    """
+
+    def __init__(self, path, pool_size=8):
+        self.path = path
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._subscribers = {t: [] for t in SCHEMA}
+        with self._conn() as conn:
+            self._create_schema(conn)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def _conn(self):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def _create_schema(self, conn):
+        for table, (key, cols, indexed) in SCHEMA.items():
+            pk = {'INTEGER': " PRIMARY KEY AUTOINCREMENT", 'TEXT': " PRIMARY KEY"}
+            defs = [f"{_q(c)} {t}{pk[t] if c == key else ''}" for c, t in cols]
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({", ".join(defs)})')
+            have = {r[1] for r in conn.execute(f'PRAGMA table_info("{table}")')}
+            for c, t in cols:
+                if c not in have:
+                    conn.execute(f'ALTER TABLE "{table}" ADD COLUMN {_q(c)} {t}')
+            for cols in indexed:
+                cols = cols if isinstance(cols, tuple) else (cols,)
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table}_{"_".join(cols)}" ON "{table}" ({", ".join(map(_q, cols))})')
+        conn.execute('CREATE TABLE IF NOT EXISTS "_versions" ("name" TEXT PRIMARY KEY, "version" INTEGER NOT NULL)')
+        conn.executemany('INSERT OR IGNORE INTO "_versions" VALUES (?, 0)', [(t,) for t in SCHEMA])
+        conn.execute('CREATE TABLE IF NOT EXISTS "_aggregates" ("tbl" TEXT, "col" TEXT, "val", "n" INTEGER NOT NULL, '
+                     'PRIMARY KEY ("tbl", "col", "val"))')
+        for table in SCHEMA:
+            self._create_aggregate_triggers(conn, table)
+
+    def _create_aggregate_triggers(self, conn, table):
+        """(Re)build the counting triggers for ``table`` and backfill its counts if they changed."""
+        cols = AGGREGATES.get(table, [])
+        tag = f"agg_{table}_{'_'.join(cols) or 'total'}"
+        existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name GLOB ?", (f"agg_{table}_*",))}
+        if existing == {f"{tag}_ins", f"{tag}_del"} | ({f"{tag}_upd"} if cols else set()):
+            return
+        for name in existing:
+            conn.execute(f'DROP TRIGGER "{name}"')
+        bump = lambda col, expr, delta: (f'INSERT INTO "_aggregates" VALUES (\'{table}\', \'{col}\', COALESCE({expr}, \'\'), {delta}) '
+                                         f'ON CONFLICT DO UPDATE SET "n" = "n" + {delta};')
+        conn.execute(f'CREATE TRIGGER "{tag}_ins" AFTER INSERT ON "{table}" BEGIN {bump("*", "NULL", 1)} '
+                     + " ".join(bump(c, f"NEW.{_q(c)}", 1) for c in cols) + " END")
+        conn.execute(f'CREATE TRIGGER "{tag}_del" AFTER DELETE ON "{table}" BEGIN {bump("*", "NULL", -1)} '
+                     + " ".join(bump(c, f"OLD.{_q(c)}", -1) for c in cols) + " END")
+        if cols:
+            conn.execute(f'CREATE TRIGGER "{tag}_upd" AFTER UPDATE OF {", ".join(map(_q, cols))} ON "{table}" BEGIN '
+                         + " ".join(bump(c, f"OLD.{_q(c)}", -1) + " " + bump(c, f"NEW.{_q(c)}", 1) for c in cols) + " END")
+        conn.execute('DELETE FROM "_aggregates" WHERE "tbl" = ?', (table,))
+        conn.execute(f'INSERT INTO "_aggregates" SELECT ?, \'*\', \'\', COUNT(*) FROM "{table}"', (table,))
+        for c in cols:
+            conn.execute(f'INSERT INTO "_aggregates" SELECT ?, ?, COALESCE({_q(c)}, \'\'), COUNT(*) FROM "{table}" GROUP BY 3', (table, c))
+
+    def _bump(self, conn, table):
+        return conn.execute('UPDATE "_versions" SET "version" = "version" + 1 WHERE "name" = ? RETURNING "version"', (table,)).fetchall()[0][0]
+
+    def subscribe(self, table, fn):
+        self._subscribers[table].append(fn)
+
+    def _notify(self, table, op, items, version):
+        for fn in self._subscribers[table]:
+            fn(op, items, version)
+
+    def version(self, table):
+        with self._conn() as conn:
+            return conn.execute('SELECT "version" FROM "_versions" WHERE "name" = ?', (table,)).fetchone()[0]
+
+    def insert(self, table, row, or_ignore=False):
+        k = key_of(table)
+        sql, cols = _insert_sql(table, row.get(k) is not None, or_ignore)
+        with self._conn() as conn:
+            try:
+                cur = conn.execute(sql, [row.get(c) for c in cols])
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(f"{table}: {row.get(k)!r} already exists") from e
+            key = row.get(k) if row.get(k) is not None else cur.lastrowid
+            version = self._bump(conn, table) if cur.rowcount else None
+        stored = self.get(table, key)
+        if version is not None:
+            self._notify(table, 'insert', [stored], version)
+        return stored
+
+    def insert_many(self, table, rows):
+        """Insert a batch of new rows in one transaction; returns their keys.
+
+        Integer ids are allocated as a contiguous block above both the current
+        maximum and the AUTOINCREMENT high-water mark, so ids of deleted rows
+        are never handed out again.
+        """
+        k = key_of(table)
+        if not rows: return []
+        sql, cols = _insert_sql(table, True, False)
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if dict(SCHEMA[table][1])[k] == 'INTEGER':
+                top = conn.execute(f'SELECT MAX(COALESCE((SELECT "seq" FROM sqlite_sequence WHERE "name" = ?), 0), '
+                                   f'COALESCE((SELECT MAX({_q(k)}) FROM "{table}"), 0))', (table,)).fetchone()[0]
+                keys = list(range(top + 1, top + 1 + len(rows)))
+            else:
+                keys = [r[k] for r in rows]
+            try:
+                conn.executemany(sql, [[key if c == k else r.get(c) for c in cols] for key, r in zip(keys, rows)])
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(f"{table}: duplicate key in batch") from e
+            version = self._bump(conn, table)
+        if self._subscribers[table]:
+            self._notify(table, 'insert', [{c: key if c == k else r.get(c) for c in columns_of(table)}
+                                           for key, r in zip(keys, rows)], version)
+        return keys
+
+    def get(self, table, key):
+        with self._conn() as conn:
+            row = conn.execute(_select_sql(table, (key_of(table),)), (key,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def find(self, table, **filters):
+        cols = tuple(filters)
+        with self._conn() as conn:
+            return [dict(r) for r in conn.execute(_select_sql(table, cols), [filters[c] for c in cols])]
+
+    def scan(self, table, columns, **filters):
+        """``columns`` of every matching row as tuples; cheaper than ``find`` for bulk loads."""
+        cols = tuple(filters)
+        where = " AND ".join(f"{_q(c)} = ?" for c in cols)
+        with self._conn() as conn:
+            cur = conn.cursor()
+            cur.row_factory = None
+            return cur.execute(f'SELECT {", ".join(map(_q, columns))} FROM "{table}"' + (f" WHERE {where}" if where else ""),
+                               [filters[c] for c in cols]).fetchall()
+
+    def before(self, table, column, value, limit):
+        """Up to ``limit`` rows whose ``column`` is below ``value``, lowest first; None never matches."""
+        with self._conn() as conn:
+            return [dict(r) for r in conn.execute(f'SELECT * FROM "{table}" WHERE {_q(column)} < ? '
+                                                  f'ORDER BY {_q(column)}, {_q(key_of(table))} LIMIT ?', (value, limit))]
+
+    def chunks(self, table, size=5000, since=None, until=None, **filters):
+        """Matching rows in key order, ``size`` at a time; ``since <= created_at < until`` when given.
+
+        Each chunk is its own keyset query (``key > last``), so no read
+        transaction stays open across the walk.
+        """
+        k = _q(key_of(table))
+        where = [f"{_q(c)} = ?" for c in filters]
+        params = list(filters.values())
+        for op, bound in ((">=", since), ("<", until)):
+            if bound is not None:
+                where.append(f'"created_at" {op} ?')
+                params.append(bound)
+        last = None
+        while True:
+            cond = where + ([f"{k} > ?"] if last is not None else [])
+            sql = f'SELECT * FROM "{table}"' + (" WHERE " + " AND ".join(cond) if cond else "") + f" ORDER BY {k} LIMIT ?"
+            with self._conn() as conn:
+                rows = [dict(r) for r in conn.execute(sql, params + ([last] if last is not None else []) + [size])]
+            if rows:
+                yield rows
+            if len(rows) < size:
+                return
+            last = rows[-1][key_of(table)]
+
+    def count(self, table, **filters):
+        cols = tuple(filters)
+        with self._conn() as conn:
+            if not cols or (len(cols) == 1 and cols[0] in AGGREGATES.get(table, ())):
+                col, val = (cols[0], filters[cols[0]]) if cols else ('*', '')
+                row = conn.execute('SELECT "n" FROM "_aggregates" WHERE "tbl" = ? AND "col" = ? AND "val" = ?',
+                                   (table, col, '' if val is None else val)).fetchone()
+                return row[0] if row else 0
+            return conn.execute(_count_sql(table, cols), [filters[c] for c in cols]).fetchone()[0]
+
+    def aggregate(self, table, column):
+        """``{value: row count}`` for ``column``; maintained counts for ``AGGREGATES`` columns, else GROUP BY."""
+        with self._conn() as conn:
+            if column in AGGREGATES.get(table, ()):
+                rows = conn.execute('SELECT "val", "n" FROM "_aggregates" WHERE "tbl" = ? AND "col" = ? AND "n" > 0', (table, column))
+                return {(None if v == '' else v): n for v, n in rows}
+            return dict(conn.execute(f'SELECT {_q(column)}, COUNT(*) FROM "{table}" GROUP BY 1'))
+
+    def page(self, table, offset=0, limit=50, order_by=None, descending=False, search=None, **filters):
+        """One page of rows plus the total match count: ``(rows, total)``."""
+        cols = tuple(filters)
+        where = [f"{_q(c)} = ?" for c in cols]
+        params = [filters[c] for c in cols]
+        if search:
+            where.append("(" + " OR ".join(f"{_q(c)} LIKE ?" for c in SEARCH_COLUMNS[table]) + ")")
+            params += [f"%{search}%"] * len(SEARCH_COLUMNS[table])
+        where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+        direction = "DESC" if descending else "ASC"
+        order = (f"{_q(order_by)} IS NULL, {_q(order_by)} {direction}, " if order_by else "") + f"{_q(key_of(table))} {direction}"
+        with self._conn() as conn:
+            rows = [dict(r) for r in conn.execute(f'SELECT * FROM "{table}"{where_sql} ORDER BY {order} LIMIT ? OFFSET ?',
+                                                   params + [limit, offset])]
+            if search:
+                return rows, conn.execute(f'SELECT COUNT(*) FROM "{table}"{where_sql}', params).fetchone()[0]
+        return rows, self.count(table, **filters)
+
+    def update(self, table, key, **changes):
+        cols = tuple(c for c in changes if c in columns_of(table))
+        if not cols: return
+        version = None
+        with self._conn() as conn:
+            if conn.execute(_update_sql(table, cols), [changes[c] for c in cols] + [key]).rowcount:
+                version = self._bump(conn, table)
+        if version is not None:
+            self._notify(table, 'update', [(key, changes)], version)
+
+    def update_many(self, table, updates):
+        """Apply ``[(key, {column: value}), ...]`` in one transaction, one executemany per column set."""
+        updates = list(updates)
+        groups = {}
+        for key, changes in updates:
+            cols = tuple(c for c in changes if c in columns_of(table))
+            if cols: groups.setdefault(cols, []).append([changes[c] for c in cols] + [key])
+        if not groups: return
+        with self._conn() as conn:
+            for cols, params in groups.items():
+                conn.executemany(_update_sql(table, cols), params)
+            version = self._bump(conn, table)
+        self._notify(table, 'update', updates, version)
+
+    def delete(self, table, key):
+        version = None
+        with self._conn() as conn:
+            if conn.execute(_delete_sql(table, (key_of(table),)), (key,)).rowcount:
+                version = self._bump(conn, table)
+        if version is not None:
+            self._notify(table, 'delete', [key], version)
+
+    def delete_many(self, table, keys):
+        """Delete every row in ``keys`` in one transaction."""
+        keys, deleted, version = list(keys), [], None
+        k = _q(key_of(table))
+        with self._conn() as conn:
+            # subscribers hear only about rows that existed, as with the memory backend
+            for lo in range(0, len(keys), 500):
+                chunk = keys[lo:lo + 500]
+                deleted += [r[0] for r in conn.execute(f'DELETE FROM "{table}" WHERE {k} IN ({", ".join("?" * len(chunk))}) '
+                                                       f'RETURNING {k}', chunk)]
+            if deleted:
+                version = self._bump(conn, table)
+        if version is not None:
+            self._notify(table, 'delete', deleted, version)
+
+    def delete_cascade(self, table, keys):
+        """Delete ``keys`` and every row depending on them (``CASCADES``) in one transaction; returns ``{table: rows deleted}``."""
+        def referencing(child, column, values):
+            values, out = list(values), []
+            for lo in range(0, len(values), 500):
+                chunk = values[lo:lo + 500]
+                out += [r[0] for r in conn.execute(f'SELECT {_q(key_of(child))} FROM "{child}" WHERE {_q(column)} IN '
+                                                   f'({", ".join("?" * len(chunk))})', chunk)]
+            return out
+        versions = {}
+        with self._conn() as conn:
+            doomed = _cascade(table, referencing(table, key_of(table), keys), referencing)
+            for t, ks in doomed.items():
+                conn.executemany(_delete_sql(t, (key_of(t),)), [(k,) for k in ks])
+                versions[t] = self._bump(conn, t)
+        for t, ks in doomed.items():
+            self._notify(t, 'delete', ks, versions[t])
+        return {t: len(ks) for t, ks in doomed.items()}
+
+    def delete_where(self, table, **filters):
+        cols = tuple(filters)
+        params = [filters[c] for c in cols]
+        keys, version = [], None
+        with self._conn() as conn:
+            if self._subscribers[table]:
+                where = " AND ".join(f"{_q(c)} = ?" for c in cols)
+                keys = [r[0] for r in conn.execute(f'SELECT {_q(key_of(table))} FROM "{table}"'
+                                                   + (f" WHERE {where}" if where else ""), params)]
+            if conn.execute(_delete_sql(table, cols), params).rowcount:
+                version = self._bump(conn, table)
+        if version is not None:
+            self._notify(table, 'delete', keys, version)
+
+# ============ FACTORY ============
+_sqlite_repos = {}
+_sqlite_lock = threading.Lock()
+
+def open_repository(url=None):
+    """Return a repository for ``url`` (or ``$AGRILOOP_DB``).
+
+    SQLite repositories are shared per path within the process so every
+    session draws from the same connection pool.
+    """
+    url = url or os.environ.get('AGRILOOP_DB', 'agriloop.db')
+    if url == 'memory':
+        return MemoryRepository()
+    path = os.path.abspath(url)
+    with _sqlite_lock:
+        if path not in _sqlite_repos:
+            _sqlite_repos[path] = SqliteRepository(path)
+        return _sqlite_repos[path]
@@ -0,0 +1,201 @@
+"""Weather inputs for irrigation advice, looked up by farm location.
+
+A provider answers ``fetch(lat, lng)`` with ``{'temperature', 'humidity',
+'rainfall'}`` (°C, %, mm over the last 7 days -- the inputs of
+``get_irrigation_rec``):
+
+* ``FileWeatherProvider`` reads station observations from a CSV/JSON
+  fixture and returns the nearest station; it stands in for a live feed in
+  demos, tests and offline setups (``fixtures/weather.csv`` ships with the
+  package).
+* ``OpenMeteoProvider`` queries the open-meteo.com forecast API (no key).
+
+``WeatherCache`` sits in front of a provider. Locations are quantized to a
+grid cell of ``cell_deg`` degrees and the cell centre is fetched at most
+once per ``ttl`` seconds; at most ``max_cells`` cells are kept, least
+recently used evicted first. A lookup of a cell that is already being
+fetched waits for that fetch instead of starting another, and
+``lookup_many`` fetches the distinct missing cells of a batch in parallel,
+so 10k farms in one district cost a handful of fetches. Failed fetches are
+remembered for ``error_ttl`` seconds so a dead provider is not hammered.
+
+``from_env`` builds the configured cache::
+
+    AGRILOOP_WEATHER=fixture streamlit run app.py          # bundled fixture
+    AGRILOOP_WEATHER=file:stations.csv streamlit run app.py
+    AGRILOOP_WEATHER=open-meteo streamlit run app.py
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import numpy as np
+
+from agriloop import metrics
+from agriloop.matching import haversine_km
+
+FIELDS = ('temperature', 'humidity', 'rainfall')
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "weather.csv")
+
+class WeatherUnavailable(Exception):
+    pass
+
+# ============ PROVIDERS ============
+class FileWeatherProvider:
+    """Nearest-station observations from a CSV or JSON file with ``lat``, ``lng`` and ``FIELDS`` columns."""
+
+    def __init__(self, path):
+        import pandas as pd
+        df = pd.read_json(path) if path.lower().endswith(".json") else pd.read_csv(path, skipinitialspace=True)
+        missing = [c for c in ('lat', 'lng', *FIELDS) if c not in df.columns]
+        if missing:
+            raise ValueError(f"{path}: missing column(s): {', '.join(missing)}")
+        self.name = f"file:{os.path.basename(path)}"
+        self.lat, self.lng = df['lat'].to_numpy(float), df['lng'].to_numpy(float)
+        self.values = df[list(FIELDS)].to_numpy(float)
+
+    def fetch(self, lat, lng):
+        if not len(self.lat):
+            raise WeatherUnavailable(f"{self.name} has no stations")
+        i = int(np.argmin(haversine_km(lat, lng, self.lat, self.lng)))
+        return dict(zip(FIELDS, self.values[i].tolist()))
+
+class OpenMeteoProvider:
+    """Current temperature and humidity plus the past week's precipitation from open-meteo.com."""
+    name = "open-meteo"
+    URL = "https://api.open-meteo.com/v1/forecast"
+
+    def __init__(self, timeout=5.0, url=URL):
+        self.timeout, self.url = timeout, url
+
+    def fetch(self, lat, lng):
+        query = urlencode({'latitude': f"{lat:.4f}", 'longitude': f"{lng:.4f}",
+                           'current': "temperature_2m,relative_humidity_2m", 'daily': "precipitation_sum",
+                           'past_days': 7, 'forecast_days': 1, 'timezone': "UTC"})
+        try:
+            with urlopen(f"{self.url}?{query}", timeout=self.timeout) as resp:
+                data = json.load(resp)
+            current, rain = data['current'], data['daily']['precipitation_sum'][:7]
+            return {'temperature': float(current['temperature_2m']), 'humidity': float(current['relative_humidity_2m']),
+                    'rainfall': float(sum(r or 0 for r in rain))}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise WeatherUnavailable(f"{self.name}: {e}") from e
+
+# ============ CACHE ============
+class WeatherCache:
+    def __init__(self, provider, cell_deg=0.1, ttl=900, max_cells=10_000, error_ttl=60, fetch_workers=8,
+                 wait_timeout=30, clock=time.monotonic):
+        self.provider, self.cell_deg, self.ttl, self.max_cells = provider, cell_deg, ttl, max_cells
+        self.error_ttl, self.wait_timeout, self.clock = error_ttl, wait_timeout, clock
+        self._cells = OrderedDict()  # cell -> (expires, observation or WeatherUnavailable)
+        self._inflight = {}          # cell -> Future of the fetch in progress
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(fetch_workers, thread_name_prefix="weather")
+        self.stats = Counter()
+
+    @property
+    def name(self):
+        return self.provider.name
+
+    def __len__(self):
+        return len(self._cells)
+
+    def cell(self, lat, lng):
+        return math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg)
+
+    def _count(self, result):
+        self.stats[result] += 1
+        metrics.inc('agriloop_weather_lookups_total', result=result)
+
+    def _claim(self, cell):
+        """Under the lock: ``('hit', observation)``, ``('wait', future)`` or ``('fetch', future)`` for the caller to fill."""
+        entry = self._cells.get(cell)
+        if entry and entry[0] > self.clock():
+            self._cells.move_to_end(cell)
+            self._count('hit')
+            return 'hit', entry[1]
+        future = self._inflight.get(cell)
+        if future is not None:
+            self._count('coalesced')
+            return 'wait', future
+        future = self._inflight[cell] = Future()
+        self._count('miss')
+        return 'fetch', future
+
+    def _fetch(self, cell, future):
+        lat, lng = (cell[0] + 0.5) * self.cell_deg, (cell[1] + 0.5) * self.cell_deg
+        try:
+            with metrics.timer('weather.fetch'):
+                result, ttl = self.provider.fetch(lat, lng), self.ttl
+        except Exception as e:
+            result = e if isinstance(e, WeatherUnavailable) else WeatherUnavailable(f"{self.name}: {e}")
+            ttl = self.error_ttl
+            self._count('error')
+        with self._lock:
+            self._cells[cell] = (self.clock() + ttl, result)
+            self._cells.move_to_end(cell)
+            while len(self._cells) > self.max_cells:
+                self._cells.popitem(last=False)
+            del self._inflight[cell]
+        if isinstance(result, WeatherUnavailable):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def _resolve(self, state, value):
+        if state == 'hit':
+            if isinstance(value, WeatherUnavailable):
+                raise value
+            return dict(value)
+        try:
+            return dict(value.result(timeout=self.wait_timeout))
+        except FutureTimeout:
+            raise WeatherUnavailable(f"{self.name}: timed out") from None
+
+    def lookup(self, lat, lng):
+        """``{temperature, humidity, rainfall}`` at (lat, lng); raises ``WeatherUnavailable``."""
+        cell = self.cell(lat, lng)
+        with self._lock:
+            state, value = self._claim(cell)
+        if state == 'fetch':
+            self._fetch(cell, value)
+        return self._resolve(state, value)
+
+    def lookup_many(self, points):
+        """Weather for each ``(lat, lng)`` in ``points``; None where unavailable or the location is missing."""
+        cells = [self.cell(lat, lng) if lat is not None and lng is not None else None for lat, lng in points]
+        with self._lock:
+            claims = {c: self._claim(c) for c in dict.fromkeys(cells) if c is not None}
+        for c, (state, value) in claims.items():
+            if state == 'fetch':
+                self._pool.submit(self._fetch, c, value)
+        found = {}
+        for c, claim in claims.items():
+            try:
+                found[c] = self._resolve(*claim)
+            except WeatherUnavailable:
+                found[c] = None
+        return [dict(found[c]) if c is not None and found[c] is not None else None for c in cells]
+
+def from_env(environ=os.environ):
+    """A cache over the provider named by ``AGRILOOP_WEATHER`` (``fixture``, ``file:<path>``, ``open-meteo``), or None."""
+    spec = environ.get('AGRILOOP_WEATHER', '').strip()
+    if not spec:
+        return None
+    if spec == 'fixture':
+        provider = FileWeatherProvider(FIXTURE)
+    elif spec.startswith('file:'):
+        provider = FileWeatherProvider(spec[len('file:'):])
+    elif spec == 'open-meteo':
+        provider = OpenMeteoProvider()
+    else:
+        raise ValueError(f"unknown AGRILOOP_WEATHER provider: {spec!r}")
+    return WeatherCache(provider, cell_deg=float(environ.get('AGRILOOP_WEATHER_CELL_DEG', 0.1)),
+                        ttl=float(environ.get('AGRILOOP_WEATHER_TTL', 900)))
@@ -0,0 +1,181 @@
+"""Trainable yield model.
+
+``YieldModel`` is a ridge regression of log yield per hectare on the crop,
+the soil type, log area and -- when the training records have them -- the
+season's temperature, rainfall and humidity. Crop and soil effects are
+multiplicative, like the ``engine.BASE_YIELD`` x ``SOIL_MULTIPLIER`` table
+it replaces, and inference over a batch is two gathers and one
+matrix-vector product. Training builds the normal equations directly from
+per-category sums, so memory grows with the number of records, not with
+records x categories.
+
+Models are trained from historical records -- CSV or Parquet with
+``crop_name``, ``soil_type``, ``area_hectares``, ``yield_kg`` and optionally
+``WEATHER`` columns -- and saved as a plain ``.npz`` file::
+
+    python -m agriloop.yieldmodel history.csv -o yield_model.npz
+
+With ``AGRILOOP_YIELD_MODEL=yield_model.npz`` the model is loaded on first
+use, once per process. Crops the model was not trained on, and every crop
+when no model is configured, use the table.
+"""
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+WEATHER = ('temperature', 'rainfall', 'humidity')
+NO_SOIL = ''
+
+def _names(values):
+    return [str(v).strip().lower() if v is not None and v == v else NO_SOIL for v in values]
+
+def _codes(values, index, default):
+    memo = {}
+    return np.fromiter((memo[v] if v in memo else memo.setdefault(v, index.get(_names([v])[0], default))
+                        for v in values), dtype=np.int64, count=len(values))
+
+def _columns(numeric, areas, weather, n):
+    """Raw ``(n, len(numeric))`` feature matrix, NaN where weather is unknown."""
+    weather = weather or {}
+    cols = []
+    for name in numeric:
+        if name == 'log_area':
+            cols.append(np.log(np.maximum(np.asarray(areas, dtype=float), 1e-3)))
+            continue
+        raw = weather.get(name.removesuffix('_sq'))
+        col = np.full(n, np.nan) if raw is None else np.array(raw, dtype=float)
+        cols.append(col ** 2 if name.endswith('_sq') else col)
+    return np.column_stack(cols) if cols else np.zeros((n, 0))
+
+class YieldModel:
+    def __init__(self, crops, soils, numeric, intercept, crop_coef, soil_coef, coef, mean, scale, smear=1.0, meta=None):
+        self.crops, self.soils, self.numeric = list(crops), list(soils), list(numeric)
+        self.intercept, self.smear = float(intercept), float(smear)
+        # a trailing NaN so unknown crops (code -1) come out as NaN
+        self.crop_coef = np.append(np.asarray(crop_coef, dtype=float), np.nan)
+        self.soil_coef = np.asarray(soil_coef, dtype=float)
+        self.coef, self.mean, self.scale = (np.asarray(a, dtype=float) for a in (coef, mean, scale))
+        self.meta = dict(meta or {})
+        self._crop_index = {c: i for i, c in enumerate(self.crops)}
+        self._soil_index = {s: i for i, s in enumerate(self.soils)}
+
+    def _features(self, areas, weather, n):
+        """Standardized numeric features; missing weather is imputed with the training mean."""
+        x = _columns(self.numeric, areas, weather, n)
+        return (np.where(np.isnan(x), self.mean, x) - self.mean) / self.scale
+
+    def predict(self, crop_names, areas, soils, weather=None):
+        """Expected yield (kg) per row; NaN for crops the model was not trained on.
+
+        ``weather`` maps ``WEATHER`` names to per-row values (None/NaN where unknown).
+        """
+        n = len(crop_names)
+        crop = _codes(crop_names, self._crop_index, -1)
+        soil = _codes(soils, self._soil_index, self._soil_index.get(NO_SOIL, 0))
+        log_ha = self.intercept + self.crop_coef[crop] + self.soil_coef[soil] + self._features(areas, weather, n) @ self.coef
+        return np.exp(log_ha) * self.smear * np.asarray(areas, dtype=float)
+
+    def save(self, path):
+        np.savez(path, crops=np.array(self.crops, dtype=str), soils=np.array(self.soils, dtype=str),
+                 numeric=np.array(self.numeric, dtype=str), intercept=self.intercept, crop_coef=self.crop_coef[:-1],
+                 soil_coef=self.soil_coef, coef=self.coef, mean=self.mean, scale=self.scale, smear=self.smear,
+                 meta=json.dumps(self.meta))
+
+def load(path):
+    with np.load(path, allow_pickle=False) as z:
+        return YieldModel(z['crops'].tolist(), z['soils'].tolist(), z['numeric'].tolist(), z['intercept'],
+                          z['crop_coef'], z['soil_coef'], z['coef'], z['mean'], z['scale'], z['smear'],
+                          json.loads(str(z['meta'])))
+
+# ============ TRAINING ============
+def fit(crop_names, areas, soils, yields, weather=None, alpha=1.0):
+    """Ridge fit of log(yield / area); rows without a positive yield and area are skipped."""
+    areas, yields = np.asarray(areas, dtype=float), np.asarray(yields, dtype=float)
+    crop_names, soils = _names(crop_names), _names(soils)
+    keep = np.flatnonzero((areas > 0) & (yields > 0) & np.array([c != NO_SOIL for c in crop_names], dtype=bool))
+    if not len(keep):
+        raise ValueError("no usable training records")
+    crops_v, soils_v = sorted({crop_names[i] for i in keep}), sorted({soils[i] for i in keep} | {NO_SOIL})
+    crop = _codes([crop_names[i] for i in keep], {c: i for i, c in enumerate(crops_v)}, -1)
+    soil = _codes([soils[i] for i in keep], {s: i for i, s in enumerate(soils_v)}, 0)
+    target = np.log(yields[keep] / areas[keep])
+
+    weather = {k: np.asarray(v, dtype=float)[keep] for k, v in (weather or {}).items() if k in WEATHER}
+    numeric = ['log_area'] + [k for k in WEATHER if k in weather and not np.isnan(weather[k]).all()]
+    if 'temperature' in numeric:
+        numeric.append('temperature_sq')
+    x = _columns(numeric, areas[keep], weather, len(keep))
+    x = np.where(np.isnan(x), np.nanmean(x, axis=0), x)
+    mean, scale = x.mean(axis=0), x.std(axis=0)
+    scale[scale == 0] = 1.0
+    x = (x - mean) / scale
+
+    # normal equations over [intercept | crop one-hot | soil one-hot | numeric] built from sums
+    n, C, S, K = len(keep), len(crops_v), len(soils_v), len(numeric)
+    cc, sc = np.bincount(crop, minlength=C).astype(float), np.bincount(soil, minlength=S).astype(float)
+    by_crop = np.column_stack([np.bincount(crop, x[:, j], C) for j in range(K)]) if K else np.zeros((C, 0))
+    by_soil = np.column_stack([np.bincount(soil, x[:, j], S) for j in range(K)]) if K else np.zeros((S, 0))
+    gram = np.block([
+        [np.array([[n]]), cc[None], sc[None], x.sum(axis=0)[None]],
+        [cc[:, None], np.diag(cc), np.bincount(crop * S + soil, minlength=C * S).reshape(C, S), by_crop],
+        [sc[:, None], np.zeros((S, C)), np.diag(sc), by_soil],
+        [x.sum(axis=0)[:, None], np.zeros((K, C)), np.zeros((K, S)), x.T @ x],
+    ])
+    gram = np.triu(gram) + np.triu(gram, 1).T
+    rhs = np.concatenate([[target.sum()], np.bincount(crop, target, C), np.bincount(soil, target, S), x.T @ target])
+    penalty = np.full(len(rhs), float(alpha))
+    penalty[0] = 0.0
+    w = np.linalg.solve(gram + np.diag(penalty), rhs)
+    b0, wc, ws, wx = w[0], w[1:1 + C], w[1 + C:1 + C + S], w[1 + C + S:]
+    resid = target - (b0 + wc[crop] + ws[soil] + x @ wx)
+    meta = {'rows': int(n), 'alpha': float(alpha), 'rmse_log': float(np.sqrt(np.mean(resid ** 2)))}
+    return YieldModel(crops_v, soils_v, numeric, b0, wc, ws, wx, mean, scale, np.mean(np.exp(resid)), meta)
+
+def fit_file(path, alpha=1.0, chunksize=200_000):
+    """Train on a CSV/Parquet file of historical records."""
+    from agriloop.importer import iter_chunks
+    cols = {'crop_name': [], 'soil_type': [], 'area_hectares': [], 'yield_kg': [], **{k: [] for k in WEATHER}}
+    for df in iter_chunks(path, path, chunksize=chunksize):
+        missing = [c for c in ('crop_name', 'area_hectares', 'yield_kg') if c not in df.columns]
+        if missing:
+            raise ValueError(f"{path}: missing column(s): {', '.join(missing)}")
+        for c, out in cols.items():
+            if c in ('crop_name', 'soil_type'):
+                out.extend(df[c].tolist() if c in df else [None] * len(df))
+            else:
+                out.append(df[c].to_numpy(float) if c in df else np.full(len(df), np.nan))
+    numbers = {c: np.concatenate(v) if v else np.zeros(0) for c, v in cols.items() if c not in ('crop_name', 'soil_type')}
+    return fit(cols['crop_name'], numbers['area_hectares'], cols['soil_type'], numbers['yield_kg'],
+               {k: numbers[k] for k in WEATHER}, alpha=alpha)
+
+# ============ LOADING ============
+_models = {}
+_models_lock = threading.Lock()
+
+def from_env(environ=os.environ):
+    """The model at ``AGRILOOP_YIELD_MODEL``, loaded once per process per path; None when unset."""
+    path = environ.get('AGRILOOP_YIELD_MODEL', '').strip()
+    if not path:
+        return None
+    with _models_lock:
+        model = _models.get(path)
+        if model is None:
+            model = _models[path] = load(path)
+        return model
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Train the yield model from historical crop records (CSV/Parquet).")
+    ap.add_argument("path")
+    ap.add_argument("-o", "--output", default="yield_model.npz")
+    ap.add_argument("--alpha", type=float, default=1.0, help="ridge penalty on the standardized coefficients")
+    args = ap.parse_args(argv)
+    model = fit_file(args.path, alpha=args.alpha)
+    model.save(args.output)
+    print(f"{args.output}: {len(model.crops)} crops, {model.meta['rows']:,} records, "
+          f"RMSE {model.meta['rmse_log']:.3f} (log yield/ha)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""AgriLoop REST API.
+
+An asyncio HTTP/1.1 server (standard library only, keep-alive supported)
+that runs alongside ``app.py`` against the same repository -- point both
+at the same SQLite file with ``AGRILOOP_DB``::
+
+    python api.py --port 8600 --workers 4
+
+Every route except ``GET /health`` needs HTTP Basic auth with an AgriLoop
+username and password. Farms and crops are scoped to the caller (admins
+see everyone's); writes go through the bulk importer's validators, so the
+API accepts exactly what the UI and CSV import accept. Deleting a farm or
+crop also deletes the rows that depend on it (``storage.CASCADES``).
+
+    GET    /farms[?offset=&limit=]        POST /farms          (object or list)
+    GET    /farms/{id}    PATCH /farms/{id}    DELETE /farms/{id}
+    GET    /crops[?farm_id=&status=&offset=&limit=]            POST /crops
+    GET    /crops/{id}    PATCH /crops/{id}    DELETE /crops/{id}
+    POST   /batch/irrigation   {"items": [{soil_moisture, temperature, humidity, rainfall, crop_name, area}]}
+    POST   /batch/yield        {"items": [{crop_name, area, soil_type, temperature?, rainfall?, humidity?}]}
+    POST   /batch/surplus      {"items": [{yield_kg, demand, storage}]}
+    GET    /export/{table}[?format=csv|ndjson|parquet&compression=&owner=&status=&since=&until=]
+
+Repository calls run on a small thread pool sized to the SQLite connection
+pool. Batch bodies larger than ``INLINE_BODY`` bytes are handed to a
+process pool as raw bytes and come back as encoded JSON, so parsing,
+scoring and serializing big batches never holds up the event loop.
+Exports (``agriloop.exports``) are sent with chunked transfer encoding,
+one repository chunk at a time, encoded on the I/O pool; a slow client
+holds back the next chunk rather than letting it pile up in memory.
+Non-admin accounts only export their own rows.
+"""
+import argparse
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import multiprocessing
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from agriloop import engine, exports, metrics
+from agriloop.importer import REQUIRED, VALIDATORS
+from agriloop.storage import open_repository
+from agriloop.yieldmodel import WEATHER, from_env as yield_model_from_env
+
+INLINE_BODY = 32_768   # batch bodies up to this size (~250 items) are scored on the event loop
+MAX_BATCH = 10_000     # items per batch request
+MAX_BODY = 8 * 2**20   # bytes
+MAX_PAGE = 500
+AUTH_TTL = 30          # seconds a verified Authorization header is trusted without a lookup
+EDITABLE = {
+    'farms': ['name', 'area_hectares', 'location_latitude', 'location_longitude', 'location_address', 'soil_type'],
+    'crops': ['crop_name', 'area_hectares', 'planting_date', 'expected_harvest_date', 'status'],
+}
+
+class Stream:
+    """A chunked response body: ``first`` piece already encoded, the rest from the generator ``rest``."""
+    def __init__(self, first, rest, content_type, filename):
+        self.first, self.rest, self.content_type, self.filename = first, rest, content_type, filename
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# ============ BATCH SCORING ============
+def _fields(items, spec):
+    """Columns of ``items`` per ``{field: default}``: float defaults make numeric fields, ``...`` required text."""
+    if not isinstance(items, list) or not items:
+        raise HTTPError(400, "'items' must be a non-empty list")
+    if len(items) > MAX_BATCH:
+        raise HTTPError(413, f"at most {MAX_BATCH} items per request")
+    if not all(isinstance(item, dict) for item in items):
+        raise HTTPError(400, "items must be objects")
+    cols = {}
+    for name, default in spec.items():
+        if default is ... and not all(name in item for item in items):
+            raise HTTPError(400, f"every item needs '{name}'")
+        values = [item.get(name, default) for item in items]
+        if isinstance(default, float):
+            try:
+                values = [default if v is None else float(v) for v in values]
+            except (TypeError, ValueError):
+                raise HTTPError(400, f"'{name}' must be numeric") from None
+        else:
+            values = [None if v is None else str(v) for v in values]
+        cols[name] = values
+    return cols
+
+def score_irrigation(cols):
+    return engine.irrigation_recs(cols['soil_moisture'], cols['temperature'], cols['humidity'], cols['rainfall'],
+                                  cols['crop_name'], cols['area'])
+
+def score_yield(cols):
+    weather = {k: cols[k] for k in WEATHER}
+    return [{'yield_kg': y} for y in engine.predict_yields(cols['crop_name'], cols['area'], cols['soil_type'],
+                                                           model=yield_model_from_env(), weather=weather)]
+
+def score_surplus(cols):
+    return engine.predict_surpluses(cols['yield_kg'], cols['demand'], cols['storage'])
+
+# name -> (field spec, scorer)
+BATCHES = {
+    'irrigation': ({'soil_moisture': 0.0, 'temperature': 0.0, 'humidity': 0.0, 'rainfall': 0.0,
+                    'crop_name': ..., 'area': 1.0}, score_irrigation),
+    'yield': ({'crop_name': ..., 'area': 1.0, 'soil_type': None, **{k: float('nan') for k in WEATHER}}, score_yield),
+    'surplus': ({'yield_kg': 0.0, 'demand': 0.0, 'storage': 0.0}, score_surplus),
+}
+
+def score_batch(name, body):
+    """Parse, score and encode one batch request body: ``(status, JSON bytes)``; runs inline or in the process pool."""
+    spec, scorer = BATCHES[name]
+    try:
+        try:
+            payload = json.loads(body or b"null")
+        except ValueError:
+            raise HTTPError(400, "body is not valid JSON") from None
+        cols = _fields(payload.get('items') if isinstance(payload, dict) else None, spec)
+        return 200, json.dumps({'results': scorer(cols)}).encode()
+    except HTTPError as e:
+        return e.status, json.dumps({'error': str(e)}).encode()
+
+# ============ SERVER ============
+class Request:
+    def __init__(self, method, path, query, headers, body):
+        self.method, self.path, self.query, self.headers, self.body = method, path, query, headers, body
+        self.user = None
+
+    def json(self):
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            raise HTTPError(400, "body is not valid JSON") from None
+
+    def arg(self, name, default=None, cast=str):
+        values = self.query.get(name)
+        if not values:
+            return default
+        try:
+            return cast(values[0])
+        except ValueError:
+            raise HTTPError(400, f"invalid '{name}'") from None
+
+class API:
+    def __init__(self, repo=None, workers=None, io_threads=8):
+        self.db = repo or open_repository()
+        self.io = ThreadPoolExecutor(io_threads, thread_name_prefix="api-io")
+        self.cpu = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        self._sessions = {}  # Authorization header -> (user, expiry)
+        self.routes = []
+        for method, pattern, handler in [
+            ('GET', r'/health', self.health),
+            ('GET', r'/(farms|crops)', self.list_rows),
+            ('POST', r'/(farms|crops)', self.create_rows),
+            ('GET', r'/(farms|crops)/(\d+)', self.get_row),
+            ('PATCH', r'/(farms|crops)/(\d+)', self.update_row),
+            ('DELETE', r'/(farms|crops)/(\d+)', self.delete_row),
+            ('POST', r'/batch/(\w+)', self.batch),
+            ('GET', r'/export/(\w+)', self.export),
+        ]:
+            self.routes.append((method, re.compile(pattern + r'/?$'), handler))
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking repository call on the I/O pool."""
+        return await asyncio.get_running_loop().run_in_executor(self.io, functools.partial(fn, *args, **kwargs))
+
+    # ---------- auth & ownership ----------
+    def _authenticate(self, header):
+        scheme, _, token = (header or "").partition(" ")
+        if scheme.lower() != "basic":
+            return None
+        try:
+            username, _, password = base64.b64decode(token).decode().partition(":")
+        except (ValueError, UnicodeDecodeError):
+            return None
+        user = self.db.get('users', username)
+        if user and user['password'] == hashlib.sha256(password.encode()).hexdigest():
+            return user
+        return None
+
+    async def user_for(self, header):
+        cached = self._sessions.get(header)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        user = await self.run(self._authenticate, header)
+        if user is not None:
+            if len(self._sessions) > 10_000:
+                self._sessions.clear()
+            self._sessions[header] = (user, time.monotonic() + AUTH_TTL)
+        return user
+
+    def _owned(self, req, table, key):
+        row = self.db.get(table, key)
+        if row is None or (req.user['role'] != 'admin' and row['owner'] != req.user['username']):
+            raise HTTPError(404, f"{table[:-1]} {key} not found")
+        return row
+
+    # ---------- handlers ----------
+    async def health(self, req):
+        return 200, {'status': 'ok'}
+
+    async def list_rows(self, req, table):
+        offset = max(0, req.arg('offset', 0, int))
+        limit = min(MAX_PAGE, max(1, req.arg('limit', 50, int)))
+        filters = {} if req.user['role'] == 'admin' else {'owner': req.user['username']}
+        if table == 'crops':
+            for name, cast in (('farm_id', int), ('status', str)):
+                if req.arg(name) is not None:
+                    filters[name] = req.arg(name, cast=cast)
+        rows, total = await self.run(self.db.page, table, offset, limit, **filters)
+        return 200, {'items': rows, 'total': total, 'offset': offset, 'limit': limit}
+
+    async def get_row(self, req, table, key):
+        return 200, await self.run(self._owned, req, table, int(key))
+
+    def _validate(self, table, records, owner):
+        df = pd.DataFrame.from_records(records)
+        missing = [c for c in REQUIRED[table] if c not in df.columns]
+        if missing:
+            raise HTTPError(400, f"missing required field(s): {', '.join(missing)}")
+        context = {'farm_ids': {f['id'] for f in self.db.find('farms', owner=owner)}} if table == 'crops' else None
+        rows, errors = VALIDATORS[table](df, owner, context)
+        if len(errors):
+            raise HTTPError(422, "; ".join(f"item {i}: {e}" for i, e in errors.head(20).items()))
+        return rows
+
+    def _create(self, table, records, owner):
+        rows = self._validate(table, records, owner)
+        keys = self.db.insert_many(table, rows)
+        return [dict(r, id=k) for r, k in zip(rows, keys)]
+
+    async def create_rows(self, req, table):
+        body = req.json()
+        records = body if isinstance(body, list) else [body]
+        if not records or not all(isinstance(r, dict) for r in records):
+            raise HTTPError(400, "expected an object or a list of objects")
+        if len(records) > MAX_BATCH:
+            raise HTTPError(413, f"at most {MAX_BATCH} rows per request")
+        created = await self.run(self._create, table, records, req.user['username'])
+        return 201, created if isinstance(body, list) else created[0]
+
+    def _update(self, req, table, key, changes):
+        row = self._owned(req, table, key)
+        unknown = set(changes) - set(EDITABLE[table])
+        if unknown:
+            raise HTTPError(400, f"cannot change: {', '.join(sorted(unknown))}")
+        valid = self._validate(table, [{**row, **changes}], row['owner'])[0]
+        self.db.update(table, key, **{c: valid[c] for c in changes})
+        return self.db.get(table, key)
+
+    async def update_row(self, req, table, key):
+        changes = req.json()
+        if not isinstance(changes, dict):
+            raise HTTPError(400, "expected an object")
+        return 200, await self.run(self._update, req, table, int(key), changes)
+
+    def _delete(self, req, table, key):
+        self._owned(req, table, key)
+        self.db.delete_cascade(table, [key])
+
+    async def delete_row(self, req, table, key):
+        await self.run(self._delete, req, table, int(key))
+        return 204, None
+
+    async def batch(self, req, name):
+        if name not in BATCHES:
+            raise HTTPError(404, f"unknown batch '{name}'")
+        if len(req.body) <= INLINE_BODY:
+            return score_batch(name, req.body)
+        return await asyncio.get_running_loop().run_in_executor(self.cpu, score_batch, name, req.body)
+
+    async def export(self, req, table):
+        fmt, compression = req.arg('format', 'csv'), req.arg('compression') or None
+        owner = req.arg('owner') if req.user['role'] == 'admin' else req.user['username']
+        gen = exports.stream(self.db, table, fmt, compression, owner=owner, status=req.arg('status'),
+                             since=req.arg('since'), until=req.arg('until'))
+        try:
+            # the first piece is produced before any header is sent, so bad arguments still get a 400
+            first = await self.run(next, gen, b"")
+        except ValueError as e:
+            raise HTTPError(400, str(e)) from None
+        return 200, Stream(first, gen, exports.CONTENT_TYPE[fmt], exports.filename(table, fmt, compression))
+
+    # ---------- HTTP ----------
+    async def dispatch(self, req):
+        allowed = []
+        for method, pattern, handler in self.routes:
+            m = pattern.match(req.path)
+            if m:
+                if method != req.method:
+                    allowed.append(method)
+                    continue
+                if handler != self.health:
+                    req.user = await self.user_for(req.headers.get('authorization'))
+                    if req.user is None:
+                        raise HTTPError(401, "authentication required")
+                with metrics.timer(f"api.{handler.__name__}"):
+                    return await handler(req, *m.groups())
+        if allowed:
+            raise HTTPError(405, f"use {', '.join(allowed)}")
+        raise HTTPError(404, "not found")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    await self._send(writer, 400, {'error': "bad request line"}, False)
+                    break
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = h.decode('latin-1').partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                keep_alive = version == "HTTP/1.1" and headers.get('connection', '').lower() != "close"
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY:
+                    await self._send(writer, 413, {'error': "body too large"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                url = urlsplit(target)
+                req = Request(method.upper(), url.path, parse_qs(url.query), headers, body)
+                try:
+                    status, payload = await self.dispatch(req)
+                except HTTPError as e:
+                    status, payload = e.status, {'error': str(e)}
+                except Exception:
+                    metrics.log.exception("api request failed: %s %s", method, target)
+                    status, payload = 500, {'error': "internal error"}
+                await self._send(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send(self, writer, status, payload, keep_alive):
+        if isinstance(payload, Stream):
+            return await self._send_stream(writer, status, payload, keep_alive)
+        if payload is None or isinstance(payload, bytes):
+            data = payload or b""
+        else:
+            data = json.dumps(payload, default=str).encode()
+        head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Content-Length: {len(data)}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        if data:
+            head.append("Content-Type: application/json")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + data)
+        await writer.drain()
+
+    async def _send_stream(self, writer, status, body, keep_alive):
+        head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", "Transfer-Encoding: chunked",
+                f"Content-Type: {body.content_type}", f'Content-Disposition: attachment; filename="{body.filename}"',
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+        data = body.first
+        try:
+            while data is not None:
+                if data:
+                    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    await writer.drain()
+                data = await self.run(next, body.rest, None)
+        except Exception as e:
+            body.rest.close()
+            if not isinstance(e, ConnectionError):
+                metrics.log.exception("api export failed after the response started")
+            raise ConnectionError("export aborted") from e
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8600):
+        server = await asyncio.start_server(self.handle, host, port, limit=2**16)
+        # spawn the scoring pool now rather than on the first large batch
+        await asyncio.get_running_loop().run_in_executor(self.cpu, time.time)
+        return server
+
+    def close(self):
+        self.cpu.shutdown(cancel_futures=True)
+        self.io.shutdown()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="AgriLoop REST API.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8600)
+    ap.add_argument("--workers", type=int, default=None, help="scoring processes (default: CPU count)")
+    ap.add_argument("--db", default=None, help="SQLite path (defaults to $AGRILOOP_DB / agriloop.db)")
+    args = ap.parse_args(argv)
+
+    async def run():
+        api = API(open_repository(args.db), workers=args.workers)
+        server = await api.serve(args.host, args.port)
+        print(f"AgriLoop API listening on http://{args.host}:{args.port}", flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            api.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,43 @@
 import streamlit as st
-import pandas as pd
+from streamlit.errors import StreamlitAPIException
+import numpy as np
 from datetime import datetime, timedelta
 import hashlib
-import random
+import os
+import re
+import threading
+import uuid
+from agriloop import engine, metrics
+from agriloop.advisories import log_for, record as advisory_record, watch_retention
+from agriloop.engine import recommendation_text
+from agriloop.exports import COMPRESSIONS as EXPORT_COMPRESSIONS, CONTENT_TYPE, FORMATS as EXPORT_FORMATS, TABLES as EXPORT_TABLES, ExportJobs
+from agriloop.impact import REGION_DEG, WASTE_TYPES, rollups_for
+from agriloop.marketplace import index_for
+from agriloop.metrics import timed
+from agriloop.matching import PartnerIndex, assign_batch, load_for
+from agriloop.routing import RoutePlanner
+from agriloop.scheduler import HORIZONS, TRIGGER, IrrigationPlanner
+from agriloop.profiler import from_env as profiler_from_env
+from agriloop.storage import SCHEMA, DuplicateKeyError, open_repository
+from agriloop.weather import WeatherUnavailable, from_env as weather_from_env
+from agriloop.yieldmodel import from_env as yield_model_from_env
+
+# pandas and the modules built on it (importer, sensors) are imported by the
+# pages that use them, so the landing and login pages start without them.
+CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agriloop", "static", "app.css")
+
+@st.cache_resource
+def page_css():
+    """The stylesheet from ``agriloop/static/app.css``, read and minified once per process."""
+    with open(CSS_PATH, encoding='utf-8') as f:
+        css = re.sub(r"/\*.*?\*/", "", f.read(), flags=re.S)
+    return "<style>" + re.sub(r"\s*([{};:,])\s*", r"\1", " ".join(css.split())) + "</style>"
 
 # ============ PAGE CONFIG ============
 st.set_page_config(page_title="AgriLoop AI", page_icon="🌾", layout="wide", initial_sidebar_state="expanded")
 
 # ============ CUSTOM CSS - LIGHT THEME ============
-st.markdown("""
-<style>
-    /* Force light theme */
-    .stApp { background-color: #f9fafb !important; }
-    
-    .main-header { background: linear-gradient(135deg, #16a34a 0%, #15803d 100%); padding: 1.5rem 2rem; border-radius: 1rem; color: white; margin-bottom: 2rem; }
-    .main-header h1 { color: white !important; margin: 0; font-size: 2.5rem; }
-    .main-header p { color: #bbf7d0; margin: 0.5rem 0 0 0; font-size: 1.1rem; }
-    
-    .metric-card { background: white !important; padding: 1.5rem; border-radius: 0.75rem; box-shadow: 0 1px 3px rgba(0,0,0,0.1); text-align: center; border: 1px solid #e5e7eb; }
-    .metric-card .value { font-size: 2rem; font-weight: bold; margin-bottom: 0.25rem; }
-    .metric-card .label { color: #6b7280 !important; font-size: 0.875rem; }
-    
-    .green { color: #16a34a !important; } 
-    .blue { color: #2563eb !important; } 
-    .orange { color: #ea580c !important; } 
-    .purple { color: #9333ea !important; } 
-    .red { color: #dc2626 !important; }
-    
-    .feature-card { background: white !important; padding: 1.5rem; border-radius: 0.75rem; box-shadow: 0 1px 3px rgba(0,0,0,0.1); border: 1px solid #e5e7eb; margin-bottom: 1rem; }
-    .feature-card .icon { font-size: 2.5rem; margin-bottom: 0.5rem; }
-    .feature-card h3 { font-size: 1.25rem; font-weight: bold; margin-bottom: 0.5rem; color: #111827 !important; }
-    .feature-card p { color: #6b7280 !important; font-size: 0.875rem; }
-    
-    .card { background: white !important; color: #111827 !important; padding: 1.5rem; border-radius: 0.75rem; box-shadow: 0 1px 3px rgba(0,0,0,0.1); margin-bottom: 1rem; border: 1px solid #e5e7eb; }
-    .card h4 { color: #111827 !important; margin: 0 0 0.5rem 0; }
-    .card p { color: #4b5563 !important; margin: 0.25rem 0; }
-    
-    .partner-card { background: white !important; color: #111827 !important; padding: 1.5rem; border-radius: 0.75rem; box-shadow: 0 2px 4px rgba(0,0,0,0.1); border: 1px solid #e5e7eb; margin-bottom: 1rem; }
-    .partner-card h4 { color: #111827 !important; font-size: 1.1rem; font-weight: 600; margin: 0 0 0.5rem 0; }
-    .partner-card .type { color: #16a34a !important; font-size: 0.9rem; text-transform: capitalize; margin: 0.25rem 0; }
-    .partner-card .capacity { color: #6b7280 !important; font-size: 0.875rem; margin: 0.25rem 0; }
-    .partner-card .rating { color: #eab308 !important; font-size: 0.9rem; margin-top: 0.5rem; }
-    
-    .result-box { background: #f0fdf4 !important; border: 1px solid #bbf7d0; padding: 1.5rem; border-radius: 0.75rem; margin: 1rem 0; }
-    .result-box h3 { color: #15803d !important; }
-    
-    .stats-section { background: #f0fdf4 !important; padding: 2rem; border-radius: 0.75rem; margin: 2rem 0; }
-    
-    .footer { background: #1f2937 !important; color: white !important; padding: 1.5rem; text-align: center; margin-top: 2rem; border-radius: 0.75rem; }
-    .footer p { color: white !important; }
-</style>
-""", unsafe_allow_html=True)
+st.markdown(page_css(), unsafe_allow_html=True)
 
 # ============ INIT SESSION STATE ============
 if 'page' not in st.session_state:
@@ -59,76 +46,201 @@ if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
 if 'current_user' not in st.session_state:
     st.session_state.current_user = None
-if 'users' not in st.session_state:
-    st.session_state.users = {
-        'admin': {'password': hashlib.sha256('admin123'.encode()).hexdigest(), 'email': 'admin@agriloop.com', 
-                  'full_name': 'System Admin', 'role': 'admin', 'phone': '', 'created_at': datetime.now().isoformat()}
-    }
-if 'farms' not in st.session_state:
-    st.session_state.farms = []
-if 'crops' not in st.session_state:
-    st.session_state.crops = []
-if 'advisories' not in st.session_state:
-    st.session_state.advisories = []
-if 'surplus_listings' not in st.session_state:
-    st.session_state.surplus_listings = []
-if 'waste_requests' not in st.session_state:
-    st.session_state.waste_requests = []
-if 'partners' not in st.session_state:
-    st.session_state.partners = [
-        {'id': 1, 'name': 'GreenCompost Co', 'type': 'compost_facility', 'capacity': 5000, 'lat': 28.6139, 'lng': 77.2090, 'rating': 4.5},
-        {'id': 2, 'name': 'BioGas Solutions', 'type': 'biogas_plant', 'capacity': 10000, 'lat': 28.7041, 'lng': 77.1025, 'rating': 4.2},
-        {'id': 3, 'name': 'FoodBank Network', 'type': 'food_bank', 'capacity': 2000, 'lat': 28.5355, 'lng': 77.3910, 'rating': 4.8},
-    ]
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+# ============ INIT STORAGE ============
+DEFAULT_PARTNERS = [
+    {'id': 1, 'name': 'GreenCompost Co', 'type': 'compost_facility', 'capacity': 5000, 'lat': 28.6139, 'lng': 77.2090, 'rating': 4.5},
+    {'id': 2, 'name': 'BioGas Solutions', 'type': 'biogas_plant', 'capacity': 10000, 'lat': 28.7041, 'lng': 77.1025, 'rating': 4.2},
+    {'id': 3, 'name': 'FoodBank Network', 'type': 'food_bank', 'capacity': 2000, 'lat': 28.5355, 'lng': 77.3910, 'rating': 4.8},
+]
+
+def seed_defaults(db):
+    """Create the default admin and partners once; an already-seeded store is only read."""
+    if db.get('users', 'admin') is None:
+        db.insert('users', {'username': 'admin', 'password': hashlib.sha256('admin123'.encode()).hexdigest(), 'email': 'admin@agriloop.com',
+                            'full_name': 'System Admin', 'role': 'admin', 'phone': '', 'created_at': datetime.now().isoformat()}, or_ignore=True)
+    for p in DEFAULT_PARTNERS:
+        if db.get('partners', p['id']) is None:
+            db.insert('partners', p, or_ignore=True)
+
+@st.cache_resource
+def get_repository():
+    """The one store shared by every session of this process."""
+    repo = open_repository()
+    seed_defaults(repo)
+    return repo
+
+@st.cache_resource
+def action_lock(name):
+    """Process-wide lock for an action that reads, decides and then writes (matching, registration)."""
+    return threading.Lock()
+
+db = get_repository()
+
+# ============ INSTRUMENTATION ============
+@st.cache_resource
+def init_instrumentation():
+    """Process-wide setup from the environment: metrics endpoint, JSON rerun log and the slow-rerun profiler."""
+    if os.environ.get('AGRILOOP_METRICS_PORT'):
+        metrics.start_metrics_server(int(os.environ['AGRILOOP_METRICS_PORT']))
+    if os.environ.get('AGRILOOP_METRICS_LOG'):
+        metrics.configure_log(os.environ['AGRILOOP_METRICS_LOG'])
+    return profiler_from_env()
+
+profiler = init_instrumentation()
+metrics.collector('entities', lambda repo=db: [('agriloop_entities', {'table': t}, repo.count(t)) for t in SCHEMA])
+
+get_irrigation_rec = timed(engine.get_irrigation_rec)
+predict_yield = timed(engine.predict_yield)
+predict_surplus = timed(engine.predict_surplus)
+forecast_surplus = timed(engine.forecast_surplus)
+
+def fragment(func):
+    """``st.fragment`` whose runs are timed under the function's name."""
+    return st.fragment(timed(func))
+
+@timed(name='dataframe')
+def table_frame(data):
+    import pandas as pd
+    return pd.DataFrame(data)
 
 # ============ HELPER FUNCTIONS ============
 def hash_pw(p): return hashlib.sha256(p.encode()).hexdigest()
-def get_user_farms(): return [f for f in st.session_state.farms if f['owner'] == st.session_state.current_user] if st.session_state.current_user else []
-def get_user_crops(): return [c for c in st.session_state.crops if c['owner'] == st.session_state.current_user] if st.session_state.current_user else []
-def get_active_crops(): return [c for c in get_user_crops() if c['status'] == 'active']
-def get_farm_crops(fid): return [c for c in st.session_state.crops if c['farm_id'] == fid]
-
-def get_irrigation_rec(soil_moisture, temp, humidity, rainfall, crop_name, area):
-    water_stress = max(0, (100 - soil_moisture) / 100)
-    evap = (temp * 0.1) + ((100 - humidity) * 0.05)
-    rain_factor = max(0, 1 - (rainfall / 50))
-    volume = area * 1000 * water_stress * evap * rain_factor
-    
-    if soil_moisture < 30: freq, urg = 1, "high"
-    elif soil_moisture < 50: freq, urg = 2, "medium"
-    elif soil_moisture < 70: freq, urg = 3, "low"
-    else: freq, urg = 5, "none"
-    
-    risks = []
-    if temp > 35: risks.append("High temperature stress")
-    if soil_moisture < 25: risks.append("Critical moisture deficit")
-    if humidity < 30: risks.append("Low humidity")
-    
-    if urg == "high": rec = f"🚨 Immediate irrigation needed for {crop_name}. Soil moisture critically low at {soil_moisture}%."
-    elif urg == "medium": rec = f"⚠️ Schedule irrigation within 24-48 hours for {crop_name}. Moisture: {soil_moisture}%."
-    elif urg == "low": rec = f"📊 Monitor {crop_name}. Irrigation may be needed in 2-3 days. Moisture: {soil_moisture}%."
-    else: rec = f"✅ No immediate irrigation needed for {crop_name}. Moisture adequate at {soil_moisture}%."
-    
-    return {"recommendation": rec, "volume": max(0, volume), "frequency": freq, "urgency": urg, "risks": risks}
-
-def predict_yield(crop, area, soil):
-    yields = {"wheat": 3500, "rice": 4000, "corn": 8000, "maize": 8000, "potato": 25000, "tomato": 50000}
-    base = yields.get(crop.lower(), 5000)
-    mult = {"loamy": 1.2, "clay": 0.9, "sandy": 0.8, "silty": 1.1}.get(soil, 1.0) if soil else 1.0
-    return round(base * area * mult * random.uniform(0.9, 1.1), 2)
-
-def predict_surplus(yield_kg, demand, storage):
-    surplus = max(0, yield_kg - demand)
-    pct = (surplus / yield_kg * 100) if yield_kg > 0 else 0
-    if pct > 30: cat, urg = "high", "high"
-    elif pct > 15: cat, urg = "medium", "medium"
-    elif pct > 5: cat, urg = "low", "low"
-    else: cat, urg = "minimal", "none"
-    recs = []
-    if surplus > storage: recs.append("⚠️ Surplus exceeds storage - sell immediately")
-    if cat == "high": recs.extend(["🏦 Connect with food banks", "🏭 Consider processing"])
-    if cat in ["high", "medium"]: recs.append("📦 List on marketplace")
-    return {"surplus": round(surplus, 2), "pct": round(pct, 2), "category": cat, "urgency": urg, "recs": recs}
+@timed
+def get_user_farms(): return db.find('farms', owner=st.session_state.current_user) if st.session_state.current_user else []
+@timed
+def get_user_crops(): return db.find('crops', owner=st.session_state.current_user) if st.session_state.current_user else []
+@timed
+def get_active_crops(): return db.find('crops', owner=st.session_state.current_user, status='active') if st.session_state.current_user else []
+@timed
+def get_farm_crops(fid): return db.find('crops', farm_id=fid)
+
+def get_listing_index(): return index_for(db)
+
+def get_impact(): return rollups_for(db)
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def partner_index(_db, version):
+    return PartnerIndex(_db.find('partners'))
+
+def get_partner_index(): return partner_index(db, db.version('partners'))
+
+PARTNER_TYPES = ["compost_facility", "biogas_plant", "food_bank", "recycling_center"]
+SENSOR_DROP_DIR = os.environ.get('AGRILOOP_SENSOR_DROP', 'sensor_drop')
+ADVISORY_RETENTION_DAYS = float(os.environ['AGRILOOP_ADVISORY_RETENTION_DAYS']) if os.environ.get('AGRILOOP_ADVISORY_RETENTION_DAYS') else None
+ADVISORY_ARCHIVE_DIR = os.environ.get('AGRILOOP_ADVISORY_ARCHIVE', 'advisory_archive')
+EXPORT_DIR = os.environ.get('AGRILOOP_EXPORT_DIR', 'exports')
+EXPORT_DOWNLOAD_LIMIT = 100 * 2**20  # larger exports stay on the server, in EXPORT_DIR
+
+@st.cache_resource
+def start_advisory_retention():
+    """Archive old advisories from one background thread per process; None when nothing expires."""
+    if ADVISORY_RETENTION_DAYS is None:
+        return None
+    return watch_retention(db, ADVISORY_RETENTION_DAYS, ADVISORY_ARCHIVE_DIR)
+
+start_advisory_retention()
+
+@timed
+def recent_advisories(n):
+    """The current user's latest ``n`` advisories, newest first, as ``(record, recommendation text)``."""
+    out = []
+    for a in log_for(db).recent(db, st.session_state.current_user, n):
+        crop = db.get('crops', a.crop_id) if a.level is not None else None
+        out.append((a, a.recommendation(crop['crop_name'] if crop else "your crop")))
+    return out
+
+@st.cache_resource
+def get_sensor_store():
+    from agriloop.sensors import SensorStore, start_ingest_server, watch_drop_dir
+    store = SensorStore()
+    watch_drop_dir(store, SENSOR_DROP_DIR)
+    if os.environ.get('AGRILOOP_INGEST_PORT'):
+        start_ingest_server(store, int(os.environ['AGRILOOP_INGEST_PORT']))
+    return store
+
+@st.cache_resource
+def get_yield_model():
+    """The trained yield model at ``AGRILOOP_YIELD_MODEL``, loaded on first use; None falls back to the lookup table."""
+    return yield_model_from_env()
+
+@st.cache_resource
+def get_weather():
+    """The process-wide weather cache configured by ``AGRILOOP_WEATHER``, or None."""
+    return weather_from_env()
+
+def crop_weather(crops):
+    """Weather at each crop's farm (None where the farm has no location or the lookup failed)."""
+    farms = {f['id']: f for f in get_user_farms()}
+    located = [farms.get(c['farm_id']) or db.get('farms', c['farm_id']) or {} for c in crops]
+    return get_weather().lookup_many([(f.get('location_latitude'), f.get('location_longitude')) for f in located])
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def admin_page_frame(_db, db_id, table, version, columns, offset, limit, order_by, descending, search, filters):
+    # db_id/version are part of the cache key: a frame is reused until its table is written to
+    import pandas as pd
+    rows, total = _db.page(table, offset, limit, order_by, descending, search or None, **dict(filters))
+    frame = pd.DataFrame([{label: r[c] for c, label in columns} for r in rows], columns=[label for _, label in columns])
+    return frame, total, [r[columns[0][0]] for r in rows]
+
+@timed
+def paged_table(table, columns, filter_col=None, filter_options=(), page_size=25):
+    """Searchable, sortable, paginated admin table; returns the keys (first column) of the rows shown."""
+    k = f"adm_{table}"
+    c1, c2, c3, c4 = st.columns([2, 1, 1, 1])
+    search = c1.text_input("Search", key=f"{k}_q", placeholder="Search...")
+    fval = c2.selectbox(filter_col.replace('_', ' ').title(), ["All", *filter_options], key=f"{k}_f") if filter_col else "All"
+    labels = dict((label, c) for c, label in columns)
+    order_by = labels[c3.selectbox("Sort by", list(labels), key=f"{k}_s")]
+    desc = c4.toggle("Descending", key=f"{k}_d")
+    filters = ((filter_col, fval),) if filter_col and fval != "All" else ()
+    
+    page_no = st.session_state.get(f"{k}_page", 1)
+    args = (db, id(db), table, db.version(table), tuple(columns))
+    frame, total, keys = admin_page_frame(*args, (page_no - 1) * page_size, page_size, order_by, desc, search, filters)
+    pages = max(1, -(-total // page_size))
+    if page_no > pages:
+        page_no = st.session_state[f"{k}_page"] = pages
+        frame, total, keys = admin_page_frame(*args, (page_no - 1) * page_size, page_size, order_by, desc, search, filters)
+    st.dataframe(frame, use_container_width=True, hide_index=True)
+    pager(k, total, page_size)
+    return keys
+
+@timed
+def list_window(key, table, page_size=10, **filters):
+    """Rows of ``table`` matching ``filters`` for the current page only (newest first): ``(rows, total)``.
+
+    Render cost stays bounded by ``page_size`` however many rows match; draw ``pager`` under the list.
+    """
+    total = db.count(table, **filters)
+    pages = max(1, -(-total // page_size))
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = pages
+    page_no = st.session_state.get(f"{key}_page", 1)
+    rows, _ = db.page(table, (page_no - 1) * page_size, page_size, descending=True, **filters)
+    return rows, total
+
+def pager(key, total, page_size=10):
+    pages = max(1, -(-total // page_size))
+    if pages > 1:
+        page_no = min(st.session_state.get(f"{key}_page", 1), pages)
+        first = (page_no - 1) * page_size
+        c1, c2 = st.columns([1, 4])
+        c1.number_input("Page", min_value=1, max_value=pages, key=f"{key}_page", label_visibility="collapsed")
+        c2.caption(f"Page {page_no} of {pages} · showing {first + 1}–{min(first + page_size, total)} of {total:,}")
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def cached_forecast(crop_names, areas, soils, demand, storage, samples, seed):
+    return forecast_surplus(crop_names, areas, soils, demand, storage, samples=samples, seed=seed, model=get_yield_model())
+
+def rerun_fragment():
+    """Rerun only the calling fragment; falls back to a full rerun when the fragment ran as part of the whole script."""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
 
 # ============ NAVIGATION FUNCTIONS ============
 def go_to(page):
@@ -139,6 +251,14 @@ def logout():
     st.session_state.current_user = None
     st.session_state.page = 'home'
 
+def current_account():
+    """The logged-in user's row; a session whose account was deleted (e.g. by an admin elsewhere) is logged out."""
+    user = db.get('users', st.session_state.current_user)
+    if user is None:
+        logout()
+        st.rerun()
+    return user
+
 # ============ SIDEBAR ============
 with st.sidebar:
     st.markdown("## 🌾 AgriLoop AI")
@@ -146,7 +266,7 @@ with st.sidebar:
     st.divider()
     
     if st.session_state.logged_in:
-        user = st.session_state.users[st.session_state.current_user]
+        user = current_account()
         st.success(f"👤 {user['full_name'] or st.session_state.current_user}")
         st.caption(f"Role: {user['role'].title()}")
         st.divider()
@@ -178,10 +298,11 @@ with st.sidebar:
     st.caption("© 2024 AgriLoop AI")
 
 # ============ PAGES ============
-page = st.session_state.page
+# Each page is a function; interactive sections are fragments so that using
+# them reruns only that section instead of the whole script.
 
 # ---------- HOME PAGE ----------
-if not st.session_state.logged_in and page == 'home':
+def page_home():
     st.markdown("""<div class="main-header"><h1>🌾 AgriLoop AI</h1><p>AI-Powered Agricultural Platform for Smart Farming & Circular Economy</p></div>""", unsafe_allow_html=True)
     
     col1, col2, col3 = st.columns([1, 1, 2])
@@ -218,7 +339,7 @@ if not st.session_state.logged_in and page == 'home':
             st.markdown(f"""<div style="text-align:center;"><div style="font-size:1.25rem;font-weight:bold;color:#16a34a;">{t}</div><div style="color:#6b7280;">{s}</div></div>""", unsafe_allow_html=True)
 
 # ---------- LOGIN PAGE ----------
-elif not st.session_state.logged_in and page == 'login':
+def page_login():
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
         st.markdown("""<div class="card" style="text-align:center;padding:2rem;"><h1>🌾 AgriLoop AI</h1><h2>Login</h2></div>""", unsafe_allow_html=True)
@@ -227,8 +348,9 @@ elif not st.session_state.logged_in and page == 'login':
         password = st.text_input("Password", type="password", placeholder="Enter your password")
         
         if st.button("Login", use_container_width=True, type="primary"):
-            if username in st.session_state.users:
-                if st.session_state.users[username]['password'] == hash_pw(password):
+            account = db.get('users', username)
+            if account:
+                if account['password'] == hash_pw(password):
                     st.session_state.logged_in = True
                     st.session_state.current_user = username
                     st.session_state.page = 'dashboard'
@@ -245,7 +367,7 @@ elif not st.session_state.logged_in and page == 'login':
             st.rerun()
 
 # ---------- REGISTER PAGE ----------
-elif not st.session_state.logged_in and page == 'register':
+def page_register():
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
         st.markdown("""<div class="card" style="text-align:center;padding:2rem;"><h1>🌾 AgriLoop AI</h1><h2>Register</h2></div>""", unsafe_allow_html=True)
@@ -260,16 +382,18 @@ elif not st.session_state.logged_in and page == 'register':
         if st.button("Register", use_container_width=True, type="primary"):
             if not email or not username or not password:
                 st.error("❌ Please fill all required fields")
-            elif username in st.session_state.users:
-                st.error("❌ Username already exists")
             else:
-                st.session_state.users[username] = {
-                    'password': hash_pw(password), 'email': email, 'full_name': full_name,
-                    'role': role, 'phone': phone, 'created_at': datetime.now().isoformat()
-                }
-                st.success("✅ Registration successful! Please login.")
-                st.session_state.page = 'login'
-                st.rerun()
+                try:
+                    db.insert('users', {
+                        'username': username, 'password': hash_pw(password), 'email': email, 'full_name': full_name,
+                        'role': role, 'phone': phone, 'created_at': datetime.now().isoformat()
+                    })
+                except DuplicateKeyError:
+                    st.error("❌ Username already exists")
+                else:
+                    st.success("✅ Registration successful! Please login.")
+                    st.session_state.page = 'login'
+                    st.rerun()
         
         st.markdown("---")
         st.markdown("Already have an account?")
@@ -277,19 +401,80 @@ elif not st.session_state.logged_in and page == 'register':
             go_to('login')
             st.rerun()
 
+# ---------- SUSTAINABILITY ----------
+IMPACT_GRAINS = {"Daily": ('day', 90), "Weekly": ('week', 52), "Monthly": ('month', 24)}  # grain, buckets charted
+IMPACT_COLORS = ["#16a34a", "#0ea5e9", "#f97316", "#a855f7", "#eab308", "#64748b", "#15803d"]
+
+def impact_metrics(totals):
+    amount = lambda v, unit: f"{v:,.0f} {unit}" if v >= 100 or not v else f"{v:,.1f} {unit}"
+    cols = st.columns(4)
+    cols[0].metric("💧 Water Saved", amount(totals['water_saved_l'], "L"))
+    cols[1].metric("♻️ Waste Diverted", amount(totals['waste_diverted_kg'], "kg"))
+    cols[2].metric("🥕 Food Rescued", amount(totals['food_rescued_kg'], "kg"))
+    cols[3].metric("🌍 CO₂e Avoided", amount(totals['co2e_avoided_kg'], "kg"))
+
+def impact_chart(x, columns, title, unit, horizontal=False):
+    """Stacked plotly bars of ``columns`` ({legend label: values}) against ``x``."""
+    import plotly.graph_objects as go
+    bars = [go.Bar(y=x, x=v, name=label, orientation='h') if horizontal else go.Bar(x=x, y=v, name=label)
+            for label, v in columns.items()]
+    fig = go.Figure(bars)
+    fig.update_layout(title=title, barmode='stack', height=320, margin=dict(l=10, r=10, t=40, b=10), colorway=IMPACT_COLORS,
+                      plot_bgcolor="white", legend=dict(orientation='h', y=-0.2), showlegend=len(columns) > 1)
+    fig.update_xaxes(title=unit if horizontal else None, gridcolor="#e5e7eb")
+    fig.update_yaxes(title=None if horizontal else unit, gridcolor="#e5e7eb", autorange='reversed' if horizontal else None)
+    st.plotly_chart(fig, use_container_width=True)
+
+def co2e_columns(s):
+    return {"Water": s['co2e_water_kg'], "Waste": s['co2e_waste_kg'], "Food": s['co2e_food_kg']}
+
+@fragment
+def impact_panel(farms):
+    """The user's (or one farm's) impact over time, read from the pre-aggregated rollup buckets."""
+    st.subheader("🌱 Sustainability Impact")
+    c1, c2 = st.columns([2, 3])
+    label = c1.radio("Period", list(IMPACT_GRAINS), index=1, horizontal=True, key='impact_grain')
+    scopes = {"All my activity": ('user', st.session_state.current_user)}
+    scopes.update({f"🏡 {f['name']} (#{f['id']})": ('farm', f['id']) for f in farms})
+    dimension, entity = scopes[c2.selectbox("Scope", list(scopes), key='impact_scope')]
+    grain, shown = IMPACT_GRAINS[label]
+    impact = get_impact()
+    totals = impact.totals(db, dimension, entity)
+    if not totals['co2e_avoided_kg']:
+        st.caption("No impact recorded yet: irrigation advisories, sold surplus and matched waste pickups all count.")
+        return
+    impact_metrics(totals)
+    s = impact.series(db, dimension, entity, grain)
+    s = {k: v[-shown:] for k, v in s.items()}
+    c1, c2 = st.columns(2)
+    with c1:
+        impact_chart(s['period'], {"Water saved": s['water_saved_l']}, "Water saved vs calendar irrigation", "L")
+    with c2:
+        impact_chart(s['period'], {**{t.replace('_', ' ').capitalize(): s[f"{t}_kg"] for t in WASTE_TYPES},
+                                   "Food rescued": s['food_rescued_kg']}, "Waste diverted and food rescued", "kg")
+    impact_chart(s['period'], co2e_columns(s), "Emissions avoided by source", "kg CO₂e")
+    if dimension == 'user' and len(farms) > 1:
+        names = {f['id']: f['name'] for f in farms}
+        top = impact.ranking(db, 'farm', entities=list(names), limit=10)
+        if top:
+            impact_chart([f"{names[f]} (#{f})" for f, _ in top], {"CO₂e avoided": [t['co2e_avoided_kg'] for _, t in top]},
+                         "Farms by emissions avoided", "kg CO₂e", horizontal=True)
+    st.caption("Water saved is measured against watering on a fixed schedule as if the soil were dry; emissions use indicative "
+               "factors for pumping energy, food production and landfill or burning avoided.")
+
 # ---------- DASHBOARD PAGE ----------
-elif st.session_state.logged_in and page == 'dashboard':
-    user = st.session_state.users[st.session_state.current_user]
+def page_dashboard():
+    user = current_account()
     st.title("🏠 Farmer Dashboard")
     st.caption(f"Welcome back, {user['full_name'] or st.session_state.current_user}!")
     
     uf = get_user_farms()
     uc = get_active_crops()
-    ua = [a for a in st.session_state.advisories if a['user'] == st.session_state.current_user]
-    us = [s for s in st.session_state.surplus_listings if s['user'] == st.session_state.current_user]
+    ua = recent_advisories(3)
+    us = db.find('surplus_listings', user=st.session_state.current_user)
     
     cols = st.columns(4)
-    for col, (val, label, color) in zip(cols, [(len(uf), "Farms", "green"), (len(uc), "Active Crops", "blue"), (len(us), "Surplus Listings", "orange"), (len(ua), "Advisories", "purple")]):
+    for col, (val, label, color) in zip(cols, [(len(uf), "Farms", "green"), (len(uc), "Active Crops", "blue"), (len(us), "Surplus Listings", "orange"), (db.count('advisories', user=st.session_state.current_user), "Advisories", "purple")]):
         with col:
             st.markdown(f"""<div class="metric-card"><div class="value {color}">{val}</div><div class="label">{label}</div></div>""", unsafe_allow_html=True)
     
@@ -314,8 +499,8 @@ elif st.session_state.logged_in and page == 'dashboard':
     with col1:
         st.subheader("Recent Advisories")
         if ua:
-            for a in ua[-3:][::-1]:
-                st.info(f"**{a['type'].title()}** - {a.get('recommendation', '')[:80]}...")
+            for a, text in ua:
+                st.info(f"**{a.type.title()}** - {text[:80]}...")
         else:
             st.caption("No advisories yet. Request one to get started.")
     with col2:
@@ -325,9 +510,72 @@ elif st.session_state.logged_in and page == 'dashboard':
                 st.success(f"**{s['quantity']} kg** - {s.get('crop', 'N/A')} ({s['harvest_date']})")
         else:
             st.caption("No surplus listings yet.")
+    
+    st.divider()
+    impact_panel(uf)
 
 # ---------- FARMS PAGE ----------
-elif st.session_state.logged_in and page == 'farms':
+@fragment
+def farm_list():
+    """The current page of the user's farms with their crops; delete and add-crop rerun only this list."""
+    farms, total = list_window('farms_list', 'farms', owner=st.session_state.current_user)
+    if not farms:
+        st.info("No farms yet. Click 'Add Farm' to get started.")
+    else:
+        for farm in farms:
+            with st.container():
+                c1, c2, c3 = st.columns([4, 1, 1])
+                with c1:
+                    st.markdown(f"### 🏡 {farm['name']}")
+                    location_display = farm.get('location_address') or f"({farm['location_latitude']}, {farm['location_longitude']})"
+                    st.caption(f"{farm['area_hectares']} hectares | {farm.get('soil_type') or 'Unknown soil'} | {location_display}")
+                with c3:
+                    if st.button("🗑️", key=f"del_{farm['id']}"):
+                        db.delete_cascade('farms', [farm['id']])
+                        rerun_fragment()
+                
+                crops = get_farm_crops(farm['id'])
+                with st.expander(f"🌾 Crops ({len(crops)})"):
+                    if crops:
+                        st.markdown("\n".join(f"- **{c['crop_name']}** - {c['area_hectares']} ha ({c['status']})" for c in crops))
+                    else:
+                        st.caption("No crops yet")
+                    
+                    # the crop form is only built for the farm it was opened on
+                    if st.session_state.get('crop_form_farm') != farm['id']:
+                        if st.button("➕ Add crop", key=f"addc_{farm['id']}"):
+                            st.session_state.crop_form_farm = farm['id']
+                            rerun_fragment()
+                    else:
+                        st.markdown("---")
+                        st.markdown("**Add Crop**")
+                        with st.form(f"crop_{farm['id']}"):
+                            c1, c2 = st.columns(2)
+                            cn = c1.text_input("Crop Name", key=f"cn{farm['id']}")
+                            ca = c2.number_input("Area (ha)", min_value=0.01, value=0.5, key=f"ca{farm['id']}")
+                            c1, c2 = st.columns(2)
+                            pdate = c1.date_input("Planting Date", key=f"pd{farm['id']}")
+                            hd = c2.date_input("Harvest Date", key=f"hd{farm['id']}")
+                            c1, c2 = st.columns(2)
+                            if c1.form_submit_button("Add Crop"):
+                                if cn:
+                                    db.insert('crops', {
+                                        'farm_id': farm['id'], 'crop_name': cn,
+                                        'area_hectares': ca, 'planting_date': pdate.isoformat(), 'expected_harvest_date': hd.isoformat(),
+                                        'status': 'active', 'owner': st.session_state.current_user, 'created_at': datetime.now().isoformat()
+                                    })
+                                    st.session_state.crop_form_farm = None
+                                    st.success(f"✅ Crop '{cn}' added!")
+                                    rerun_fragment()
+                            if c2.form_submit_button("Cancel"):
+                                st.session_state.crop_form_farm = None
+                                rerun_fragment()
+                st.divider()
+        pager('farms_list', total)
+
+def page_farms():
+    from agriloop.importer import SOIL_TYPES, bulk_import
+    from agriloop.sensors import import_readings
     st.title("🌱 My Farms")
     
     col1, col2 = st.columns([4, 1])
@@ -345,13 +593,13 @@ elif st.session_state.logged_in and page == 'farms':
                 lat = c1.number_input("Latitude *", value=28.6139, format="%.6f")
                 lng = c2.number_input("Longitude *", value=77.2090, format="%.6f")
                 address = st.text_input("Address")
-                soil = st.selectbox("Soil Type", ["", "clay", "sandy", "loamy", "silty", "peaty", "chalky"])
+                soil = st.selectbox("Soil Type", ["", *SOIL_TYPES])
                 
                 c1, c2 = st.columns(2)
                 if c1.form_submit_button("Add Farm", use_container_width=True, type="primary"):
                     if name:
-                        st.session_state.farms.append({
-                            'id': len(st.session_state.farms) + 1, 'name': name, 'area_hectares': area,
+                        db.insert('farms', {
+                            'name': name, 'area_hectares': area,
                             'location_latitude': lat, 'location_longitude': lng, 'location_address': address,
                             'soil_type': soil or None, 'owner': st.session_state.current_user, 'created_at': datetime.now().isoformat()
                         })
@@ -362,57 +610,35 @@ elif st.session_state.logged_in and page == 'farms':
                     st.session_state.show_farm_form = False
                     st.rerun()
     
-    farms = get_user_farms()
-    if not farms:
-        st.info("No farms yet. Click 'Add Farm' to get started.")
-    else:
-        for farm in farms:
-            with st.container():
-                c1, c2, c3 = st.columns([4, 1, 1])
-                with c1:
-                    st.markdown(f"### 🏡 {farm['name']}")
-                    location_display = farm.get('location_address') or f"({farm['location_latitude']}, {farm['location_longitude']})"
-                    st.caption(f"{farm['area_hectares']} hectares | {farm.get('soil_type') or 'Unknown soil'} | {location_display}")
-                with c3:
-                    if st.button("🗑️", key=f"del_{farm['id']}"):
-                        st.session_state.farms = [f for f in st.session_state.farms if f['id'] != farm['id']]
-                        st.session_state.crops = [c for c in st.session_state.crops if c['farm_id'] != farm['id']]
-                        st.rerun()
-                
-                crops = get_farm_crops(farm['id'])
-                with st.expander(f"🌾 Crops ({len(crops)})"):
-                    if crops:
-                        for c in crops:
-                            st.write(f"• **{c['crop_name']}** - {c['area_hectares']} ha ({c['status']})")
-                    else:
-                        st.caption("No crops yet")
-                    
-                    st.markdown("---")
-                    st.markdown("**Add Crop**")
-                    with st.form(f"crop_{farm['id']}"):
-                        c1, c2 = st.columns(2)
-                        cn = c1.text_input("Crop Name", key=f"cn{farm['id']}")
-                        ca = c2.number_input("Area (ha)", min_value=0.01, value=0.5, key=f"ca{farm['id']}")
-                        c1, c2 = st.columns(2)
-                        pd = c1.date_input("Planting Date", key=f"pd{farm['id']}")
-                        hd = c2.date_input("Harvest Date", key=f"hd{farm['id']}")
-                        if st.form_submit_button("Add Crop"):
-                            if cn:
-                                st.session_state.crops.append({
-                                    'id': len(st.session_state.crops) + 1, 'farm_id': farm['id'], 'crop_name': cn,
-                                    'area_hectares': ca, 'planting_date': pd.isoformat(), 'expected_harvest_date': hd.isoformat(),
-                                    'status': 'active', 'owner': st.session_state.current_user
-                                })
-                                st.success(f"✅ Crop '{cn}' added!")
-                                st.rerun()
-                st.divider()
+    with st.expander("📥 Bulk Import (CSV / Parquet)"):
+        kind = st.radio("Import", ["farms", "crops", "readings"], horizontal=True, format_func=lambda k: "Sensor Readings" if k == "readings" else k.title())
+        st.caption("Farms need columns name, area_hectares, location_latitude, location_longitude (optional location_address, soil_type). "
+                   "Crops need farm_id, crop_name, area_hectares (optional planting_date, expected_harvest_date, status). "
+                   "Sensor readings need crop_id, ts (optional soil_moisture, temperature, humidity, rainfall).")
+        upload = st.file_uploader("Upload file", type=["csv", "parquet"], key="bulk_upload")
+        if upload and st.button("📥 Import", type="primary"):
+            bar = st.progress(0.0, text="Importing...")
+            try:
+                if kind == 'readings':
+                    res = import_readings(get_sensor_store(), upload, upload.name, {c['id'] for c in get_user_crops()})
+                else:
+                    res = bulk_import(db, kind, upload, upload.name, st.session_state.current_user,
+                                      on_progress=lambda seen, ins, rej: bar.progress(min(1.0, upload.tell() / max(upload.size, 1)), text=f"{seen:,} rows read"))
+            except (ValueError, ImportError) as e:
+                st.error(f"❌ {e}")
+            else:
+                bar.progress(1.0, text="Done")
+                st.success(f"✅ Imported {res['inserted']:,} {kind}" + (f", rejected {res['rejected']:,} rows" if res['rejected'] else ""))
+                if len(res['errors']):
+                    st.dataframe(res['errors'], use_container_width=True, hide_index=True)
+                    st.download_button("⬇️ Error Report", res['errors'].to_csv(index=False), f"{kind}_import_errors.csv", "text/csv")
+    
+    farm_list()
 
 # ---------- ADVISORY PAGE ----------
-elif st.session_state.logged_in and page == 'advisory':
-    st.title("💧 Crop Advisory")
-    
-    crops = get_active_crops()
-    
+@fragment
+def irrigation_panel(crops):
+    """Manual irrigation form plus the advisory history it appends to."""
     st.subheader("🤖 AI Irrigation Recommendation")
     if not crops:
         st.warning("⚠️ Add farms and crops first to get irrigation advice.")
@@ -422,17 +648,30 @@ elif st.session_state.logged_in and page == 'advisory':
             with c1:
                 opts = {}
                 for c in crops:
-                    f = next((f for f in st.session_state.farms if f['id'] == c['farm_id']), None)
-                    opts[f"{f['name'] if f else 'Farm'} - {c['crop_name']}"] = c
+                    f = db.get('farms', c['farm_id'])
+                    opts[f"{f['name'] if f else 'Farm'} - {c['crop_name']}"] = (c, f)
                 sel = st.selectbox("Select Crop *", list(opts.keys()))
-                crop = opts[sel]
+                crop, farm = opts[sel]
                 soil_m = st.slider("Soil Moisture (%)", 0, 100, 50)
                 temp = st.slider("Temperature (°C)", 0, 50, 25)
             with c2:
                 humid = st.slider("Humidity (%)", 0, 100, 60)
                 rain = st.slider("Rainfall (mm, last 7 days)", 0, 100, 0)
+                weather = get_weather()
+                live = st.checkbox("🌦️ Use current weather at the farm", value=weather is not None, disabled=weather is None,
+                                   help=f"Temperature, humidity and rainfall from {weather.name}." if weather is not None else "No weather source configured (AGRILOOP_WEATHER).")
             
             if st.form_submit_button("🔮 Get Recommendation", use_container_width=True, type="primary"):
+                if live and weather is not None:
+                    if farm and farm.get('location_latitude') is not None and farm.get('location_longitude') is not None:
+                        try:
+                            w = weather.lookup(farm['location_latitude'], farm['location_longitude'])
+                            temp, humid, rain = w['temperature'], w['humidity'], w['rainfall']
+                            st.caption(f"🌦️ {weather.name}: {temp:.1f} °C, {humid:.0f}% humidity, {rain:.1f} mm rain in the last 7 days")
+                        except WeatherUnavailable as e:
+                            st.warning(f"⚠️ Weather unavailable ({e}); using the values entered.")
+                    else:
+                        st.warning("⚠️ This farm has no location; using the values entered.")
                 r = get_irrigation_rec(soil_m, temp, humid, rain, crop['crop_name'], crop['area_hectares'])
                 
                 st.markdown("""<div class="result-box"><h3>📊 Recommendation</h3></div>""", unsafe_allow_html=True)
@@ -447,32 +686,93 @@ elif st.session_state.logged_in and page == 'advisory':
                 if r['risks']:
                     st.warning("**Risk Factors:** " + ", ".join(r['risks']))
                 
-                st.session_state.advisories.append({
-                    'id': len(st.session_state.advisories) + 1, 'user': st.session_state.current_user,
-                    'crop_id': crop['id'], 'type': 'irrigation', 'status': 'completed',
-                    'recommendation': r['recommendation'], 'volume': r['volume'], 'frequency': r['frequency'],
-                    'created_at': datetime.now().isoformat()
-                })
+                db.insert('advisories', advisory_record(st.session_state.current_user, crop['id'], r, soil_m))
     
     st.divider()
     st.subheader("📋 Advisory History")
-    ua = [a for a in st.session_state.advisories if a['user'] == st.session_state.current_user]
+    ua = recent_advisories(10)
     if ua:
-        for a in ua[-10:][::-1]:
-            st.markdown(f"""<div class="card"><strong>{a['type'].title()}</strong> <span style="color:#6b7280;">- {a.get('created_at', '')[:10]}</span><p>{a.get('recommendation', '')}</p></div>""", unsafe_allow_html=True)
+        for a, text in ua:
+            st.markdown(f"""<div class="card"><strong>{a.type.title()}</strong> <span style="color:#6b7280;">- {a.created_at[:10]}</span><p>{text}</p></div>""", unsafe_allow_html=True)
     else:
         st.info("No advisories yet.")
 
-# ---------- SURPLUS PAGE ----------
-elif st.session_state.logged_in and page == 'surplus':
-    st.title("📦 Surplus Management")
+def page_advisory():
+    st.title("💧 Crop Advisory")
     
     crops = get_active_crops()
     
-    c1, c2 = st.columns([4, 1])
-    with c2:
-        show_surplus = st.button("➕ Add Listing", use_container_width=True, type="primary")
+    irrigation_panel(crops)
+    
+    sensors = get_sensor_store()
+    sensors.apply_retention(min_interval=3600)
+    sensors.refresh_advisories(crops, crop_weather if get_weather() is not None else None)
+    live = [(c, sensors.advisories[c['id']]) for c in crops if c['id'] in sensors.advisories]
+    if live:
+        st.divider()
+        st.subheader("📡 Sensor-Driven Advisories")
+        st.caption("Recomputed automatically from the latest sensor window whenever a crop's readings change.")
+        urg_icon = {"high": "🔴", "medium": "🟡", "low": "🟢", "none": "⚪"}
+        data = [{'Crop': c['crop_name'], 'Last Reading': datetime.fromtimestamp(a['ts']).strftime('%Y-%m-%d %H:%M'), 'Moisture (%)': a['soil_moisture'],
+                 'Volume (L)': round(float(a['volume']), 1), 'Every (days)': int(a['frequency']), 'Urgency': f"{urg_icon[str(a['urgency'])]} {str(a['urgency']).title()}",
+                 'Recommendation': recommendation_text(a['level'], c['crop_name'], a['soil_moisture'])} for c, a in live]
+        st.dataframe(table_frame(data), use_container_width=True, hide_index=True)
+    
+    st.divider()
+    schedule_panel(crops, sensors)
+
+def _first(*values):
+    return next(v for v in values if v is not None and v == v)
+
+@fragment
+def schedule_panel(crops, sensors):
+    """Day-by-day irrigation plan for all active crops, optionally within a shared daily water budget."""
+    st.subheader("📅 Irrigation Schedule")
+    if not crops:
+        st.info("Add crops to plan irrigation.")
+        return
+    c1, c2 = st.columns(2)
+    days = c1.slider("Horizon (days)", HORIZONS[0], HORIZONS[1], HORIZONS[0], key='plan_days')
+    budget = c2.number_input("Daily water budget, all farms (L, 0 = unlimited)", min_value=0, value=0, step=10_000, key='plan_budget')
+    planner = st.session_state.get('planner')
+    if planner is None or planner.days != days:
+        planner = st.session_state.planner = IrrigationPlanner(days)
+    weather = crop_weather(crops) if get_weather() is not None else [None] * len(crops)
+    sm, temp, humid = [], [], []
+    for c, w in zip(crops, weather):
+        a = sensors.advisories.get(c['id'])
+        x, w = (a['inputs'] if a else {}), (w or {})
+        sm.append(a['soil_moisture'] if a else 50.0)
+        temp.append(_first(x.get('temperature'), w.get('temperature'), 25.0))
+        humid.append(_first(x.get('humidity'), w.get('humidity'), 60.0))
+    planner.update([c['id'] for c in crops], sm, [c['area_hectares'] for c in crops], temp, humid)
+    plan = planner.plan(float(budget) or None)
+    import pandas as pd
+    
+    cols = st.columns(3)
+    cols[0].metric("💧 Planned Water", f"{plan['used'].sum():,.0f} L")
+    cols[1].metric("📈 Peak Day", f"{plan['used'].max():,.0f} L")
+    cols[2].metric("⚠️ Dry Field-Days", f"{int((plan['moisture'] < TRIGGER).sum()):,}")
+    st.bar_chart(pd.DataFrame({'Planned water (L)': plan['used']}, index=pd.RangeIndex(1, days + 1, name='Day')))
     
+    watered = plan['litres'] > 0
+    first_day = np.where(watered.any(axis=1), watered.argmax(axis=1), days)
+    order = np.lexsort((-plan['stress'], first_day))[:50]
+    # plan rows follow planner.ids, which need not be the order of this rerun's crops
+    by_id = {c['id']: (c, m) for c, m in zip(crops, sm)}
+    rows = [by_id[i] for i in planner.ids]
+    data = [{'Crop': rows[i][0]['crop_name'], 'Moisture now (%)': round(rows[i][1], 1),
+             'Irrigate on days': ", ".join(str(d + 1) for d in np.flatnonzero(watered[i])) or "-",
+             'Water (L)': round(float(plan['litres'][i].sum())), 'Lowest moisture (%)': round(float(plan['moisture'][i].min()), 1)}
+            for i in order]
+    st.caption(f"Soil water balance over {days} days with no rain assumed; the {len(data)} of {len(crops)} crops needing water soonest. "
+               + ("Within the budget the driest fields are watered first." if budget else ""))
+    st.dataframe(table_frame(data), use_container_width=True, hide_index=True)
+
+# ---------- SURPLUS PAGE ----------
+@fragment
+def prediction_panel(crops):
+    """Single-crop prediction and the all-crop forecast; neither writes, so they rerun alone."""
     st.subheader("🔮 Predict Surplus")
     if not crops:
         st.warning("⚠️ Add crops first to predict surplus.")
@@ -482,7 +782,7 @@ elif st.session_state.logged_in and page == 'surplus':
             with c1:
                 opts = {}
                 for c in crops:
-                    f = next((f for f in st.session_state.farms if f['id'] == c['farm_id']), None)
+                    f = db.get('farms', c['farm_id'])
                     opts[f"{f['name'] if f else 'Farm'} - {c['crop_name']}"] = (c, f)
                 sel = st.selectbox("Select Crop *", list(opts.keys()))
                 crop, farm = opts[sel]
@@ -491,7 +791,9 @@ elif st.session_state.logged_in and page == 'surplus':
                 storage = st.number_input("Storage Capacity (kg)", min_value=0, value=500)
             
             if st.form_submit_button("📊 Predict", use_container_width=True, type="primary"):
-                yld = predict_yield(crop['crop_name'], crop['area_hectares'], farm.get('soil_type') if farm else None)
+                model = get_yield_model()
+                w = crop_weather([crop])[0] if model is not None and get_weather() is not None else None
+                yld = predict_yield(crop['crop_name'], crop['area_hectares'], farm.get('soil_type') if farm else None, model, w)
                 r = predict_surplus(yld, demand, storage)
                 
                 st.markdown("""<div class="result-box"><h3>📊 Prediction Results</h3></div>""", unsafe_allow_html=True)
@@ -507,6 +809,94 @@ elif st.session_state.logged_in and page == 'surplus':
                     for rec in r['recs']:
                         st.write(f"• {rec}")
     
+        st.subheader("🎲 Surplus Forecast (All Active Crops)")
+        with st.form("forecast"):
+            c1, c2, c3, c4 = st.columns(4)
+            f_demand = c1.number_input("Market Demand per Crop (kg)", min_value=0, value=1000)
+            f_storage = c2.number_input("Storage Capacity per Crop (kg)", min_value=0, value=500)
+            f_samples = c3.select_slider("Samples", options=[1000, 2000, 5000, 10000, 20000], value=5000)
+            f_seed = c4.number_input("Seed", min_value=0, value=42)
+            if st.form_submit_button("🎲 Run Forecast", use_container_width=True):
+                farms = {c['farm_id']: db.get('farms', c['farm_id']) for c in crops}
+                fc = cached_forecast(tuple(c['crop_name'] for c in crops), tuple(c['area_hectares'] for c in crops),
+                                     tuple((farms[c['farm_id']] or {}).get('soil_type') for c in crops), f_demand, f_storage, f_samples, f_seed)
+                data = [{'Farm': (farms[c['farm_id']] or {}).get('name', 'Farm'), 'Crop': c['crop_name'], 'Yield P50 (kg)': round(fc['yield_p50'][i]),
+                         'Surplus P10 (kg)': round(fc['p10'][i]), 'Surplus P50 (kg)': round(fc['p50'][i]), 'Surplus P90 (kg)': round(fc['p90'][i]),
+                         'P(exceeds storage)': f"{fc['p_exceed'][i]:.0%}"} for i, c in enumerate(crops)]
+                st.dataframe(table_frame(data), use_container_width=True, hide_index=True)
+
+@fragment
+def surplus_list():
+    """The current page of the user's surplus listings."""
+    us, total = list_window('surplus_list', 'surplus_listings', user=st.session_state.current_user)
+    if us:
+        st.markdown("".join(f"""<div class="card"><h4>{s['quantity']} kg - {s.get('crop', 'N/A')}</h4><p>📅 {s['harvest_date']} | {'💰 $' + str(s['unit_price']) + '/kg' if s.get('unit_price') else 'No price set'}</p><span style="background:#fed7aa;color:#c2410c;padding:0.25rem 0.5rem;border-radius:0.25rem;font-size:0.75rem;">{s['status'].title()}</span></div>""" for s in us), unsafe_allow_html=True)
+        pager('surplus_list', total)
+    else:
+        st.info("No surplus listings yet.")
+
+MARKET_SORTS = {"Lowest price": ('price', False), "Highest price": ('price', True),
+                "Earliest harvest": ('harvest_date', False), "Latest harvest": ('harvest_date', True)}
+
+@fragment
+def marketplace():
+    """Every seller's available listings, searched through the listing index; filtering and paging rerun only this section."""
+    index = get_listing_index()
+    facets = index.crop_facets(db)
+    if not facets:
+        st.info("No listings on the market yet.")
+        return
+    home = next(((f['location_latitude'], f['location_longitude']) for f in get_user_farms()
+                 if f.get('location_latitude') is not None and f.get('location_longitude') is not None), None)
+    sorts = dict(MARKET_SORTS, **({"Nearest": ('distance', False)} if home else {}))
+    c1, c2 = st.columns([3, 1])
+    options = sorted(set(facets) | set(st.session_state.get('mkt_crops', ())), key=lambda c: (-facets.get(c, 0), str(c)))
+    crops = c1.multiselect("Crops", options,
+                           format_func=lambda c: f"{c} ({facets.get(c, 0):,})", key="mkt_crops")
+    sort, descending = sorts[c2.selectbox("Sort by", list(sorts), key="mkt_sort")]
+    c1, c2, c3, c4 = st.columns(4)
+    min_qty = c1.number_input("Min quantity (kg)", min_value=0, value=0, key="mkt_min_qty")
+    max_qty = c2.number_input("Max quantity (kg)", min_value=0, value=0, key="mkt_max_qty", help="0 = no limit")
+    min_price = c3.number_input("Min price per kg", min_value=0.0, value=0.0, key="mkt_min_price")
+    max_price = c4.number_input("Max price per kg", min_value=0.0, value=0.0, key="mkt_max_price", help="0 = no limit")
+    c1, c2 = st.columns(2)
+    window = c1.date_input("Harvest between", value=(), key="mkt_harvest")
+    radius = c2.number_input("Within km of your farm", min_value=0, value=0, key="mkt_radius", disabled=not home,
+                             help="0 = anywhere" if home else "Add a farm with a location to search by distance")
+    query = {'crops': crops or None, 'min_quantity': min_qty or None, 'max_quantity': max_qty or None,
+             'min_price': min_price or None, 'max_price': max_price or None,
+             'harvest_from': window[0] if window else None, 'harvest_to': window[1] if len(window) > 1 else None,
+             'near': home, 'radius_km': (radius or None) if home else None, 'sort': sort, 'descending': descending}
+
+    # a new query starts from its first page
+    signature = repr(sorted(query.items(), key=lambda kv: kv[0]))
+    if st.session_state.get('mkt_query') != signature:
+        st.session_state.mkt_query = signature
+        st.session_state.mkt_page = 1
+    page_size = 10
+    rows, total = index.search(db, offset=(st.session_state.get('mkt_page', 1) - 1) * page_size, limit=page_size, **query)
+    if not rows and total:
+        st.session_state.mkt_page = -(-total // page_size)
+        rows, total = index.search(db, offset=(st.session_state.mkt_page - 1) * page_size, limit=page_size, **query)
+    if not rows:
+        st.info("No listings match these filters.")
+        return
+    st.caption(f"{total:,} matching listings")
+    dist = lambda s: f" | 📍 {s['distance_km']:.0f} km" if s.get('distance_km') is not None else ""
+    st.markdown("".join(f"""<div class="card"><h4>{s['quantity']} kg - {s.get('crop', 'N/A')}</h4><p>📅 {s['harvest_date']} | {'💰 $' + str(s['unit_price']) + '/kg' if s.get('unit_price') else 'No price set'} | 👤 {s['user']}{dist(s)}</p></div>""" for s in rows), unsafe_allow_html=True)
+    pager('mkt', total, page_size)
+
+def page_surplus():
+    st.title("📦 Surplus Management")
+    
+    crops = get_active_crops()
+    
+    c1, c2 = st.columns([4, 1])
+    with c2:
+        show_surplus = st.button("➕ Add Listing", use_container_width=True, type="primary")
+    
+    prediction_panel(crops)
+    
     st.divider()
     
     if show_surplus or st.session_state.get('show_surplus_form'):
@@ -523,8 +913,8 @@ elif st.session_state.logged_in and page == 'surplus':
                     
                     c1, c2 = st.columns(2)
                     if c1.form_submit_button("Add Listing", use_container_width=True, type="primary"):
-                        st.session_state.surplus_listings.append({
-                            'id': len(st.session_state.surplus_listings) + 1, 'user': st.session_state.current_user,
+                        db.insert('surplus_listings', {
+                            'user': st.session_state.current_user,
                             'crop_id': crop_opts[sel_crop]['id'], 'crop': sel_crop, 'quantity': qty,
                             'harvest_date': hdate.isoformat(), 'unit_price': price if price > 0 else None,
                             'status': 'available', 'created_at': datetime.now().isoformat()
@@ -537,15 +927,71 @@ elif st.session_state.logged_in and page == 'surplus':
                         st.rerun()
     
     st.subheader("📋 Surplus Listings")
-    us = [s for s in st.session_state.surplus_listings if s['user'] == st.session_state.current_user]
-    if us:
-        for s in us[::-1]:
-            st.markdown(f"""<div class="card"><h4>{s['quantity']} kg - {s.get('crop', 'N/A')}</h4><p>📅 {s['harvest_date']} | {'💰 $' + str(s['unit_price']) + '/kg' if s.get('unit_price') else 'No price set'}</p><span style="background:#fed7aa;color:#c2410c;padding:0.25rem 0.5rem;border-radius:0.25rem;font-size:0.75rem;">{s['status'].title()}</span></div>""", unsafe_allow_html=True)
-    else:
-        st.info("No surplus listings yet.")
+    surplus_list()
+
+    st.divider()
+    st.subheader("🛒 Marketplace")
+    marketplace()
 
 # ---------- CIRCULAR ECONOMY PAGE ----------
-elif st.session_state.logged_in and page == 'circular':
+@fragment
+def partner_grid():
+    """The current page of partner cards."""
+    partners, total = list_window('partners_list', 'partners', page_size=9)
+    st.markdown('<div style="display:grid;grid-template-columns:repeat(3,1fr);gap:1rem;">' + "".join(f"""
+            <div class="partner-card">
+                <h4>{p['name']}</h4>
+                <p class="type">{p['type'].replace('_', ' ')}</p>
+                <p class="capacity">Capacity: {p['capacity']} kg/day</p>
+                <p class="rating">{'⭐' * int(p['rating'])} ({p['rating']})</p>
+            </div>""" for p in partners) + "</div>", unsafe_allow_html=True)
+    pager('partners_list', total, page_size=9)
+
+@fragment
+def waste_list():
+    """The current page of the user's waste requests; matching one reruns only this list."""
+    ur, total = list_window('waste_list', 'waste_requests', user=st.session_state.current_user)
+    if ur:
+        for r in ur:
+            c1, c2, c3 = st.columns([3, 1, 1])
+            with c1:
+                st.markdown(f"""
+                <div class="card">
+                    <h4 style="text-transform:capitalize;">{r['waste_type'].replace('_', ' ')}</h4>
+                    <p>{r['quantity_kg']} kg | {r.get('created_at', '')[:10]}</p>
+                    {'<p style="color:#16a34a !important;">✅ Matched with partner</p>' if r.get('partner_id') else ''}
+                </div>
+                """, unsafe_allow_html=True)
+            with c2:
+                colors = {'pending': '🟡', 'matched': '🟢', 'completed': '✅'}
+                st.write(f"{colors.get(r['status'], '⚪')} {r['status'].title()}")
+            with c3:
+                if r['status'] == 'pending':
+                    if st.button("🔗 Match", key=f"m{r['id']}"):
+                        # capacity is read and then claimed, so matches from all sessions take turns
+                        with action_lock('match'):
+                            current = db.get('waste_requests', r['id'])
+                            if not current or current['status'] != 'pending':
+                                options = None
+                            else:
+                                load = load_for(db).load(db)
+                                options = get_partner_index().nearest(r['location_latitude'], r['location_longitude'], k=3,
+                                                                      waste_type=r['waste_type'], quantity=r['quantity_kg'], load=load)
+                                if options:
+                                    p, dist, _ = options[0]
+                                    db.update('waste_requests', r['id'], partner_id=p['id'], status='matched', matched_at=datetime.now().isoformat())
+                        if options is None:  # matched from another session meanwhile
+                            rerun_fragment()
+                        elif options:
+                            st.success(f"✅ Matched with {p['name']} ({dist:.1f} km away)!")
+                            rerun_fragment()
+                        else:
+                            st.error("❌ No compatible partner with spare capacity today")
+        pager('waste_list', total)
+    else:
+        st.info("No waste requests yet.")
+
+def page_circular():
     st.title("♻️ Circular Economy Marketplace")
     
     c1, c2 = st.columns([4, 1])
@@ -553,17 +999,7 @@ elif st.session_state.logged_in and page == 'circular':
         show_waste = st.button("➕ Create Request", use_container_width=True, type="primary")
     
     st.subheader("🤝 Available Partners")
-    cols = st.columns(3)
-    for i, p in enumerate(st.session_state.partners):
-        with cols[i % 3]:
-            st.markdown(f"""
-            <div class="partner-card">
-                <h4>{p['name']}</h4>
-                <p class="type">{p['type'].replace('_', ' ')}</p>
-                <p class="capacity">Capacity: {p['capacity']} kg/day</p>
-                <p class="rating">{'⭐' * int(p['rating'])} ({p['rating']})</p>
-            </div>
-            """, unsafe_allow_html=True)
+    partner_grid()
     
     st.divider()
     
@@ -581,8 +1017,8 @@ elif st.session_state.logged_in and page == 'circular':
                 
                 c1, c2 = st.columns(2)
                 if c1.form_submit_button("Create Request", use_container_width=True, type="primary"):
-                    st.session_state.waste_requests.append({
-                        'id': len(st.session_state.waste_requests) + 1, 'user': st.session_state.current_user,
+                    db.insert('waste_requests', {
+                        'user': st.session_state.current_user,
                         'waste_type': wtype, 'quantity_kg': qty, 'location_latitude': lat,
                         'location_longitude': lng, 'location_address': addr, 'status': 'pending',
                         'partner_id': None, 'created_at': datetime.now().isoformat()
@@ -595,35 +1031,191 @@ elif st.session_state.logged_in and page == 'circular':
                     st.rerun()
     
     st.subheader("📋 My Waste Requests")
-    ur = [r for r in st.session_state.waste_requests if r['user'] == st.session_state.current_user]
-    if ur:
-        for r in ur[::-1]:
-            c1, c2, c3 = st.columns([3, 1, 1])
-            with c1:
-                st.markdown(f"""
-                <div class="card">
-                    <h4 style="text-transform:capitalize;">{r['waste_type'].replace('_', ' ')}</h4>
-                    <p>{r['quantity_kg']} kg | {r.get('created_at', '')[:10]}</p>
-                    {'<p style="color:#16a34a !important;">✅ Matched with partner</p>' if r.get('partner_id') else ''}
-                </div>
-                """, unsafe_allow_html=True)
-            with c2:
-                colors = {'pending': '🟡', 'matched': '🟢', 'completed': '✅'}
-                st.write(f"{colors.get(r['status'], '⚪')} {r['status'].title()}")
-            with c3:
-                if r['status'] == 'pending':
-                    if st.button("🔗 Match", key=f"m{r['id']}"):
-                        if st.session_state.partners:
-                            r['partner_id'] = st.session_state.partners[0]['id']
-                            r['status'] = 'matched'
-                            st.success(f"✅ Matched with {st.session_state.partners[0]['name']}!")
-                            st.rerun()
-    else:
-        st.info("No waste requests yet.")
+    waste_list()
 
 # ---------- ADMIN PAGE ----------
-elif st.session_state.logged_in and page == 'admin':
-    user = st.session_state.users[st.session_state.current_user]
+@fragment
+def admin_users(roles):
+    """User list with bulk role changes and deletion; those rerun the whole page to refresh the counts."""
+    st.subheader("User Management")
+    shown = paged_table('users', [('username', 'Username'), ('email', 'Email'), ('full_name', 'Name'), ('role', 'Role')],
+                        filter_col='role', filter_options=list(roles))
+    
+    st.markdown("---")
+    st.subheader("Bulk Actions")
+    st.caption("Acts on the selected users of the current page.")
+    others = [u for u in shown if u != st.session_state.current_user]
+    # the selection outlives paging, search and filtering; keep only users this page still shows
+    if st.session_state.get('adm_sel_users'):
+        st.session_state.adm_sel_users = [u for u in st.session_state.adm_sel_users if u in others]
+    if others:
+        sel = [u for u in st.multiselect("Users", others, key="adm_sel_users") if u in others]
+        c1, c2, c3 = st.columns([2, 1, 1])
+        new_r = c1.selectbox("New Role", ["farmer", "processor", "waste_converter", "admin"])
+        with c2:
+            st.write("")
+            st.write("")
+            if st.button("Update Role", disabled=not sel):
+                db.update_many('users', [(u, {'role': new_r}) for u in sel])
+                st.toast(f"✅ Updated {len(sel)} user(s) to {new_r}")
+                del st.session_state.adm_sel_users
+                st.rerun()
+        with c3:
+            st.write("")
+            st.write("")
+            if st.button("🗑️ Delete", disabled=not sel):
+                removed = db.delete_cascade('users', sel)
+                extra = ", ".join(f"{n} {t.replace('_', ' ')}" for t, n in removed.items() if t != 'users')
+                st.toast(f"✅ Deleted {removed.get('users', 0)} user(s)" + (f" with {extra}" if extra else ""))
+                del st.session_state.adm_sel_users
+                st.rerun()
+
+@fragment
+def admin_farms():
+    """Paged table of every farm."""
+    st.subheader("All Farms")
+    if db.count('farms'):
+        paged_table('farms', [('id', 'ID'), ('name', 'Name'), ('area_hectares', 'Area'), ('owner', 'Owner'), ('soil_type', 'Soil')])
+    else:
+        st.info("No farms yet")
+
+@fragment
+def admin_partners():
+    """Paged partner table and the add-partner form."""
+    st.subheader("Partners")
+    if db.count('partners'):
+        paged_table('partners', [('id', 'ID'), ('name', 'Name'), ('type', 'Type'), ('capacity', 'Capacity'), ('rating', 'Rating')],
+                    filter_col='type', filter_options=PARTNER_TYPES)
+    
+    st.markdown("---")
+    st.subheader("Add Partner")
+    with st.form("add_partner"):
+        c1, c2 = st.columns(2)
+        pname = c1.text_input("Name *")
+        ptype = c2.selectbox("Type", PARTNER_TYPES)
+        c1, c2, c3 = st.columns(3)
+        cap = c1.number_input("Capacity (kg/day)", min_value=1, value=1000)
+        plat = c2.number_input("Latitude", value=28.6139, format="%.6f")
+        plng = c3.number_input("Longitude", value=77.2090, format="%.6f")
+        
+        if st.form_submit_button("Add Partner", use_container_width=True, type="primary"):
+            if pname:
+                db.insert('partners', {
+                    'name': pname, 'type': ptype,
+                    'capacity': cap, 'lat': plat, 'lng': plng, 'rating': 0
+                })
+                st.success(f"✅ Partner '{pname}' added!")
+                rerun_fragment()
+
+@fragment
+def admin_assignments():
+    """Batch assignment of all pending waste requests."""
+    st.subheader("Batch Waste Assignment")
+    n_pending = db.count('waste_requests', status='pending')
+    st.caption(f"{n_pending} pending waste requests. Assigns all of them at once, minimizing total transport distance within each partner's remaining daily capacity.")
+    if st.button("⚙️ Optimize Assignments", type="primary", disabled=not n_pending):
+        with action_lock('match'):
+            pending = db.find('waste_requests', status='pending')
+            load = load_for(db).load(db)
+            result = assign_batch(pending, get_partner_index(), load=load)
+            now = datetime.now().isoformat()
+            updates = [(r['id'], {'partner_id': p['id'], 'status': 'matched', 'matched_at': now}) for r, p, _ in result if p]
+            db.update_many('waste_requests', updates)
+        km = sum(d for _, p, d in result if p)
+        st.success(f"✅ Assigned {len(updates)} of {len(pending)} requests ({km:,.1f} km total)")
+        if len(updates) < len(pending):
+            st.warning(f"⚠️ {len(pending) - len(updates)} requests have no compatible partner with spare capacity today")
+
+@fragment
+def admin_logistics():
+    """Pickup route planning for matched requests."""
+    st.subheader("Pickup Route Planning")
+    n_matched = db.count('waste_requests', status='matched')
+    st.caption(f"{n_matched} matched waste requests awaiting pickup. Routes start and end at each partner's depot.")
+    vcap = st.number_input("Vehicle Capacity (kg)", min_value=1, value=2000)
+    if st.button("🗺️ Plan Routes", type="primary", disabled=not n_matched):
+        matched = db.find('waste_requests', status='matched')
+        if 'route_planner' not in st.session_state:
+            st.session_state.route_planner = RoutePlanner()
+        routes = st.session_state.route_planner.plan_all(db.find('partners'), matched, vcap)
+        total = sum(r['distance_km'] for r in routes)
+        st.success(f"✅ {len(routes)} routes covering {len(matched)} stops ({total:,.1f} km total)")
+        data = [{'Partner': r['partner']['name'], 'Stops': len(r['stops']), 'Load (kg)': r['load_kg'], 'Distance (km)': round(r['distance_km'], 1),
+                 'Pickup Order': ' → '.join(f"#{s['id']}" for s in r['stops'])} for r in routes]
+        st.dataframe(table_frame(data), use_container_width=True, hide_index=True)
+
+@st.cache_resource
+def get_export_jobs():
+    """Process-wide background exports, written to ``AGRILOOP_EXPORT_DIR``."""
+    return ExportJobs(EXPORT_DIR)
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@fragment
+def admin_exports():
+    """Background table exports with download buttons for the finished ones."""
+    st.subheader("Data Exports")
+    st.caption(f"Exports are written in chunks on a background thread to `{EXPORT_DIR}/`, so even millions of rows don't hold up the app. Password hashes are never exported.")
+    c1, c2, c3 = st.columns(3)
+    table = c1.selectbox("Table", EXPORT_TABLES, format_func=lambda t: t.replace('_', ' ').title(), key='exp_table')
+    fmt = c2.selectbox("Format", EXPORT_FORMATS, format_func=str.upper, key='exp_format')
+    compression = c3.selectbox("Compression", EXPORT_COMPRESSIONS[fmt], format_func=lambda c: c or "none")
+    c1, c2, c3, c4 = st.columns(4)
+    owner = c1.text_input("Owner (username)", key='exp_owner').strip() or None
+    status = c2.text_input("Status", key='exp_status', disabled=table == 'users').strip() or None
+    since = c3.date_input("Created from", value=None, key='exp_since')
+    until = c4.date_input("Created through", value=None, key='exp_until')
+    if st.button("📤 Start Export", type="primary"):
+        try:
+            get_export_jobs().submit(db, table, fmt, compression, requested_by=st.session_state.current_user, owner=owner,
+                                     status=status if table != 'users' else None, since=since.isoformat() if since else None,
+                                     until=(until + timedelta(days=1)).isoformat() if until else None)
+            st.toast(f"📤 Exporting {table.replace('_', ' ')}...")
+        except (ValueError, ImportError) as e:
+            st.error(f"❌ {e}")
+    
+    jobs = get_export_jobs().jobs()[:10]
+    if not jobs:
+        return
+    if any(j['status'] == 'running' for j in jobs):
+        st.button("🔄 Refresh", key='exp_refresh')
+    icon = {'running': "⏳", 'done': "✅", 'failed': "❌"}
+    for j in jobs:
+        c1, c2, c3 = st.columns([3, 2, 1])
+        c1.markdown(f"{icon[j['status']]} `{os.path.basename(j['path'])}`")
+        size = os.path.getsize(j['path']) if j['status'] == 'done' and os.path.exists(j['path']) else 0
+        c2.caption(j['error'] if j['status'] == 'failed' else f"{j['rows']:,} rows" + (f" · {size / 2**20:,.1f} MB" if size else ""))
+        if size and size <= EXPORT_DOWNLOAD_LIMIT:
+            c3.download_button("⬇️ Download", data=lambda path=j['path']: _read_file(path), file_name=os.path.basename(j['path']),
+                               mime=CONTENT_TYPE[j['format']], key=f"exp_dl_{j['id']}", on_click='ignore')
+
+@fragment
+def admin_impact():
+    """Platform-wide impact over time and the regions and users contributing most."""
+    st.subheader("Sustainability Impact")
+    label = st.radio("Period", list(IMPACT_GRAINS), index=2, horizontal=True, key='admin_impact_grain')
+    grain, shown = IMPACT_GRAINS[label]
+    impact = get_impact()
+    impact_metrics(impact.totals(db, 'all'))
+    s = impact.series(db, 'all', grain=grain)
+    s = {k: v[-shown:] for k, v in s.items()}
+    impact_chart(s['period'], co2e_columns(s), "Emissions avoided by source", "kg CO₂e")
+    c1, c2 = st.columns(2)
+    with c1:
+        top = impact.ranking(db, 'region', limit=15)
+        impact_chart([r for r, _ in top], {"CO₂e avoided": [t['co2e_avoided_kg'] for _, t in top]},
+                     f"Top regions ({REGION_DEG:g}° cells)", "kg CO₂e", horizontal=True)
+    with c2:
+        top = impact.ranking(db, 'user', limit=15)
+        st.markdown("**Top contributors**")
+        st.dataframe(table_frame([{'User': u, 'Water saved (L)': round(t['water_saved_l']), 'Waste diverted (kg)': round(t['waste_diverted_kg']),
+                                   'Food rescued (kg)': round(t['food_rescued_kg']), 'CO₂e avoided (kg)': round(t['co2e_avoided_kg'])}
+                                  for u, t in top]), use_container_width=True, hide_index=True)
+
+def page_admin():
+    user = current_account()
     if user['role'] != 'admin':
         st.error("❌ Admin access required")
         st.stop()
@@ -631,7 +1223,7 @@ elif st.session_state.logged_in and page == 'admin':
     st.title("🔧 Admin Panel")
     
     cols = st.columns(4)
-    for col, (val, label, color) in zip(cols, [(len(st.session_state.users), "Users", "blue"), (len(st.session_state.farms), "Farms", "green"), (len(st.session_state.crops), "Crops", "orange"), (len(st.session_state.advisories), "Advisories", "purple")]):
+    for col, (val, label, color) in zip(cols, [(db.count('users'), "Users", "blue"), (db.count('farms'), "Farms", "green"), (db.count('crops'), "Crops", "orange"), (db.count('advisories'), "Advisories", "purple")]):
         with col:
             st.markdown(f"""<div class="metric-card"><div class="value {color}">{val}</div><div class="label">{label}</div></div>""", unsafe_allow_html=True)
     
@@ -640,9 +1232,7 @@ elif st.session_state.logged_in and page == 'admin':
     # Role distribution
     st.subheader("👥 User Distribution")
     roles = {'farmer': 0, 'processor': 0, 'waste_converter': 0, 'admin': 0}
-    for u in st.session_state.users.values():
-        r = u.get('role', 'farmer')
-        if r in roles: roles[r] += 1
+    roles.update({r: n for r, n in db.aggregate('users', 'role').items() if r in roles})
     
     cols = st.columns(4)
     for col, (role, count) in zip(cols, roles.items()):
@@ -651,75 +1241,32 @@ elif st.session_state.logged_in and page == 'admin':
     
     st.divider()
     
-    tab1, tab2, tab3 = st.tabs(["👥 Users", "🌱 Farms", "🤝 Partners"])
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs(["👥 Users", "🌱 Farms", "🤝 Partners", "♻️ Assignments", "🚚 Logistics", "📤 Exports", "🌍 Impact"])
     
     with tab1:
-        st.subheader("User Management")
-        data = [{'Username': u, 'Email': d['email'], 'Name': d.get('full_name', ''), 'Role': d['role']} for u, d in st.session_state.users.items()]
-        st.dataframe(pd.DataFrame(data), use_container_width=True, hide_index=True)
-        
-        st.markdown("---")
-        st.subheader("Change Role")
-        others = [u for u in st.session_state.users.keys() if u != st.session_state.current_user]
-        if others:
-            c1, c2, c3 = st.columns(3)
-            sel_u = c1.selectbox("User", others)
-            new_r = c2.selectbox("New Role", ["farmer", "processor", "waste_converter", "admin"])
-            with c3:
-                st.write("")
-                st.write("")
-                if st.button("Update"):
-                    st.session_state.users[sel_u]['role'] = new_r
-                    st.success(f"✅ Updated {sel_u} to {new_r}")
-                    st.rerun()
-        
-        st.subheader("Delete User")
-        if others:
-            c1, c2 = st.columns([2, 1])
-            del_u = c1.selectbox("Select User", others, key="del")
-            with c2:
-                st.write("")
-                st.write("")
-                if st.button("🗑️ Delete"):
-                    del st.session_state.users[del_u]
-                    st.session_state.farms = [f for f in st.session_state.farms if f['owner'] != del_u]
-                    st.session_state.crops = [c for c in st.session_state.crops if c['owner'] != del_u]
-                    st.success(f"✅ Deleted {del_u}")
-                    st.rerun()
-    
+        admin_users(roles)
     with tab2:
-        st.subheader("All Farms")
-        if st.session_state.farms:
-            data = [{'ID': f['id'], 'Name': f['name'], 'Area': f['area_hectares'], 'Owner': f['owner']} for f in st.session_state.farms]
-            st.dataframe(pd.DataFrame(data), use_container_width=True, hide_index=True)
-        else:
-            st.info("No farms yet")
-    
+        admin_farms()
     with tab3:
-        st.subheader("Partners")
-        if st.session_state.partners:
-            data = [{'ID': p['id'], 'Name': p['name'], 'Type': p['type'], 'Capacity': p['capacity'], 'Rating': p['rating']} for p in st.session_state.partners]
-            st.dataframe(pd.DataFrame(data), use_container_width=True, hide_index=True)
-        
-        st.markdown("---")
-        st.subheader("Add Partner")
-        with st.form("add_partner"):
-            c1, c2 = st.columns(2)
-            pname = c1.text_input("Name *")
-            ptype = c2.selectbox("Type", ["compost_facility", "biogas_plant", "food_bank", "recycling_center"])
-            c1, c2, c3 = st.columns(3)
-            cap = c1.number_input("Capacity (kg/day)", min_value=1, value=1000)
-            plat = c2.number_input("Latitude", value=28.6139, format="%.6f")
-            plng = c3.number_input("Longitude", value=77.2090, format="%.6f")
-            
-            if st.form_submit_button("Add Partner", use_container_width=True, type="primary"):
-                if pname:
-                    st.session_state.partners.append({
-                        'id': len(st.session_state.partners) + 1, 'name': pname, 'type': ptype,
-                        'capacity': cap, 'lat': plat, 'lng': plng, 'rating': 0
-                    })
-                    st.success(f"✅ Partner '{pname}' added!")
-                    st.rerun()
+        admin_partners()
+    with tab4:
+        admin_assignments()
+    with tab5:
+        admin_logistics()
+    with tab6:
+        admin_exports()
+    with tab7:
+        admin_impact()
+
+# ============ ROUTING ============
+PUBLIC_PAGES = {'home': page_home, 'login': page_login, 'register': page_register}
+PRIVATE_PAGES = {'dashboard': page_dashboard, 'farms': page_farms, 'advisory': page_advisory,
+                 'surplus': page_surplus, 'circular': page_circular, 'admin': page_admin}
+
+render = (PRIVATE_PAGES if st.session_state.logged_in else PUBLIC_PAGES).get(st.session_state.page)
+if render:
+    with metrics.rerun(st.session_state.page, st.session_state.session_id, profiler):
+        render()
 
 # ---------- FOOTER ----------
 st.markdown("""<div class="footer"><p>© 2024 AgriLoop AI. All rights reserved.</p></div>""", unsafe_allow_html=True)
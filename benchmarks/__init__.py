@@ -0,0 +1 @@
+"""Headless benchmarks for the AgriLoop AI app (see ``benchmarks.run``)."""
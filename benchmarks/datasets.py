@@ -0,0 +1,122 @@
+"""Synthetic AgriLoop datasets for benchmarking.
+
+``build(path, scale)`` fills a SQLite database with ``scale`` times the
+reference volumes (10k users, 100k farms, 500k crops, 1M advisories plus
+listings, waste requests and partners). Rows are spread uniformly over the
+users, except that the ``bench`` admin account owns ``HEAVY_SHARE`` of every
+table so the per-user pages are measured against a large account. Output is
+deterministic for a given ``seed``.
+"""
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from agriloop.engine import BASE_YIELD, table_yield
+from agriloop.importer import SOIL_TYPES
+from agriloop.matching import WASTE_PARTNER_TYPES
+from agriloop.storage import SqliteRepository
+
+VOLUMES = {'users': 10_000, 'farms': 100_000, 'crops': 500_000, 'advisories': 1_000_000,
+           'surplus_listings': 100_000, 'waste_requests': 100_000, 'partners': 2_000}
+HEAVY_USER, HEAVY_PASSWORD = 'bench', 'bench'
+HEAVY_SHARE = 0.01
+CHUNK = 50_000
+
+def _owners(rng, n, users):
+    owner = rng.integers(1, len(users), n)
+    owner[rng.random(n) < HEAVY_SHARE] = 0
+    return [users[i] for i in owner]
+
+def _stamps(rng, n, start=datetime(2025, 1, 1), days=365):
+    secs = np.sort(rng.integers(0, days * 86400, n))
+    return [(start + timedelta(seconds=int(s))).isoformat() for s in secs]
+
+def _insert(repo, table, columns, on_progress=None):
+    n = len(next(iter(columns.values())))
+    for lo in range(0, n, CHUNK):
+        repo.insert_many(table, [dict(zip(columns, vals)) for vals in zip(*(c[lo:lo + CHUNK] for c in columns.values()))])
+        if on_progress:
+            on_progress(table, min(lo + CHUNK, n), n)
+
+def build(path, scale=1.0, seed=7, on_progress=None):
+    """Create the dataset at ``path`` (which must not exist yet); returns the row counts."""
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    rng = np.random.default_rng(seed)
+    size = {t: max(1, int(n * scale)) for t, n in VOLUMES.items()}
+    repo = SqliteRepository(path)
+    pw = hashlib.sha256(HEAVY_PASSWORD.encode()).hexdigest()
+
+    users = [HEAVY_USER] + [f"user{i:06d}" for i in range(1, size['users'])]
+    roles = rng.choice(['farmer', 'processor', 'waste_converter'], len(users), p=[0.8, 0.1, 0.1]).tolist()
+    roles[0] = 'admin'
+    _insert(repo, 'users', {'username': users, 'password': [pw] * len(users), 'email': [f"{u}@example.com" for u in users],
+                            'full_name': [u.title() for u in users], 'role': roles, 'phone': [''] * len(users),
+                            'created_at': _stamps(rng, len(users))}, on_progress)
+
+    n = size['partners']
+    _insert(repo, 'partners', {'name': [f"Partner {i}" for i in range(n)],
+                               'type': rng.choice(sorted({t for ts in WASTE_PARTNER_TYPES.values() for t in ts}), n).tolist(),
+                               'capacity': rng.integers(500, 20_000, n).tolist(),
+                               'lat': rng.uniform(8, 35, n).round(5).tolist(), 'lng': rng.uniform(68, 97, n).round(5).tolist(),
+                               'rating': rng.uniform(3, 5, n).round(1).tolist()}, on_progress)
+
+    n = size['farms']
+    farm_owner = _owners(rng, n, users)
+    _insert(repo, 'farms', {'name': [f"Farm {i}" for i in range(n)], 'area_hectares': rng.uniform(0.5, 50, n).round(2).tolist(),
+                            'location_latitude': rng.uniform(8, 35, n).round(5).tolist(),
+                            'location_longitude': rng.uniform(68, 97, n).round(5).tolist(),
+                            'location_address': [''] * n, 'soil_type': rng.choice(SOIL_TYPES, n).tolist(),
+                            'owner': farm_owner, 'created_at': _stamps(rng, n)}, on_progress)
+
+    n = size['crops']
+    farm_of = rng.integers(0, size['farms'], n)
+    planted = _stamps(rng, n)
+    _insert(repo, 'crops', {'farm_id': (farm_of + 1).tolist(), 'crop_name': rng.choice(sorted(BASE_YIELD), n).tolist(),
+                            'area_hectares': rng.uniform(0.1, 10, n).round(2).tolist(),
+                            'planting_date': [p[:10] for p in planted],
+                            'expected_harvest_date': [(datetime.fromisoformat(p) + timedelta(days=120)).date().isoformat() for p in planted],
+                            'status': rng.choice(['active', 'harvested', 'failed'], n, p=[0.6, 0.35, 0.05]).tolist(),
+                            'owner': [farm_owner[f] for f in farm_of], 'created_at': planted}, on_progress)
+
+    n = size['advisories']
+    _insert(repo, 'advisories', {'user': _owners(rng, n, users), 'crop_id': rng.integers(1, size['crops'] + 1, n).tolist(),
+                                 'type': ['irrigation'] * n, 'status': ['completed'] * n,
+                                 'level': rng.integers(0, 4, n).tolist(), 'soil_moisture': rng.uniform(0, 100, n).round(1).tolist(),
+                                 'volume': rng.uniform(0, 5000, n).round(1).tolist(), 'frequency': rng.integers(1, 8, n).tolist(),
+                                 'created_at': _stamps(rng, n)}, on_progress)
+
+    n = size['surplus_listings']
+    _insert(repo, 'surplus_listings', {'user': _owners(rng, n, users), 'crop_id': rng.integers(1, size['crops'] + 1, n).tolist(),
+                                       'crop': rng.choice(sorted(BASE_YIELD), n).tolist(), 'quantity': rng.integers(10, 5000, n).tolist(),
+                                       'harvest_date': [s[:10] for s in _stamps(rng, n)], 'unit_price': rng.uniform(0.2, 3, n).round(2).tolist(),
+                                       'status': rng.choice(['available', 'sold'], n).tolist(), 'created_at': _stamps(rng, n)}, on_progress)
+
+    n = size['waste_requests']
+    status = rng.choice(['pending', 'matched', 'completed'], n, p=[0.3, 0.3, 0.4])
+    _insert(repo, 'waste_requests', {'user': _owners(rng, n, users), 'waste_type': rng.choice(sorted(WASTE_PARTNER_TYPES), n).tolist(),
+                                     'quantity_kg': rng.integers(10, 2000, n).tolist(),
+                                     'location_latitude': rng.uniform(8, 35, n).round(5).tolist(),
+                                     'location_longitude': rng.uniform(68, 97, n).round(5).tolist(), 'location_address': [''] * n,
+                                     'status': status.tolist(),
+                                     'partner_id': [int(p) if s != 'pending' else None for s, p in zip(status, rng.integers(1, size['partners'] + 1, n))],
+                                     'created_at': _stamps(rng, n), 'matched_at': [None] * n}, on_progress)
+    return size
+
+def yield_history(n, seed=7):
+    """``n`` synthetic harvest records (the columns ``yieldmodel.fit_file`` reads).
+
+    Yields follow the engine's lookup table with a weather response
+    (optimum near 25 °C, diminishing returns to rain) and log-normal noise.
+    """
+    rng = np.random.default_rng(seed)
+    crops = rng.choice(sorted(BASE_YIELD) + ["sorghum", "cotton"], n)
+    soils = rng.choice(list(SOIL_TYPES) + [None], n)
+    area = rng.uniform(0.2, 20, n).round(2)
+    temp, rain, humid = rng.normal(26, 5, n).round(1), rng.gamma(2, 40, n).round(1), rng.uniform(30, 95, n).round()
+    response = np.exp(-((temp - 25) / 12) ** 2) * (1 - np.exp(-rain / 60)) * area ** -0.03
+    yld = table_yield(crops.tolist(), area, soils.tolist()) * response * rng.lognormal(0, 0.15, n) * 1.4
+    return {'crop_name': crops.tolist(), 'soil_type': soils.tolist(), 'area_hectares': area, 'temperature': temp,
+            'rainfall': rain, 'humidity': humid, 'yield_kg': yld.round(1)}
@@ -0,0 +1,334 @@
+"""Headless AgriLoop benchmark suite.
+
+Drives ``app.py`` with Streamlit's AppTest against a synthetic SQLite
+dataset (see ``benchmarks.datasets``) and reports, per page, the cold and
+warm rerun latency and the peak Python allocation of one rerun; the
+latency of representative marketplace searches and impact rollup queries;
+the throughput of the prediction helpers; cold-start time to first render
+(median of fresh interpreters); and the peak RSS of the process.
+Results are written as JSON so runs can be compared::
+
+    python -m benchmarks.run                         # full scale, print results
+    python -m benchmarks.run --scale 0.1 --save dev  # -> benchmarks/baselines/dev.json
+    python -m benchmarks.run --compare benchmarks/baselines/dev.json
+
+``--compare`` exits with status 1 when a latency or throughput figure is
+worse than the baseline by more than ``--tolerance``.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, "benchmarks", "baselines")
+PAGES = ['dashboard', 'farms', 'advisory', 'surplus', 'circular', 'admin']
+
+def _log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+def dataset(path, scale, seed):
+    from benchmarks import datasets
+    if not os.path.exists(path):
+        _log(f"building dataset {path} (scale {scale})")
+        t0 = time.perf_counter()
+        datasets.build(path, scale, seed, on_progress=lambda t, done, n: _log(f"  {t}: {done:,}/{n:,}") if done == n else None)
+        _log(f"  built in {time.perf_counter() - t0:.1f}s")
+    return path
+
+def _share_bytecode():
+    # A running server compiles app.py once; AppTest builds a fresh ScriptCache
+    # per run, so without this every rerun would also pay for compiling the script.
+    from streamlit.runtime.scriptrunner import script_cache
+    compiled, original = {}, script_cache.ScriptCache.get_bytecode
+    script_cache.ScriptCache.get_bytecode = lambda self, path: compiled.get(path) or compiled.setdefault(path, original(self, path))
+
+def bench_pages(db_path, repeat):
+    from streamlit.testing.v1 import AppTest
+    from benchmarks.datasets import HEAVY_USER
+    os.environ['AGRILOOP_DB'] = db_path
+    _share_bytecode()
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=600).run()
+    at.session_state.logged_in = True
+    at.session_state.current_user = HEAVY_USER
+    results = {}
+    for page in PAGES:
+        at.session_state.page = page
+        t0 = time.perf_counter()
+        at.run()
+        cold = time.perf_counter() - t0
+        if at.exception:
+            raise RuntimeError(f"{page}: {at.exception[0].message}")
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            at.run()
+            times.append(time.perf_counter() - t0)
+        tracemalloc.start()
+        at.run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        times.sort()
+        results[page] = {'cold_ms': cold * 1000, 'p50_ms': statistics.median(times) * 1000,
+                         'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+                         'mean_ms': statistics.fmean(times) * 1000, 'peak_alloc_mb': peak / 2**20}
+        _log(f"  {page:10s} cold {cold * 1000:8.1f} ms  p50 {results[page]['p50_ms']:8.1f} ms  alloc {peak / 2**20:7.1f} MB")
+    return results
+
+MARKET_QUERIES = {
+    'all_by_price': {},
+    'one_crop': {'crops': ['tomato']},
+    'price_band': {'min_price': 1.0, 'max_price': 1.2, 'sort': 'harvest_date', 'descending': True},
+    'harvest_window': {'harvest_from': '2025-03-01', 'harvest_to': '2025-03-14'},
+    'nearby': {'near': (20.0, 80.0), 'radius_km': 100, 'sort': 'distance'},
+    'faceted': {'crops': ['rice', 'wheat'], 'min_quantity': 1000, 'max_price': 2.0, 'near': (15.0, 75.0), 'radius_km': 500},
+}
+
+def bench_marketplace(db_path, repeat):
+    from agriloop.marketplace import ListingIndex
+    from agriloop.storage import SqliteRepository
+    repo, index = SqliteRepository(db_path), ListingIndex()
+    t0 = time.perf_counter()
+    index.sync(repo)
+    results = {'load': {'ms': (time.perf_counter() - t0) * 1000, 'listings': len(index)}}
+    _log(f"  {'load':14s} {results['load']['ms']:8.1f} ms  ({len(index):,} listings)")
+    for name, q in MARKET_QUERIES.items():
+        times = []
+        for _ in range(max(repeat, 5)):
+            t0 = time.perf_counter()
+            _, total = index.search(repo, **q)
+            times.append(time.perf_counter() - t0)
+        results[name] = {'p50_ms': statistics.median(times) * 1000, 'total': total}
+        _log(f"  {name:14s} {results[name]['p50_ms']:8.2f} ms  ({total:,} matches)")
+    return results
+
+IMPACT_QUERIES = {
+    'user_month': lambda r, repo, user: r.series(repo, 'user', user, 'month'),
+    'user_day': lambda r, repo, user: r.series(repo, 'user', user, 'day'),
+    'farm_totals': lambda r, repo, user: r.totals(repo, 'farm', 1),
+    'all_day': lambda r, repo, user: r.series(repo, 'all', grain='day'),
+    'region_ranking': lambda r, repo, user: r.ranking(repo, 'region'),
+    'user_ranking': lambda r, repo, user: r.ranking(repo, 'user'),
+}
+
+def bench_impact(db_path, repeat):
+    from agriloop.impact import ImpactRollups
+    from agriloop.storage import SqliteRepository
+    from benchmarks.datasets import HEAVY_USER
+    repo, rollups = SqliteRepository(db_path), ImpactRollups()
+    t0 = time.perf_counter()
+    rollups.sync(repo)
+    results = {'load': {'ms': (time.perf_counter() - t0) * 1000, 'buckets': len(rollups)}}
+    _log(f"  {'load':14s} {results['load']['ms']:8.1f} ms  ({len(rollups):,} buckets)")
+    for name, query in IMPACT_QUERIES.items():
+        times = []
+        for _ in range(max(repeat, 5)):
+            t0 = time.perf_counter()
+            query(rollups, repo, HEAVY_USER)
+            times.append(time.perf_counter() - t0)
+        results[name] = {'p50_ms': statistics.median(times) * 1000}
+        _log(f"  {name:14s} {results[name]['p50_ms']:8.2f} ms")
+    return results
+
+def _rate(fn, n, min_time=0.5):
+    """Operations per second of ``fn()`` doing ``n`` operations, best of repeated timings."""
+    best, spent = float('inf'), 0.0
+    while spent < min_time:
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best, spent = min(best, dt), spent + dt
+    return n / best
+
+def bench_helpers():
+    from agriloop import engine, yieldmodel
+    from agriloop.scheduler import plan_irrigation
+    from benchmarks.datasets import yield_history
+    rng = np.random.default_rng(0)
+    n = 100_000
+    sm, temp, hum, rain = rng.uniform(0, 100, n), rng.uniform(0, 50, n), rng.uniform(0, 100, n), rng.uniform(0, 100, n)
+    area = rng.uniform(0.1, 10, n)
+    crops = rng.choice(sorted(engine.BASE_YIELD), n).tolist()
+    soils = rng.choice(["loamy", "clay", "sandy", "silty", None], n).tolist()
+    k = 2_000
+    history = yield_history(200_000)
+    t0 = time.perf_counter()
+    model = yieldmodel.fit(history['crop_name'], history['area_hectares'], history['soil_type'], history['yield_kg'],
+                           {w: history[w] for w in yieldmodel.WEATHER})
+    fit_s = time.perf_counter() - t0
+    with tempfile.TemporaryDirectory() as tmp:
+        model.save(os.path.join(tmp, "yield_model.npz"))
+        t0 = time.perf_counter()
+        model = yieldmodel.load(os.path.join(tmp, "yield_model.npz"))
+        load_ms = (time.perf_counter() - t0) * 1e3
+    weather = {'temperature': temp, 'rainfall': rain, 'humidity': hum}
+    results = {
+        'get_irrigation_rec': _rate(lambda: [engine.get_irrigation_rec(sm[i], temp[i], hum[i], rain[i], crops[i], area[i]) for i in range(k)], k),
+        'irrigation_batch': _rate(lambda: engine.irrigation_batch(sm, temp, hum, rain, area), n),
+        'predict_yield': _rate(lambda: [engine.predict_yield(crops[i], area[i], soils[i]) for i in range(k)], k),
+        'predict_surplus': _rate(lambda: [engine.predict_surplus(area[i] * 1000, 1000, 500) for i in range(k)], k),
+        'forecast_surplus': _rate(lambda: engine.forecast_surplus(crops[:10_000], area[:10_000], soils[:10_000], 1000, 500), 10_000),
+        'plan_irrigation': _rate(lambda: plan_irrigation(sm[:50_000], area[:50_000], temp[:50_000], hum[:50_000], days=14,
+                                                         budget=area[:50_000].sum() * 20_000), 50_000),
+    }
+    results['yield_table'] = _rate(lambda: engine.expected_yield(crops, area, soils), n)
+    results['yield_model'] = _rate(lambda: engine.expected_yield(crops, area, soils, model, weather), n)
+    for name, rate in results.items():
+        _log(f"  {name:20s} {rate:14,.0f} /s")
+    _log(f"  yield model: trained on {len(history['yield_kg']):,} records in {fit_s:.2f} s, loaded in {load_ms:.1f} ms, "
+         f"{1e6 / results['yield_model']:.2f} µs/crop at {n:,} crops")
+    return {name: {'ops_per_s': rate} for name, rate in results.items()}
+
+def _startup_probe():
+    """One cold start in this fresh interpreter; prints its timings as JSON.
+
+    ``import_ms`` covers app.py's module-level imports, ``first_render_ms``
+    the first run of the landing page after them and ``session_ms`` a
+    further new session. Renders are timed inside the script thread, so
+    AppTest's own start-up and polling are left out.
+    """
+    import ast
+    from streamlit.testing.v1 import AppTest
+    app = os.path.join(ROOT, "app.py")
+    with open(app, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    imports = ast.Module([n for n in tree.body if isinstance(n, (ast.Import, ast.ImportFrom))], [])
+    t0 = time.perf_counter()
+    exec(compile(imports, app, "exec"), {'__name__': "startup_probe"})
+    import_ms = (time.perf_counter() - t0) * 1000
+    modules = len(sys.modules)
+    with tempfile.TemporaryDirectory() as tmp:
+        timed, out = os.path.join(tmp, "timed_app.py"), os.path.join(tmp, "render_ms")
+        with open(timed, "w") as f:
+            f.write(f"import runpy, time\nt0 = time.perf_counter()\nrunpy.run_path({app!r}, run_name='__main__')\n"
+                    f"open({out!r}, 'w').write(str((time.perf_counter() - t0) * 1000))\n")
+        def render():
+            at = AppTest.from_file(timed, default_timeout=120).run()
+            if at.exception:
+                raise RuntimeError(at.exception[0].message)
+            with open(out) as f:
+                return float(f.read())
+        first, session = render(), render()
+    print(json.dumps({'import_ms': import_ms, 'first_render_ms': first, 'time_to_first_render_ms': import_ms + first,
+                      'session_ms': session, 'modules': modules, 'pandas_loaded': 'pandas' in sys.modules}))
+
+def bench_startup(samples=5):
+    """Median cold-start figures over ``samples`` fresh interpreters, each with a new database."""
+    runs = []
+    for _ in range(samples):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {**os.environ, 'AGRILOOP_DB': os.path.join(tmp, "startup.db"), 'PYTHONPATH': ROOT}
+            out = subprocess.run([sys.executable, "-m", "benchmarks.run", "--startup-probe"], cwd=ROOT, env=env,
+                                 capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+    result = {k: statistics.median(r[k] for r in runs) for k in runs[0] if k.endswith("_ms")}
+    result.update(modules=runs[0]['modules'], pandas_loaded=runs[0]['pandas_loaded'])
+    _log(f"  imports {result['import_ms']:.0f} ms + first render {result['first_render_ms']:.0f} ms = "
+         f"{result['time_to_first_render_ms']:.0f} ms; new session {result['session_ms']:.0f} ms; "
+         f"{result['modules']} modules, pandas {'loaded' if result['pandas_loaded'] else 'not loaded'}")
+    return result
+
+def _meta(args):
+    import pandas
+    import streamlit
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'scale': args.scale, 'seed': args.seed,
+            'repeat': args.repeat, 'python': platform.python_version(), 'platform': platform.platform(),
+            'streamlit': streamlit.__version__, 'pandas': pandas.__version__, 'numpy': np.__version__}
+
+def compare(current, baseline, tolerance):
+    """Print the change of every figure against ``baseline``; returns the regressions beyond ``tolerance``."""
+    regressions = []
+    if baseline.get('meta', {}).get('scale') != current['meta']['scale']:
+        print(f"note: baseline scale {baseline.get('meta', {}).get('scale')} differs from {current['meta']['scale']}")
+    rows = [(f"pages.{p}.{m}", v, baseline.get('pages', {}).get(p, {}).get(m), False)
+            for p, r in current['pages'].items() for m, v in r.items()]
+    rows += [(f"marketplace.{q}.p50_ms", r['p50_ms'], baseline.get('marketplace', {}).get(q, {}).get('p50_ms'), False)
+             for q, r in current.get('marketplace', {}).items() if 'p50_ms' in r]
+    rows += [(f"impact.{q}.p50_ms", r['p50_ms'], baseline.get('impact', {}).get(q, {}).get('p50_ms'), False)
+             for q, r in current.get('impact', {}).items() if 'p50_ms' in r]
+    rows += [(f"helpers.{h}.ops_per_s", r['ops_per_s'], baseline.get('helpers', {}).get(h, {}).get('ops_per_s'), True)
+             for h, r in current['helpers'].items()]
+    rows += [(f"startup.{m}", v, baseline.get('startup', {}).get(m), False)
+             for m, v in current.get('startup', {}).items() if m.endswith("_ms")]
+    rows.append(("peak_rss_mb", current['peak_rss_mb'], baseline.get('peak_rss_mb'), False))
+    for name, now, before, higher_is_better in rows:
+        if not before:
+            print(f"{name:40s} {now:14.1f}   (new)")
+            continue
+        change = now / before - 1
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance and not name.endswith(("cold_ms", "peak_alloc_mb")):
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:40s} {now:14.1f} {change:+8.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Headless AgriLoop benchmarks.")
+    ap.add_argument("--scale", type=float, default=1.0, help="fraction of the reference dataset size")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--repeat", type=int, default=10, help="warm reruns timed per page")
+    ap.add_argument("--data", help="dataset path (default benchmarks/data/agriloop-<scale>-<seed>.db)")
+    ap.add_argument("--save", metavar="NAME", help="write results to benchmarks/baselines/NAME.json")
+    ap.add_argument("--out", help="write results to this path")
+    ap.add_argument("--compare", metavar="BASELINE", help="baseline JSON to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown before --compare fails")
+    ap.add_argument("--skip-pages", action="store_true", help="only run the helper and startup benchmarks")
+    ap.add_argument("--startup-samples", type=int, default=5, help="fresh interpreters timed for the startup figures")
+    ap.add_argument("--startup-probe", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+    if args.startup_probe:
+        return _startup_probe()
+
+    sys.path.insert(0, ROOT)
+    data = args.data or os.path.join(ROOT, "benchmarks", "data", f"agriloop-{args.scale:g}-{args.seed}.db")
+    os.makedirs(os.path.dirname(data), exist_ok=True)
+    result = {'meta': _meta(args)}
+    if not args.skip_pages:
+        _log("pages")
+        result['pages'] = bench_pages(dataset(data, args.scale, args.seed), args.repeat)
+        _log("marketplace")
+        result['marketplace'] = bench_marketplace(data, args.repeat)
+        _log("impact")
+        result['impact'] = bench_impact(data, args.repeat)
+    else:
+        result['pages'] = {}
+    _log("helpers")
+    result['helpers'] = bench_helpers()
+    _log("startup")
+    result['startup'] = bench_startup(args.startup_samples)
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    text = json.dumps(result, indent=2)
+    paths = [args.out] if args.out else []
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        paths.append(os.path.join(BASELINES, f"{args.save}.json"))
+    for path in paths:
+        with open(path, "w") as f:
+            f.write(text + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+            sys.exit(1)
+    elif not paths:
+        print(text)
+
+if __name__ == "__main__":
+    main()